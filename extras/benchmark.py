@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+#    Copyright (C) 2022 Ben Woodcroft
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+__author__ = "Ben Woodcroft"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Ben Woodcroft"]
+__license__ = "GPL3"
+__maintainer__ = "Ben Woodcroft"
+__email__ = "benjwoodcroft near gmail.com"
+__status__ = "Development"
+
+# Benchmark the hot paths of SingleM on synthetic data of several sizes.
+#
+# For each benchmark and scale, synthetic input is generated with a fixed
+# random seed, and then the code being benchmarked is run in a fresh process,
+# so that the peak RSS reported is that of the benchmarked code alone (plus
+# imports). Wall time, peak RSS and throughput are reported as a TSV.
+#
+# The pipe benchmark requires the same external programs as singlem pipe
+# (DIAMOND, OrfM, HMMER etc.) and the query benchmark requires the index
+# library of the chosen --search-method.
+
+import argparse
+import logging
+import sys
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import importlib
+import multiprocessing
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')] + sys.path
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','test','data')
+DEFAULT_METAPACKAGE = os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg.smpkg')
+
+BENCHMARKS = ['pipe', 'condense', 'makedb', 'query']
+DEFAULT_SCALES = [1000, 10000, 100000]
+
+# Index format used by makedb for each query search method
+SEARCH_METHOD_TO_INDEX_FORMAT = {
+    'naive': 'scann-naive',
+    'scann': 'scann',
+    'annoy': 'annoy',
+    'nmslib': 'nmslib',
+}
+
+WINDOW_SIZE = 60
+READ_LENGTH = 150
+NUM_SAMPLES = 10
+NUM_GENERA = 50
+SPECIES_PER_GENUS = 5
+# Fraction of synthetic reads drawn from the marker genes, the rest are random
+# sequence
+MARKER_READ_FRACTION = 0.1
+# Per-base substitution rate applied to reads and OTU sequences
+MUTATION_RATE = 0.02
+
+
+def _mutate(rng, seq, rate):
+    return ''.join([rng.choice('ACGT') if rng.random() < rate else c for c in seq])
+
+def _random_sequence(rng, length):
+    return ''.join(rng.choices('ACGT', k=length))
+
+def _read_fasta(path):
+    from singlem.sequence_classes import SeqReader
+    with open(path) as f:
+        return list([seq for (_, seq, _) in SeqReader().readfq(f)])
+
+def _marker_transcripts(metapackage_path):
+    from singlem.metapackage import Metapackage
+    metapackage = Metapackage.acquire(metapackage_path)
+    transcripts = []
+    for spkg in metapackage.singlem_packages:
+        transcripts_path = os.path.join(spkg.base_directory(), 'nucleotide_transcripts.fna')
+        if os.path.exists(transcripts_path):
+            transcripts.extend([t for t in _read_fasta(transcripts_path) if len(t) >= READ_LENGTH])
+    if len(transcripts) == 0:
+        raise Exception("No nucleotide transcripts of length >= {} found in metapackage {}".format(READ_LENGTH, metapackage_path))
+    return metapackage, transcripts
+
+def _taxonomy(genus, species):
+    return 'Root; d__Bacteria; p__P{0}; c__C{0}; o__O{0}; f__F{0}; g__G{0}; s__S{0}_{1}'.format(genus, species)
+
+def generate_reads(path, num_reads, transcripts, rng):
+    '''Write a FASTA file of reads, some of which are fragments of the marker
+    genes and the rest random sequence.'''
+    with open(path, 'w') as f:
+        for i in range(num_reads):
+            if rng.random() < MARKER_READ_FRACTION:
+                transcript = rng.choice(transcripts)
+                start = rng.randint(0, len(transcript) - READ_LENGTH)
+                seq = _mutate(rng, transcript[start:(start+READ_LENGTH)], MUTATION_RATE)
+            else:
+                seq = _random_sequence(rng, READ_LENGTH)
+            f.write(">read{}\n{}\n".format(i, seq))
+
+def _species_windows(rng, markers):
+    '''Return a dict of (marker, genus, species) to window sequence, with the
+    species of a genus having similar sequences.'''
+    windows = {}
+    for marker in markers:
+        for genus in range(NUM_GENERA):
+            genus_window = _random_sequence(rng, WINDOW_SIZE)
+            for species in range(SPECIES_PER_GENUS):
+                windows[(marker, genus, species)] = _mutate(rng, genus_window, 0.05)
+    return windows
+
+def generate_otu_table(path, num_otus, markers, rng, windows=None):
+    '''Write an OTU table of OTUs whose sequences are mutated copies of a set
+    of species' window sequences. If windows is None, the species are
+    generated with rng, otherwise windows is a dict as returned by
+    _species_windows.'''
+    if windows is None:
+        windows = _species_windows(rng, markers)
+    keys = list(windows.keys())
+    with open(path, 'w') as f:
+        f.write("\t".join(['gene','sample','sequence','num_hits','coverage','taxonomy'])+"\n")
+        for i in range(num_otus):
+            (marker, genus, species) = rng.choice(keys)
+            num_hits = rng.randint(1, 20)
+            f.write("\t".join([
+                marker,
+                'sample{}'.format(i % NUM_SAMPLES),
+                _mutate(rng, windows[(marker, genus, species)], MUTATION_RATE),
+                str(num_hits),
+                '%.2f' % (num_hits * 1.4),
+                _taxonomy(genus, species)])+"\n")
+
+def generate_archive_otu_table(path, num_otus, metapackage, rng):
+    '''Write an archive OTU table suitable as condense input, where each OTU
+    has been assigned to one or more equally best hit species.'''
+    from singlem.archive_otu_table import ArchiveOtuTable
+    from singlem.taxonomy import QUERY_BASED_ASSIGNMENT_METHOD
+
+    markers = list([spkg.graftm_package_basename() for spkg in metapackage.singlem_packages])
+    windows = _species_windows(rng, markers)
+    keys = list(windows.keys())
+    archive = ArchiveOtuTable(metapackage.singlem_packages)
+    for i in range(num_otus):
+        (marker, genus, species) = rng.choice(keys)
+        num_hits = rng.randint(1, 20)
+        best_hits = [_taxonomy(genus, species)]
+        # Some OTUs are ambiguous between species of the same genus
+        for other_species in range(SPECIES_PER_GENUS):
+            if other_species != species and rng.random() < 0.2:
+                best_hits.append(_taxonomy(genus, other_species))
+        archive.data.append([
+            marker,
+            'sample{}'.format(i % NUM_SAMPLES),
+            _mutate(rng, windows[(marker, genus, species)], MUTATION_RATE),
+            num_hits,
+            num_hits * 1.4,
+            'Root; d__Bacteria; p__P{0}; c__C{0}; o__O{0}; f__F{0}; g__G{0}'.format(genus),
+            ['read{}_{}'.format(i, j) for j in range(num_hits)],
+            [WINDOW_SIZE]*num_hits,
+            False,
+            None,
+            best_hits,
+            QUERY_BASED_ASSIGNMENT_METHOD])
+    with open(path, 'w') as f:
+        archive.write_to(f)
+
+
+def _run_pipe(inputs, options):
+    from singlem.pipe import SearchPipe
+    from singlem.metapackage import Metapackage
+    from singlem import defaults
+    from singlem.taxonomy import NAIVE_THEN_DIAMOND_ASSIGNMENT_METHOD
+    SearchPipe().run_to_otu_table(
+        sequences = [inputs['reads']],
+        threads = options['threads'],
+        known_otu_tables = None,
+        assignment_method = NAIVE_THEN_DIAMOND_ASSIGNMENT_METHOD,
+        assignment_threads = defaults.DEFAULT_ASSIGNMENT_THREADS,
+        output_jplace = None,
+        evalue = None,
+        min_orf_length = defaults.DEFAULT_MIN_ORF_LENGTH,
+        restrict_read_length = None,
+        filter_minimum_protein = defaults.DEFAULT_FILTER_MINIMUM_PROTEIN,
+        filter_minimum_nucleotide = defaults.DEFAULT_FILTER_MINIMUM_NUCLEOTIDE,
+        include_inserts = False,
+        metapackage_object = Metapackage.acquire(options['metapackage']),
+        assign_taxonomy = True,
+        known_sequence_taxonomy = None,
+        diamond_prefilter = True,
+        diamond_prefilter_performance_parameters = defaults.DEFAULT_PREFILTER_PERFORMANCE_PARAMETERS,
+        diamond_package_assignment = True,
+        diamond_prefilter_db = None,
+        diamond_taxonomy_assignment_performance_parameters = defaults.DEFAULT_DIAMOND_ASSIGN_TAXONOMY_PERFORMANCE_PARAMETERS,
+        assignment_singlem_db = None,
+        working_directory = None,
+        working_directory_dev_shm = False,
+        force = False)
+
+def _run_condense(inputs, options):
+    from singlem.condense import Condenser
+    from singlem.metapackage import Metapackage
+    from singlem.otu_table_collection import StreamingOtuTableCollection
+    otus = StreamingOtuTableCollection()
+    otus.add_archive_otu_table_file(inputs['archive_otu_table'])
+    Condenser().condense(
+        input_streaming_otu_table = otus,
+        output_otu_table = os.devnull,
+        krona = None,
+        metapackage = Metapackage.acquire(options['metapackage']))
+
+def _run_makedb(inputs, options):
+    from singlem.sequence_database import SequenceDatabase
+    from singlem.otu_table_collection import StreamingOtuTableCollection
+    otus = StreamingOtuTableCollection()
+    otus.add_otu_table_file(inputs['otu_table'])
+    SequenceDatabase.create_from_otu_table(
+        inputs['db'], otus,
+        num_threads = options['threads'],
+        sequence_database_methods = [SEARCH_METHOD_TO_INDEX_FORMAT[options['search_method']]])
+
+def _run_query(inputs, options):
+    from singlem.querier import Querier
+    from singlem.sequence_database import SequenceDatabase
+    from singlem.otu_table_collection import StreamingOtuTableCollection
+    otus = StreamingOtuTableCollection()
+    otus.add_otu_table_file(inputs['query_otu_table'])
+    # Results are written to stdout, which is discarded
+    with open(os.devnull, 'w') as devnull:
+        original_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            Querier().query(
+                db = inputs['db'],
+                max_divergence = 3,
+                output_style = 'sparse',
+                query_otu_table = otus,
+                num_threads = options['threads'],
+                search_method = options['search_method'],
+                sequence_type = SequenceDatabase.NUCLEOTIDE_TYPE,
+                max_nearest_neighbours = 1,
+                max_search_nearest_neighbours = 100,
+                preload_db = False,
+                limit_per_sequence = None)
+        finally:
+            sys.stdout = original_stdout
+
+BENCHMARK_FUNCTIONS = {
+    'pipe': _run_pipe,
+    'condense': _run_condense,
+    'makedb': _run_makedb,
+    'query': _run_query,
+}
+
+# Module imported by each benchmark, which is imported before timing starts
+BENCHMARK_MODULES = {
+    'pipe': 'singlem.pipe',
+    'condense': 'singlem.condense',
+    'makedb': 'singlem.sequence_database',
+    'query': 'singlem.querier',
+}
+
+# What the scale of each benchmark counts, for reporting throughput
+BENCHMARK_UNITS = {
+    'pipe': 'reads',
+    'condense': 'otus',
+    'makedb': 'otus',
+    'query': 'queries',
+}
+
+def _benchmark_child(benchmark, inputs, options, result_queue):
+    logging.basicConfig(level=options['loglevel'], format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    try:
+        importlib.import_module(BENCHMARK_MODULES[benchmark])
+        start = time.perf_counter()
+        BENCHMARK_FUNCTIONS[benchmark](inputs, options)
+        seconds = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on Linux. External programs run by the
+        # benchmarked code are counted separately.
+        result_queue.put((seconds,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            None))
+    except Exception as e:
+        result_queue.put((None, None, None, repr(e)))
+
+def run_benchmark(benchmark, inputs, options):
+    '''Run the benchmark in a new process, returning (seconds,
+    peak_rss_kb, peak_child_rss_kb, error).'''
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=_benchmark_child, args=(benchmark, inputs, options, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+def prepare_inputs(benchmark, scale, working_directory, metapackage_path, search_method, seed):
+    '''Generate the synthetic input for a benchmark at a given scale, returning
+    a dict of input name to path.'''
+    from singlem.otu_table_collection import StreamingOtuTableCollection
+    rng = random.Random(seed)
+    prefix = os.path.join(working_directory, '{}_{}'.format(benchmark, scale))
+    inputs = {}
+    if benchmark == 'pipe':
+        _, transcripts = _marker_transcripts(metapackage_path)
+        inputs['reads'] = prefix + '.fna'
+        generate_reads(inputs['reads'], scale, transcripts, rng)
+    elif benchmark == 'condense':
+        metapackage, _ = _marker_transcripts(metapackage_path)
+        inputs['archive_otu_table'] = prefix + '.json'
+        generate_archive_otu_table(inputs['archive_otu_table'], scale, metapackage, rng)
+    elif benchmark in ('makedb', 'query'):
+        markers = ['marker{}'.format(i) for i in range(3)]
+        inputs['otu_table'] = prefix + '.otu_table.csv'
+        inputs['db'] = prefix + '.sdb'
+        # Remove any database left by a previous run in the same working
+        # directory, since makedb will not overwrite it
+        if os.path.exists(inputs['db']):
+            shutil.rmtree(inputs['db'])
+        windows = _species_windows(rng, markers)
+        generate_otu_table(inputs['otu_table'], scale, markers, rng, windows=windows)
+        if benchmark == 'query':
+            # The query is run against a database of the same scale, which is
+            # built outside the benchmark. The query OTUs are different
+            # mutated copies of the same species as those in the database.
+            inputs['query_otu_table'] = prefix + '.query_otu_table.csv'
+            generate_otu_table(inputs['query_otu_table'], scale, markers,
+                random.Random('{}_query'.format(seed)), windows=windows)
+            from singlem.sequence_database import SequenceDatabase
+            otus = StreamingOtuTableCollection()
+            otus.add_otu_table_file(inputs['otu_table'])
+            SequenceDatabase.create_from_otu_table(
+                inputs['db'], otus,
+                sequence_database_methods = [SEARCH_METHOD_TO_INDEX_FORMAT[search_method]])
+    else:
+        raise Exception("Unknown benchmark {}".format(benchmark))
+    return inputs
+
+
+if __name__ == '__main__':
+    parent_parser = argparse.ArgumentParser(description='Benchmark SingleM pipe, condense, makedb and query on synthetic data')
+    parent_parser.add_argument('--debug', help='output debug information', action="store_true")
+    parent_parser.add_argument('--quiet', help='only output errors', action="store_true")
+    parent_parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+        help='Benchmarks to run [default: all]')
+    parent_parser.add_argument('--scales', nargs='+', type=int, default=DEFAULT_SCALES,
+        help='Number of reads (pipe), OTUs (condense, makedb) or queries (query) to benchmark with [default: {}]'.format(
+            ' '.join([str(s) for s in DEFAULT_SCALES])))
+    parent_parser.add_argument('--metapackage', default=DEFAULT_METAPACKAGE,
+        help='Metapackage used by pipe and condense, and as the source of marker sequences for synthetic reads [default: the 4.11.22seqs test metapackage]')
+    parent_parser.add_argument('--search-method', choices=sorted(SEARCH_METHOD_TO_INDEX_FORMAT.keys()), default='naive',
+        help='Search method for query, which also determines the index built by makedb [default: naive]')
+    parent_parser.add_argument('--threads', type=int, default=1, help='Number of threads [default: 1]')
+    parent_parser.add_argument('--seed', type=int, default=42, help='Random seed for synthetic data [default: 42]')
+    parent_parser.add_argument('--working-directory',
+        help='Generate synthetic data in this directory, and keep it [default: a temporary directory, which is removed]')
+    args = parent_parser.parse_args()
+
+    # Setup logging
+    if args.debug:
+        loglevel = logging.DEBUG
+    elif args.quiet:
+        loglevel = logging.ERROR
+    else:
+        loglevel = logging.INFO
+    logging.basicConfig(level=loglevel, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if args.working_directory:
+        os.makedirs(args.working_directory, exist_ok=True)
+        working_directory = args.working_directory
+        tmp = None
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix='singlem_benchmark')
+        working_directory = tmp.name
+
+    options = {
+        'metapackage': args.metapackage,
+        'search_method': args.search_method,
+        'threads': args.threads,
+        # Quieten the benchmarked code unless debugging
+        'loglevel': logging.DEBUG if args.debug else logging.ERROR,
+    }
+
+    print("\t".join(['benchmark','scale','unit','wall_seconds','peak_rss_mb','peak_external_rss_mb','throughput_per_second','error']))
+    for benchmark in args.benchmarks:
+        for scale in args.scales:
+            logging.info("Generating synthetic input for {} at scale {} ..".format(benchmark, scale))
+            try:
+                inputs = prepare_inputs(benchmark, scale, working_directory, args.metapackage, args.search_method, args.seed)
+            except Exception as e:
+                # e.g. the index library needed to build the query database
+                # is not installed. Report it like a failed benchmark.
+                inputs = None
+                (seconds, peak_rss, peak_child_rss, error) = (None, None, None, repr(e))
+            if inputs is not None:
+                logging.info("Running {} benchmark at scale {} ..".format(benchmark, scale))
+                (seconds, peak_rss, peak_child_rss, error) = run_benchmark(benchmark, inputs, options)
+            if error is not None:
+                logging.error("Benchmark {} at scale {} failed: {}".format(benchmark, scale, error))
+                print("\t".join([benchmark, str(scale), BENCHMARK_UNITS[benchmark], '', '', '', '', error]))
+            else:
+                print("\t".join([
+                    benchmark,
+                    str(scale),
+                    BENCHMARK_UNITS[benchmark],
+                    '%.3f' % seconds,
+                    '%.1f' % (peak_rss / 1024),
+                    '%.1f' % (peak_child_rss / 1024),
+                    '%.1f' % (scale / seconds),
+                    '']))
+            sys.stdout.flush()
+
+    if tmp is not None:
+        tmp.cleanup()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+###############################################################################
+#
+#    Copyright (C) 2022 Ben Woodcroft
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+__author__ = "Ben Woodcroft"
+__copyright__ = "Copyright 2022"
+__credits__ = ["Ben Woodcroft"]
+__license__ = "GPL3"
+__maintainer__ = "Ben Woodcroft"
+__email__ = "benjwoodcroft near gmail.com"
+__status__ = "Development"
+
+import argparse
+import logging
+import sys
+import os
+import subprocess
+import time
+import statistics
+
+path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
+
+# Commands which should not need to import the heavy parts of singlem
+DEFAULT_COMMANDS = [
+    ['--version'],
+    ['pipe', '-h'],
+    ['summarise', '-h'],
+    ['condense', '-h'],
+    ['data', '-h'],
+]
+
+def time_command(command, num_repeats):
+    timings = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, path_to_script] + command,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def slowest_imports(command, num_imports):
+    '''Return a list of (cumulative microseconds, module) of the slowest top
+    level imports when running the command, according to python -X
+    importtime.'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', path_to_script] + command,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        splits = line.split('|')
+        module = splits[2]
+        if module.startswith('  '):
+            # Only report modules imported directly, not their dependencies
+            continue
+        imports.append((int(splits[1]), module.strip()))
+    return sorted(imports, reverse=True)[:num_imports]
+
+if __name__ == '__main__':
+    parent_parser = argparse.ArgumentParser(description='Benchmark how long bin/singlem takes to start up')
+    parent_parser.add_argument('--debug', help='output debug information', action="store_true")
+    parent_parser.add_argument('--quiet', help='only output errors', action="store_true")
+    parent_parser.add_argument('--repeats', type=int, default=5, help='Number of times to run each command [default: 5]')
+    parent_parser.add_argument('--show-imports', type=int, default=0, metavar='NUM',
+        help='Also show the NUM slowest top level imports of each command [default: 0]')
+    parent_parser.add_argument('--command', nargs='+',
+        help='Arguments to bin/singlem to benchmark, instead of the default set of commands')
+    args = parent_parser.parse_args()
+
+    # Setup logging
+    if args.debug:
+        loglevel = logging.DEBUG
+    elif args.quiet:
+        loglevel = logging.ERROR
+    else:
+        loglevel = logging.INFO
+    logging.basicConfig(level=loglevel, format='%(asctime)s %(levelname)s: %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    commands = [args.command] if args.command else DEFAULT_COMMANDS
+
+    print("\t".join(['command','min_seconds','median_seconds']))
+    for command in commands:
+        logging.debug("Benchmarking {}".format(' '.join(command)))
+        timings = time_command(command, args.repeats)
+        print("\t".join([' '.join(command), '%.3f' % min(timings), '%.3f' % statistics.median(timings)]))
+        if args.show_imports > 0:
+            for (microseconds, module) in slowest_imports(command, args.show_imports):
+                print("\t".join(['  import {}'.format(module), '%.3f' % (microseconds / 1e6), '']))
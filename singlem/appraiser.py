@@ -1,14 +1,10 @@
 import logging
-import os
 import sys
-import tempfile
 import numpy
 
 from .otu_table import OtuTable
-from .otu_table_collection import OtuTableCollection
 from .appraisal_result import Appraisal, AppraisalResult
-from .querier import Querier
-from .sequence_database import SequenceDatabase
+from .hamming import hamming_distances
 from .condense import _tmean
 
 class Appraiser:
@@ -71,6 +67,13 @@ class Appraiser:
                 window_size)
             sample_to_building_block = sample_to_assembled
 
+        sample_to_metagenome_otus = {}
+        for otu in metagenome_otu_table_collection:
+            try:
+                sample_to_metagenome_otus[otu.sample_name].append(otu)
+            except KeyError:
+                sample_to_metagenome_otus[otu.sample_name] = [otu]
+
         app = Appraisal()
         app.appraisal_results = []
         for sample in list(sample_to_building_block.keys()):
@@ -90,8 +93,8 @@ class Appraiser:
                 for otu in res.assembled_otus:
                     seen_otu_sequences.add(otu.sequence)
             not_seen_otus = []
-            for otu in metagenome_otu_table_collection:
-                if otu.sample_name == sample and otu.sequence not in seen_otu_sequences:
+            for otu in sample_to_metagenome_otus.get(sample, []):
+                if otu.sequence not in seen_otu_sequences:
                     if output_found_in:
                         otu.add_found_data('')
                     not_seen_otus.append(otu)
@@ -120,47 +123,36 @@ class Appraiser:
         else:
             max_divergence = 0
 
-        tmp = tempfile.TemporaryDirectory()
-        sdb_path = os.path.join(tmp.name, "tmp.sdb")
-        sequence_database = SequenceDatabase()
-        sequence_database.create_from_otu_table(sdb_path, found_otu_collection, sequence_database_methods = ['naive'])
-        sdb_tmp = sequence_database.acquire(sdb_path)
+        found_otu_index = FoundOtuIndex(found_otu_collection)
 
-        found_genes = [table.marker for table in found_otu_collection]
-        metagenome_table = OtuTable()
+        marker_to_metagenome_otus = {}
         for otu in metagenome_otu_table_collection:
-            if otu.marker in found_genes:
-                metagenome_table.add([otu])
-
-        metagenome_collection = OtuTableCollection()
-        metagenome_collection.add_otu_table_object(metagenome_table)
-        metagenome_collection.sort_otu_tables_by_marker()
-
-        querier = Querier()
-        queries = querier.query_with_queries(metagenome_collection, sdb_tmp, max_divergence, 'naive', SequenceDatabase.NUCLEOTIDE_TYPE, 1, None, True, None)
+            if found_otu_index.has_marker(otu.marker):
+                try:
+                    marker_to_metagenome_otus[otu.marker].append(otu)
+                except KeyError:
+                    marker_to_metagenome_otus[otu.marker] = [otu]
 
         sample_to_building_block = {}
-        for hit in queries:
-            # hit has (query, subject, divergence)
-            # subject has .taxonomy
-            q = hit.query
-            if q.sample_name in sample_to_building_block:
-                appraisal = sample_to_building_block[q.sample_name]
-            else:
-                appraisal = AppraisalBuildingBlock(packages)
-                sample_to_building_block[q.sample_name] = appraisal
+        for marker in sorted(marker_to_metagenome_otus.keys()):
+            for (q, found_otus) in found_otu_index.each_match(
+                    marker, marker_to_metagenome_otus[marker], max_divergence):
+                if q.sample_name in sample_to_building_block:
+                    appraisal = sample_to_building_block[q.sample_name]
+                else:
+                    appraisal = AppraisalBuildingBlock(packages)
+                    sample_to_building_block[q.sample_name] = appraisal
 
-            if output_found_in:
-                q.add_found_data(hit.subject.sample_name)
+                if output_found_in:
+                    for found_otu in found_otus:
+                        q.add_found_data(found_otu.sample_name)
 
-            if q not in appraisal.found_otus:
                 appraisal.add_otu(q)
 
         for otu in metagenome_otu_table_collection:
             if otu.sample_name not in sample_to_building_block:
                 sample_to_building_block[otu.sample_name] = AppraisalBuildingBlock(packages)
 
-        tmp.cleanup()
         return sample_to_building_block
 
 
@@ -360,3 +352,51 @@ class AppraisalBuildingBlock:
         for domain in self.DOMAINS:
             out[domain] = round(_tmean([n[domain] for n in self.num_found.values() if domain in n], 0.1))
         return out
+
+
+class FoundOtuIndex:
+    '''Index of the OTUs found in genomes or assemblies, keyed by marker and
+    then sequence. It is built once and then used to match the OTUs of all
+    metagenome samples.'''
+
+    # Number of metagenome OTUs to compare to the found sequences at once when
+    # matching inexactly
+    CHUNK_SIZE = 1000
+
+    def __init__(self, found_otus):
+        self._marker_to_sequence_to_otus = {}
+        for otu in found_otus:
+            try:
+                sequence_to_otus = self._marker_to_sequence_to_otus[otu.marker]
+            except KeyError:
+                sequence_to_otus = {}
+                self._marker_to_sequence_to_otus[otu.marker] = sequence_to_otus
+            try:
+                sequence_to_otus[otu.sequence].append(otu)
+            except KeyError:
+                sequence_to_otus[otu.sequence] = [otu]
+
+    def has_marker(self, marker):
+        return marker in self._marker_to_sequence_to_otus
+
+    def each_match(self, marker, otus, max_divergence):
+        '''For each of the given OTUs of the marker which match a found OTU,
+        yield (otu, found_otus), where found_otus are the found OTUs with the
+        nearest sequence to that of the OTU. A match is one with at most
+        max_divergence differences.'''
+        sequence_to_otus = self._marker_to_sequence_to_otus.get(marker, {})
+        if max_divergence == 0:
+            for otu in otus:
+                if otu.sequence in sequence_to_otus:
+                    yield otu, sequence_to_otus[otu.sequence]
+        else:
+            found_sequences = list(sequence_to_otus.keys())
+            if len(found_sequences) == 0:
+                return
+            for i in range(0, len(otus), self.CHUNK_SIZE):
+                chunk = otus[i:(i+self.CHUNK_SIZE)]
+                distances = hamming_distances([otu.sequence for otu in chunk], found_sequences)
+                nearest = numpy.argmin(distances, axis=1)
+                for (otu, nearest_index, otu_distances) in zip(chunk, nearest, distances):
+                    if otu_distances[nearest_index] <= max_divergence:
+                        yield otu, sequence_to_otus[found_sequences[nearest_index]]
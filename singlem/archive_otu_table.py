@@ -1,4 +1,5 @@
 import json
+import codecs
 
 from .otu_table_entry import OtuTableEntry
 
@@ -53,35 +54,173 @@ class ArchiveOtuTable:
     def read(input_io, min_version=None):
         otus = ArchiveOtuTable()
         j = json.load(input_io)
-        if not j['version'] in [1,2,3,4]:
-            raise Exception("Wrong OTU table version detected")
         otus.version = j['version']
-        if min_version is not None and otus.version < min_version:
-            raise InsufficientArchiveOtuTableVersionException(
-                "OTU table version is too old, required: %d, found: %d" % (min_version, otus.version))
+        otus.fields = j['fields']
+        otus._check_header(min_version)
 
         otus.alignment_hmm_sha256s = j['alignment_hmm_sha256s']
         otus.singlem_package_sha256s = j['singlem_package_sha256s']
 
-        otus.fields = j['fields']
-        if otus.fields != ArchiveOtuTable.FIELDS_OF_EACH_VERSION[j['version']-1]:
-            raise Exception("Unexpected archive OTU table format detected")
-
         otus.data = j['otus']
         return otus
 
+    @staticmethod
+    def read_streaming(input_io, min_version=None):
+        '''Like read(), but the OTUs are parsed incrementally as they are
+        iterated over, rather than the whole JSON document being loaded into
+        RAM. The returned StreamingArchiveOtuTable can only be iterated over
+        once.'''
+        return StreamingArchiveOtuTable(input_io, min_version=min_version)
+
+    def _check_header(self, min_version):
+        if not self.version in [1,2,3,4]:
+            raise Exception("Wrong OTU table version detected")
+        if min_version is not None and self.version < min_version:
+            raise InsufficientArchiveOtuTableVersionException(
+                "OTU table version is too old, required: %d, found: %d" % (min_version, self.version))
+        if self.fields != ArchiveOtuTable.FIELDS_OF_EACH_VERSION[self.version-1]:
+            raise Exception("Unexpected archive OTU table format detected")
+
+    @staticmethod
+    def _entry_from_data(d, fields):
+        e = ArchiveOtuTableEntry()
+        e.marker = d[0]
+        e.sample_name = d[1]
+        e.sequence = d[2]
+        e.count = d[3]
+        e.coverage = d[4]
+        e.taxonomy = d[5]
+        e.data = d
+        e.fields = fields
+        return e
+
     def __iter__(self):
         for d in self.data:
-            e = ArchiveOtuTableEntry()
-            e.marker = d[0]
-            e.sample_name = d[1]
-            e.sequence = d[2]
-            e.count = d[3]
-            e.coverage = d[4]
-            e.taxonomy = d[5]
-            e.data = d
-            e.fields = self.fields
-            yield e
+            yield self._entry_from_data(d, self.fields)
+
+
+class StreamingArchiveOtuTable(ArchiveOtuTable):
+    '''An archive OTU table where the OTUs are read from the underlying IO
+    one at a time during iteration. The header (version, fields etc.) is read
+    upon construction. Archive OTU tables written by singlem have the OTUs as
+    the last entry, so only one OTU at a time is held in memory. If the OTUs
+    are encountered before the rest of the header, they are instead read in
+    all at once.'''
+
+    _CHUNK_SIZE = 1024*1024
+
+    def __init__(self, input_io, min_version=None):
+        super().__init__()
+        self._io = input_io
+        self._decoder = json.JSONDecoder()
+        self._incremental_decoder = None
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._iterated = False
+
+        self.version = None
+        self.fields = None
+        self.data = None
+
+        self._skip_token('{')
+        found_otus = False
+        while True:
+            key = self._decode_value()
+            self._skip_token(':')
+            if key == 'otus':
+                if self.version is not None and self.fields is not None:
+                    found_otus = True
+                    break
+                # Header is not yet complete, so OTUs cannot be checked as
+                # they stream. Fall back to reading them in.
+                self.data = self._decode_value()
+            else:
+                value = self._decode_value()
+                if key == 'version':
+                    self.version = value
+                elif key == 'fields':
+                    self.fields = value
+                elif key == 'alignment_hmm_sha256s':
+                    self.alignment_hmm_sha256s = value
+                elif key == 'singlem_package_sha256s':
+                    self.singlem_package_sha256s = value
+            if self._next_token() == '}':
+                break
+            self._skip_token(',')
+        self._check_header(min_version)
+        if found_otus:
+            self._skip_token('[')
+        elif self.data is None:
+            raise Exception("Unexpected archive OTU table format detected")
+
+    def __iter__(self):
+        if self._iterated:
+            raise Exception("Streaming archive OTU tables can only be iterated over once")
+        self._iterated = True
+
+        if self.data is not None:
+            for d in self.data:
+                yield self._entry_from_data(d, self.fields)
+            return
+
+        if self._next_token() == ']':
+            self._skip_token(']')
+            return
+        while True:
+            yield self._entry_from_data(self._decode_value(), self.fields)
+            if self._next_token() == ']':
+                self._skip_token(']')
+                return
+            self._skip_token(',')
+
+    def _fill_buffer(self):
+        '''Read another chunk from the IO, returning False at EOF.'''
+        if self._eof:
+            return False
+        chunk = self._io.read(self._CHUNK_SIZE)
+        if isinstance(chunk, bytes):
+            if self._incremental_decoder is None:
+                self._incremental_decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = self._incremental_decoder.decode(chunk, final=len(chunk) == 0)
+        if len(chunk) == 0:
+            self._eof = True
+            return False
+        # Drop the already consumed part of the buffer
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _next_token(self):
+        '''Return the next non-whitespace character without consuming it.'''
+        while True:
+            self._position = json.decoder.WHITESPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill_buffer():
+                raise json.decoder.JSONDecodeError(
+                    "Unexpected end of archive OTU table", self._buffer, self._position)
+
+    def _skip_token(self, token):
+        found = self._next_token()
+        if found != token:
+            raise json.decoder.JSONDecodeError(
+                "Expected '{}' but found '{}'".format(token, found), self._buffer, self._position)
+        self._position += 1
+
+    def _decode_value(self):
+        self._next_token()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+                # A number at the very end of the buffer may be truncated
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return value
+            except json.decoder.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill_buffer()
 
 
 class ArchiveOtuTableEntry(OtuTableEntry):
@@ -5,7 +5,7 @@ import json
 import extern
 
 from singlem.sequence_classes import SeqReader, Sequence
-from .metagenome_otu_finder import MetagenomeOtuFinder
+from .window_cache import WindowCache
 from .singlem_package import SingleMPackage
 from .pipe_sequence_extractor import _align_proteins_to_hmm
 from graftm.graftm_package import GraftMPackage
@@ -119,16 +119,15 @@ class Chainsaw:
         stretch_length = input_spkg.window_size() / 3
         trimmed_output = []
         
-        ignored_columns = MetagenomeOtuFinder()._find_lower_case_columns(tmp_alignment)
-        logging.debug("Ignoring columns %s", str(ignored_columns))
-        # Find start of window in aligned sequence
-        start_position = MetagenomeOtuFinder()._upper_case_position_to_alignment_position(
-            best_position, ignored_columns)
-        logging.debug("Using pre-defined best section of the alignment starting from %i" % (start_position + 1))
-        # Find all positions in the window
-        chosen_positions = MetagenomeOtuFinder()._best_position_to_chosen_positions(
-            start_position, stretch_length, ignored_columns)
-        logging.debug("Found chosen positions %s", chosen_positions)
+        # The alignment is of the package's own sequences (prefixes aside), so
+        # its columns can be cached in the package, keyed on the sequences
+        # and HMM it is made from.
+        checksum = WindowCache.checksum(
+            [input_spkg.graftm_package().unaligned_sequence_database_path(),
+             input_spkg.graftm_package().alignment_hmm_path()],
+            'window_columns', best_position, stretch_length)
+        _, chosen_positions = WindowCache(input_spkg.window_cache_path()).window_columns(
+            checksum, tmp_alignment, best_position, stretch_length)
         
         for aligned_sequence in tmp_alignment:
             windowed_residues = aligned_sequence.seq[min(chosen_positions):1+max(chosen_positions)].replace('-','')
@@ -0,0 +1,257 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+from .archive_otu_table import ArchiveOtuTable, ArchiveOtuTableEntry
+from .otu_table import OtuTable
+from .otu_table_entry import OtuTableEntry
+
+
+class ColumnarOtuTable:
+    '''A binary OTU table stored column-wise, so that it can be memory-mapped
+    and filtered by marker or sample without parsing every OTU.
+
+    The file is laid out as the MAGIC bytes, the length of a JSON header, the
+    JSON header itself and then each column, each starting on an 8 byte
+    boundary. The gene, sample and taxonomy columns are dictionary-encoded as
+    uint32 codes into lists of distinct values kept in the header. Sequences
+    are stored as one byte string with an array of offsets into it. Any fields
+    beyond the standard 6 (e.g. those of archive OTU tables) are stored per
+    OTU as JSON in the same way, and are only decoded for the OTUs that are
+    iterated over.'''
+
+    version = 1
+    MAGIC = b'SINGLEMC'
+
+    _PREAMBLE = struct.Struct('<8sQ')
+    _STANDARD_FIELDS = OtuTable.DEFAULT_OUTPUT_FIELDS
+    _COLUMN_DTYPES = {
+        'gene': '<u4',
+        'sample': '<u4',
+        'taxonomy': '<u4',
+        'num_hits': '<i8',
+        'coverage': '<f8',
+        'sequence_offsets': '<i8',
+        'sequence': 'u1',
+        'extras_offsets': '<i8',
+        'extras': 'u1',
+    }
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, header_length = self._PREAMBLE.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC:
+            raise Exception("File {} does not appear to be a columnar OTU table".format(path))
+        header = json.loads(self._mmap[self._PREAMBLE.size:self._PREAMBLE.size + header_length].decode())
+        if header['version'] != self.version:
+            raise Exception("Unexpected columnar OTU table version {} detected in {}".format(
+                header['version'], path))
+
+        self.fields = header['fields']
+        self.alignment_hmm_sha256s = header['alignment_hmm_sha256s']
+        self.singlem_package_sha256s = header['singlem_package_sha256s']
+        self._num_otus = header['num_otus']
+        self._genes = header['genes']
+        self._samples = header['samples']
+        self._taxonomies = header['taxonomies']
+
+        data_start = self._data_start(header_length)
+        self._columns = {}
+        for name, (offset, count) in header['columns'].items():
+            self._columns[name] = np.frombuffer(
+                self._mmap, dtype=self._COLUMN_DTYPES[name], count=count, offset=data_start + offset)
+
+        if self.fields in ArchiveOtuTable.FIELDS_OF_EACH_VERSION:
+            self._entry_class = ArchiveOtuTableEntry
+        else:
+            self._entry_class = OtuTableEntry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # numpy arrays hold references to the mmap, so remove them first
+        self._columns = {}
+        self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._num_otus
+
+    def genes(self):
+        '''Return a list of the distinct marker genes in the table'''
+        return list(self._genes)
+
+    def samples(self):
+        '''Return a list of the distinct sample names in the table'''
+        return list(self._samples)
+
+    def __iter__(self):
+        return self.each()
+
+    def each(self, markers=None, samples=None):
+        '''Yield an OtuTableEntry (or ArchiveOtuTableEntry) for each OTU in the
+        table, in the order they were written.
+
+        Parameters
+        ----------
+        markers: list of str
+            if not None, only yield OTUs from these marker genes
+        samples: list of str
+            if not None, only yield OTUs from these samples
+        '''
+        if markers is None and samples is None:
+            indices = range(self._num_otus)
+        else:
+            mask = np.ones(self._num_otus, dtype=bool)
+            if markers is not None:
+                mask &= self._code_mask('gene', self._genes, markers)
+            if samples is not None:
+                mask &= self._code_mask('sample', self._samples, samples)
+            indices = np.flatnonzero(mask)
+
+        genes = self._columns['gene']
+        sample_codes = self._columns['sample']
+        taxonomies = self._columns['taxonomy']
+        num_hits = self._columns['num_hits']
+        coverages = self._columns['coverage']
+        sequence_offsets = self._columns['sequence_offsets']
+        sequences = self._columns['sequence']
+        extras_offsets = self._columns.get('extras_offsets')
+        extras = self._columns.get('extras')
+        for i in indices:
+            e = self._entry_class()
+            e.marker = self._genes[genes[i]]
+            e.sample_name = self._samples[sample_codes[i]]
+            e.sequence = sequences[sequence_offsets[i]:sequence_offsets[i+1]].tobytes().decode()
+            e.count = int(num_hits[i])
+            e.coverage = float(coverages[i])
+            e.taxonomy = self._taxonomies[taxonomies[i]]
+            e.data = [e.marker, e.sample_name, e.sequence, e.count, e.coverage, e.taxonomy]
+            if extras is not None:
+                e.data += json.loads(extras[extras_offsets[i]:extras_offsets[i+1]].tobytes())
+            e.fields = self.fields
+            yield e
+
+    def _code_mask(self, column, dictionary, values):
+        value_set = set(values)
+        codes = [i for i, value in enumerate(dictionary) if value in value_set]
+        return np.isin(self._columns[column], codes)
+
+    @staticmethod
+    def _data_start(header_length):
+        return ColumnarOtuTable._padded(ColumnarOtuTable._PREAMBLE.size + header_length)
+
+    @staticmethod
+    def _padded(length):
+        return (length + 7) // 8 * 8
+
+    @staticmethod
+    def _itemsize(column):
+        return column.itemsize if isinstance(column, array) else 1
+
+    @staticmethod
+    def write(otus, output_path, fields=None, alignment_hmm_sha256s=None, singlem_package_sha256s=None):
+        '''Write OTUs to a new columnar OTU table file.
+
+        Parameters
+        ----------
+        otus: iterable of OtuTableEntry
+            e.g. an OtuTable, ArchiveOtuTable or OtuTableCollection. Iterated
+            over only once, so may be streaming.
+        output_path: str
+            path to write to
+        fields: list of str
+            fields of the OTUs to store. None indicates the fields of the first
+            OTU.
+        alignment_hmm_sha256s, singlem_package_sha256s: list of str
+            stored in the header, for when the OTUs come from an archive OTU
+            table.
+        '''
+        code_dictionaries = {'gene': {}, 'sample': {}, 'taxonomy': {}}
+        columns = {
+            'gene': array('I'),
+            'sample': array('I'),
+            'taxonomy': array('I'),
+            'num_hits': array('q'),
+            'coverage': array('d'),
+            'sequence_offsets': array('q', [0]),
+            'sequence': bytearray(),
+        }
+        extra_fields = None
+        last_otu_fields = None
+        for otu in otus:
+            if extra_fields is None:
+                if fields is None:
+                    fields = list(otu.fields)
+                if fields[:len(ColumnarOtuTable._STANDARD_FIELDS)] != ColumnarOtuTable._STANDARD_FIELDS:
+                    raise Exception("Columnar OTU tables must start with the fields {}".format(
+                        ColumnarOtuTable._STANDARD_FIELDS))
+                extra_fields = fields[len(ColumnarOtuTable._STANDARD_FIELDS):]
+                if len(extra_fields) > 0:
+                    columns['extras_offsets'] = array('q', [0])
+                    columns['extras'] = bytearray()
+            if otu.fields is not last_otu_fields:
+                # OTUs from the same table share their fields, so only look
+                # up the extra fields when the table changes.
+                last_otu_fields = otu.fields
+                extra_field_indices = [otu.fields.index(f) if f in otu.fields else None for f in extra_fields]
+
+            for column, value in (('gene', otu.marker), ('sample', otu.sample_name), ('taxonomy', otu.taxonomy)):
+                dictionary = code_dictionaries[column]
+                code = dictionary.get(value)
+                if code is None:
+                    code = len(dictionary)
+                    dictionary[value] = code
+                columns[column].append(code)
+            columns['num_hits'].append(otu.count)
+            columns['coverage'].append(otu.coverage)
+            columns['sequence'] += otu.sequence.encode()
+            columns['sequence_offsets'].append(len(columns['sequence']))
+            if len(extra_fields) > 0:
+                columns['extras'] += json.dumps(
+                    [otu.data[i] if i is not None and i < len(otu.data) else '' for i in extra_field_indices]).encode()
+                columns['extras_offsets'].append(len(columns['extras']))
+
+        if fields is None:
+            fields = list(ColumnarOtuTable._STANDARD_FIELDS)
+
+        if sys.byteorder != 'little':
+            for column in columns.values():
+                if isinstance(column, array):
+                    column.byteswap()
+
+        column_positions = {}
+        offset = 0
+        for name, column in columns.items():
+            column_positions[name] = (offset, len(column))
+            offset = ColumnarOtuTable._padded(offset + len(column) * ColumnarOtuTable._itemsize(column))
+        header = json.dumps({
+            'version': ColumnarOtuTable.version,
+            'fields': fields,
+            'alignment_hmm_sha256s': alignment_hmm_sha256s,
+            'singlem_package_sha256s': singlem_package_sha256s,
+            'num_otus': len(columns['num_hits']),
+            'genes': list(code_dictionaries['gene'].keys()),
+            'samples': list(code_dictionaries['sample'].keys()),
+            'taxonomies': list(code_dictionaries['taxonomy'].keys()),
+            'columns': column_positions,
+        }).encode()
+
+        with open(output_path, 'wb') as f:
+            f.write(ColumnarOtuTable._PREAMBLE.pack(ColumnarOtuTable.MAGIC, len(header)))
+            f.write(header)
+            f.write(b'\0' * (ColumnarOtuTable._data_start(len(header)) - ColumnarOtuTable._PREAMBLE.size - len(header)))
+            for column in columns.values():
+                length = len(column) * ColumnarOtuTable._itemsize(column)
+                f.write(column)
+                f.write(b'\0' * (ColumnarOtuTable._padded(length) - length))
@@ -7,6 +7,7 @@ import sys
 
 from queue import Queue
 
+from . import defaults
 from .archive_otu_table import ArchiveOtuTable, ArchiveOtuTableEntry
 from .singlem_package import SingleMPackage
 from .metapackage import Metapackage
@@ -28,8 +29,8 @@ while True:
 class Condenser:
     """ Combines otu table output for each marker into a single otu table"""
 
-    DEFAULT_TRIM_PERCENT = 10
-    DEFAULT_MIN_TAXON_COVERAGE = 0.35
+    DEFAULT_TRIM_PERCENT = defaults.DEFAULT_TRIM_PERCENT
+    DEFAULT_MIN_TAXON_COVERAGE = defaults.DEFAULT_MIN_TAXON_COVERAGE
 
     def condense(self, **kwargs):
         output_otu_table = kwargs.pop('output_otu_table')
@@ -423,70 +424,28 @@ class Condenser:
             return best_hit_genera
 
         # Set up initial conditions. The coverage of each genus is set to 1
-        genus_to_coverage = {}
         best_hit_taxonomy_sets = set()
         some_em_to_do = False
+        otu_genera = []
         for otu in sample_otus:
             best_hit_genera = best_hit_genera_from_otu(otu)
             if otu.taxonomy_assignment_method() == DIAMOND_ASSIGNMENT_METHOD:
                 some_em_to_do = True
             best_hit_taxonomy_sets.add(self._species_list_to_key(best_hit_genera))
-            for genus in best_hit_genera:
-                if genus not in genus_to_coverage:
-                    genus_to_coverage[genus] = 1
+            otu_genera.append(best_hit_genera)
         if some_em_to_do is False:
             return None
         logging.debug(best_hit_taxonomy_sets)
-        num_steps = 0
 
         # The fraction of each undecided OTU is the ratio of that class's
         # coverage (coverage in the current iteration) to the total coverage of
         # all best hits of the undecided OTU
-        while True: # while not converged
-            next_genus_to_gene_to_coverage = {}
-            num_steps += 1
-            # logging.debug("Starting iteration with species abundances: {}".format(species_to_coverage))
-
-            # Partition out the undecided coverage according to the current
-            # iteration's ratios
-            for otu in sample_otus:
-                unnormalised_coverages = {}
-                best_hit_genera = best_hit_genera_from_otu(otu)
-
-                for best_hit_genus in best_hit_genera:
-                    if best_hit_genus in genus_to_coverage: # Can get removed during trimmed mean
-                        unnormalised_coverages[best_hit_genus] = genus_to_coverage[best_hit_genus]
-                total_coverage = sum(unnormalised_coverages.values())
-                # if total_coverage == 0:
-                #     # This OTU has been removed by the previous iteration through trimmed mean
-                #     continue
-
-                for tax, unnormalised_coverage in unnormalised_coverages.items():
-                    # Record the total for each gene so a trimmed mean can be taken afterwards
-                    if tax not in next_genus_to_gene_to_coverage:
-                        next_genus_to_gene_to_coverage[tax] = {}
-                    if otu.marker not in next_genus_to_gene_to_coverage[tax]:
-                        next_genus_to_gene_to_coverage[tax][otu.marker] = 0
-                    next_genus_to_gene_to_coverage[tax][otu.marker] = next_genus_to_gene_to_coverage[tax][otu.marker] + unnormalised_coverage / total_coverage * otu.coverage
-                    
-            # Calculate the trimmed mean for each genus
-            next_genus_to_coverage = {}
-            for tax, gene_to_coverage in next_genus_to_gene_to_coverage.items():
-                num_markers = len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')])
-                logging.debug("Using {} markers for OTU taxonomy {}, with coverages {}".format(num_markers, tax, gene_to_coverage.values()))
-                trimmed_mean = self.calculate_abundance(list(gene_to_coverage.values()), num_markers, trim_percent)
-                next_genus_to_coverage[tax] = trimmed_mean
-
-            # Has any species changed in abundance by a large enough amount? If not, we're done
-            need_another_iteration = False
-            for tax, next_coverage in next_genus_to_coverage.items():
-                if abs(next_coverage - genus_to_coverage[tax]) > 0.001:
-                    logging.debug("Taxonomy {} changed from {} to {}".format(tax, next_coverage, genus_to_coverage[tax]))
-                    need_another_iteration = True
-                    break
-            genus_to_coverage = next_genus_to_coverage
-            if not need_another_iteration:
-                break
+        engine = _ExpectationMaximizationEngine(
+            otu_genera,
+            [otu.marker for otu in sample_otus],
+            [otu.coverage for otu in sample_otus],
+            genes_per_domain)
+        genus_to_coverage, num_steps = engine.run(trim_percent, self.calculate_abundance)
         
         # Round each genome to 4 decimal places in coverage, removing entries with 0 coverage
         # Use 3 decimals to avoid rounding to 0 when one OTU is split between many species
@@ -536,24 +495,21 @@ class Condenser:
 
     def _apply_species_expectation_maximization_core(self, sample_otus, trim_percent, genes_per_domain, min_genes_for_whitelist=10, proximity_cutoff=0.1):
         # Set up initial conditions. The coverage of each species is set to 1
-        species_to_coverage = {}
         best_hit_taxonomy_sets = set()
         some_em_to_do = False
         species_genes = {}
+        em_otus = []
         for otu in sample_otus:
             best_hit_taxonomies = otu.equal_best_hit_taxonomies()
             if otu.taxonomy_assignment_method() == QUERY_BASED_ASSIGNMENT_METHOD and best_hit_taxonomies is not None:
                 some_em_to_do = True
+                em_otus.append(otu)
                 best_hit_taxonomy_sets.add(self._species_list_to_key(best_hit_taxonomies))
-                for best_hit_tax in best_hit_taxonomies:
-                    if best_hit_tax not in species_to_coverage:
-                        species_to_coverage[best_hit_tax] = 1
                 if len(best_hit_taxonomies) == 1:
                     sp = best_hit_taxonomies[0]
                     if sp not in species_genes:
                         species_genes[sp] = set()
                     species_genes[sp].add(otu.marker)
-                species_genes
         if some_em_to_do is False:
             return None
         logging.debug(best_hit_taxonomy_sets)
@@ -562,65 +518,19 @@ class Condenser:
         logging.info("Found {} species uniquely hitting >= {} marker genes".format(len(species_whitelist), min_genes_for_whitelist))
         logging.debug("Species whitelist: {}".format(species_whitelist))
 
-        num_steps = 0
         # The fraction of each undecided OTU is the ratio of that class's
         # coverage (coverage in the current iteration) to the total coverage of
-        # all best hits of the undecided OTU
-        while True: # while not converged
-            next_species_to_gene_to_coverage = {}
-            num_steps += 1
-            # logging.debug("Starting iteration with species abundances: {}".format(species_to_coverage))
-            for otu in sample_otus:
-                unnormalised_coverages = {}
-                best_hit_taxonomies = otu.equal_best_hit_taxonomies()
-                if otu.taxonomy_assignment_method() == QUERY_BASED_ASSIGNMENT_METHOD and best_hit_taxonomies is not None:
-                    for best_hit_tax in best_hit_taxonomies:
-                        if best_hit_tax in species_to_coverage: # Can get removed during trimmed mean
-                            unnormalised_coverages[best_hit_tax] = species_to_coverage[best_hit_tax]
-                total_coverage = sum(unnormalised_coverages.values())
-                if total_coverage == 0:
-                    # This OTU has been removed by the previous iteration through trimmed mean
-                    continue
-
-                for tax, unnormalised_coverage in unnormalised_coverages.items():
-                    # Record the total for each gene so a trimmed mean can be taken afterwards
-                    if tax not in next_species_to_gene_to_coverage:
-                        next_species_to_gene_to_coverage[tax] = {}
-                    if otu.marker not in next_species_to_gene_to_coverage[tax]:
-                        next_species_to_gene_to_coverage[tax][otu.marker] = 0
-                    next_species_to_gene_to_coverage[tax][otu.marker] = next_species_to_gene_to_coverage[tax][otu.marker] + unnormalised_coverage / total_coverage * otu.coverage
-                    
-            # Calculate the (possibly trimmed) mean for each species
-            next_species_to_coverage = {}
-            for tax, gene_to_coverage in next_species_to_gene_to_coverage.items():
-                num_markers = len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')])
-                # logging.debug("Using {} markers for OTU taxonomy {}, with coverages {}".format(num_markers, tax, gene_to_coverage.values()))
-                trimmed_mean = self.calculate_abundance(list(gene_to_coverage.values()), num_markers, trim_percent)
-                next_species_to_coverage[tax] = trimmed_mean
-
-            # Remove species that appear to be noise based upon having low
-            # coverage and proximity to higher coverage species
-            failed_species = self._find_species_with_low_coverage_and_proximity_to_higher_coverage_species(
-                next_species_to_coverage, species_whitelist, proximity_cutoff)
-            for failed_s in failed_species:
-                logging.debug("Removing species {} due to low coverage and proximity to higher coverage species".format(failed_species))
-                del next_species_to_coverage[failed_s]
-
-            # Has any species changed in abundance by a large enough amount? If not, we're done
-            if len(failed_species) > 0:
-                # Always iterate again if we removed any species, because
-                # otherwise their coverage contributions will be lost.
-                need_another_iteration = True
-            else:
-                need_another_iteration = False
-                for tax, next_coverage in next_species_to_coverage.items():
-                    if abs(next_coverage - species_to_coverage[tax]) > 0.001:
-                        need_another_iteration = True
-                        break
-
-            species_to_coverage = next_species_to_coverage
-            if not need_another_iteration:
-                break
+        # all best hits of the undecided OTU. Species that appear to be noise
+        # based upon having low coverage and proximity to higher coverage
+        # species are removed each iteration.
+        engine = _ExpectationMaximizationEngine(
+            [otu.equal_best_hit_taxonomies() for otu in em_otus],
+            [otu.marker for otu in em_otus],
+            [otu.coverage for otu in em_otus],
+            genes_per_domain)
+        species_to_coverage, num_steps = engine.run(
+            trim_percent, self.calculate_abundance,
+            species_whitelist=species_whitelist, proximity_cutoff=proximity_cutoff)
         
         # Round each genome to 4 decimal places in coverage, removing entries with 0 coverage
         # Use 3 decimals to avoid rounding to 0 when one OTU is split between many species
@@ -635,26 +545,6 @@ class Condenser:
         return rounded_species_to_coverage, \
             list([self._key_to_species_list(k) for k in best_hit_taxonomy_sets])
 
-    def _find_species_with_low_coverage_and_proximity_to_higher_coverage_species(self,
-        species_to_coverage, species_whitelist, proximity_cutoff):
-        '''Return a list of species that is not in the species whitelist, and
-        is less than 10% of the total relative abundance of the genus
-        '''
-        genus_to_coverage = {}
-        for tax, coverage in species_to_coverage.items():
-            genus = tax.split(';')[6].strip()
-            if genus not in genus_to_coverage:
-                genus_to_coverage[genus] = 0
-            genus_to_coverage[genus] += coverage
-
-        failed_species = []
-        for tax, coverage in species_to_coverage.items():
-            genus = tax.split(';')[6].strip()
-            if tax not in species_whitelist and coverage < genus_to_coverage[genus] * proximity_cutoff:
-                failed_species.append(tax)
-        return failed_species
-
-
     def _demultiplex_otus(self, sample_otus, species_to_coverage, eq_classes,
     assignment_method):
         ''' Return a new OTU table where the OTUs have been demultiplexed. This
@@ -773,6 +663,147 @@ def _tmean(data, proportiontocut):
         a = sorted(data)
         return np.mean(a[cut:-cut])
 
+class _ExpectationMaximizationEngine:
+    """Runs the iterations of the Condenser's expectation maximization over
+    numpy arrays. The relationships between OTUs and their candidate taxa are
+    compiled once into flat arrays of (OTU, taxon) pairs, so that each
+    iteration is a few vectorised operations rather than loops over dicts of
+    taxa and OTUs. Sums are accumulated in the same order as a loop over the
+    OTUs would, so that the results are the same."""
+
+    def __init__(self, otu_taxa, otu_markers, otu_coverages, genes_per_domain):
+        """otu_taxa is a list with a list of candidate taxa for each OTU, and
+        otu_markers and otu_coverages are lists of the marker and coverage of
+        each OTU."""
+        taxon_to_index = {}
+        marker_to_index = {}
+        pair_otus = []
+        pair_taxa = []
+        otu_marker_indices = []
+        for (i, (taxa, marker)) in enumerate(zip(otu_taxa, otu_markers)):
+            if marker not in marker_to_index:
+                marker_to_index[marker] = len(marker_to_index)
+            otu_marker_indices.append(marker_to_index[marker])
+            seen = set()
+            for tax in taxa:
+                if tax in seen:
+                    continue
+                seen.add(tax)
+                if tax not in taxon_to_index:
+                    taxon_to_index[tax] = len(taxon_to_index)
+                pair_otus.append(i)
+                pair_taxa.append(taxon_to_index[tax])
+
+        self.taxa = list(taxon_to_index.keys())
+        self._num_otus = len(otu_markers)
+        self._num_taxa = len(self.taxa)
+        self._num_markers = len(marker_to_index)
+        self._pair_otus = np.array(pair_otus, dtype=np.int64)
+        self._pair_taxa = np.array(pair_taxa, dtype=np.int64)
+        otu_marker_indices = np.array(otu_marker_indices, dtype=np.int64)
+        # Each (taxon, marker) cell of the taxon by marker coverage matrix,
+        # flattened
+        self._pair_cells = self._pair_taxa * self._num_markers + otu_marker_indices[self._pair_otus]
+        self._pair_otu_coverages = np.array(otu_coverages, dtype=np.float64)[self._pair_otus]
+        self._taxon_num_markers = np.array(
+            [len(genes_per_domain[tax.split(';')[1].strip().replace('d__','')]) for tax in self.taxa],
+            dtype=np.float64)
+
+        # Order the markers of each taxon by when they are first encountered,
+        # so that sums across markers are taken in that order.
+        next_rank = [0]*self._num_taxa
+        cell_to_rank = {}
+        for cell in self._pair_cells.tolist():
+            if cell not in cell_to_rank:
+                taxon_index = cell // self._num_markers
+                cell_to_rank[cell] = next_rank[taxon_index]
+                next_rank[taxon_index] += 1
+        self._ordered_cells = np.arange(self._num_taxa * self._num_markers, dtype=np.int64)
+        unranked = np.ones(self._num_taxa * self._num_markers, dtype=bool)
+        for cell, rank in cell_to_rank.items():
+            self._ordered_cells[cell - cell % self._num_markers + rank] = cell
+            unranked[cell - cell % self._num_markers + rank] = False
+        # Cells never encountered are always 0, so can go at the end in any order
+        unranked_cells = np.setdiff1d(
+            np.arange(self._num_taxa * self._num_markers, dtype=np.int64),
+            np.array(list(cell_to_rank.keys()), dtype=np.int64))
+        self._ordered_cells[unranked] = unranked_cells
+
+    def run(self, trim_percent, calculate_abundance, species_whitelist=None, proximity_cutoff=None):
+        """Iterate until convergence. If species_whitelist is given, species
+        not in it which have less than proximity_cutoff of the coverage of
+        their genus are removed each iteration. Returns a dict of taxon to
+        coverage and the number of steps taken."""
+        coverages = np.ones(self._num_taxa, dtype=np.float64)
+        active = np.ones(self._num_taxa, dtype=bool)
+        if species_whitelist is not None:
+            whitelisted = np.array([tax in species_whitelist for tax in self.taxa], dtype=bool)
+            genus_to_index = {}
+            taxon_genera = np.array(
+                [genus_to_index.setdefault(tax.split(';')[6].strip(), len(genus_to_index)) for tax in self.taxa],
+                dtype=np.int64)
+
+        num_steps = 0
+        while True: # while not converged
+            num_steps += 1
+
+            # Partition out the undecided coverage according to the current
+            # iteration's ratios
+            pair_active = active[self._pair_taxa]
+            pair_coverages = np.where(pair_active, coverages[self._pair_taxa], 0.0)
+            otu_totals = np.bincount(self._pair_otus, weights=pair_coverages, minlength=self._num_otus)
+            pair_totals = otu_totals[self._pair_otus]
+            # OTUs whose candidates have all been removed contribute nothing
+            contributing = pair_active & (pair_totals != 0)
+            shares = pair_coverages[contributing] / pair_totals[contributing] * self._pair_otu_coverages[contributing]
+            contributing_cells = self._pair_cells[contributing]
+            cell_coverages = np.bincount(
+                contributing_cells, weights=shares, minlength=self._num_taxa * self._num_markers)
+            next_active = np.bincount(self._pair_taxa[contributing], minlength=self._num_taxa) > 0
+
+            # Calculate the (possibly trimmed) mean for each taxon
+            ordered_coverages = cell_coverages[self._ordered_cells].reshape(self._num_taxa, self._num_markers)
+            if trim_percent == 0:
+                next_coverages = np.cumsum(ordered_coverages, axis=1)[:, -1] / self._taxon_num_markers
+            else:
+                present = np.bincount(contributing_cells, minlength=self._num_taxa * self._num_markers) > 0
+                ordered_present = present[self._ordered_cells].reshape(self._num_taxa, self._num_markers)
+                next_coverages = np.zeros(self._num_taxa, dtype=np.float64)
+                for i in np.flatnonzero(next_active):
+                    next_coverages[i] = calculate_abundance(
+                        ordered_coverages[i][ordered_present[i]].tolist(), int(self._taxon_num_markers[i]), trim_percent)
+
+            # Remove species that appear to be noise based upon having low
+            # coverage and proximity to higher coverage species
+            if species_whitelist is not None:
+                genus_coverages = np.bincount(
+                    taxon_genera[next_active], weights=next_coverages[next_active], minlength=len(genus_to_index))
+                failed = next_active & ~whitelisted & \
+                    (next_coverages < genus_coverages[taxon_genera] * proximity_cutoff)
+                if failed.any():
+                    logging.debug("Removing species {} due to low coverage and proximity to higher coverage species".format(
+                        [self.taxa[i] for i in np.flatnonzero(failed)]))
+                next_active = next_active & ~failed
+            else:
+                failed = np.zeros(self._num_taxa, dtype=bool)
+
+            # Has any taxon changed in abundance by a large enough amount? If
+            # not, we're done. Always iterate again if we removed any
+            # species, because otherwise their coverage contributions will be
+            # lost.
+            need_another_iteration = failed.any() or \
+                (np.abs(next_coverages[next_active] - coverages[next_active]) > 0.001).any()
+
+            coverages = next_coverages
+            active = next_active
+            if not need_another_iteration:
+                break
+
+        taxon_to_coverage = {}
+        for i in np.flatnonzero(active):
+            taxon_to_coverage[self.taxa[i]] = float(coverages[i])
+        return taxon_to_coverage, num_steps
+
 class WordNode:
     def __init__(self, parent, word):
         self.parent = parent # WordNode object
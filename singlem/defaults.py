@@ -0,0 +1,23 @@
+# Default values and names that bin/singlem needs when building its argument
+# parser. This module must not import anything heavy, so that singlem starts
+# quickly when the subcommand run does not need e.g. pipe or condense. The
+# modules these belong to import them from here.
+
+DEFAULT_THREADS = 1
+
+# SearchPipe
+DEFAULT_MIN_ORF_LENGTH = 72
+DEFAULT_GENOME_MIN_ORF_LENGTH = 300
+DEFAULT_FILTER_MINIMUM_PROTEIN = 24
+DEFAULT_FILTER_MINIMUM_NUCLEOTIDE = 72
+DEFAULT_PREFILTER_PERFORMANCE_PARAMETERS = "--block-size 0.5 --target-indexed -c1"
+DEFAULT_DIAMOND_ASSIGN_TAXONOMY_PERFORMANCE_PARAMETERS = "--block-size 0.5 --target-indexed -c1"
+DEFAULT_ASSIGNMENT_THREADS = 1
+
+# Condenser
+DEFAULT_TRIM_PERCENT = 10
+DEFAULT_MIN_TAXON_COVERAGE = 0.35
+
+# Metapackage
+DATA_ENVIRONMENT_VARIABLE = 'SINGLEM_METAPACKAGE_PATH'
+PREFILTER_CACHE_ENVIRONMENT_VARIABLE = 'SINGLEM_PREFILTER_CACHE_DIRECTORY'
@@ -1,17 +1,31 @@
 import os
 import logging
-import extern
+from array import array
+from contextlib import ExitStack
 
 from .singlem import FastaNameToSampleName
+from .sequence_classes import SeqReader
+from .read_store import ReadStore
 from .run_via_os_system import run_via_os_system
+from . import instrumentation
 
 class DiamondSpkgSearcher:
-    def __init__(self, num_threads, working_directory):
+    # Separates the index of the sample from the read name in the names of
+    # reads given to DIAMOND when searching several samples at once
+    SAMPLE_TAG_SEPARATOR = '|'
+
+    def __init__(self, num_threads, working_directory, samples_per_run=1):
+        '''samples_per_run: int
+            number of read files to search in each DIAMOND run. Searching
+            several at once means the DIAMOND database is only loaded once
+            for them all.'''
         self._num_threads = num_threads
         self._working_directory = working_directory
+        self._samples_per_run = samples_per_run
 
     def run_diamond(self, hmms, forward_read_files, reverse_read_files, performance_parameters, diamond_db):
-        '''Run a single DIAMOND run for each of the forward_read_files against a 
+        '''Run a single DIAMOND run for each of the forward_read_files (or for
+        each group of samples_per_run of them) against a
         combined database of all sequences from the singlem package set given.
 
         diamond_db: None or str
@@ -61,55 +75,155 @@ class DiamondSpkgSearcher:
             prefilter_dir = os.path.join(self._working_directory, 'prefilter_forward')
         os.mkdir(prefilter_dir)
         
+        fasta_paths = []
         for file in read_files:
             fasta_path = os.path.join(prefilter_dir,
                                       os.path.basename(file))
             if fasta_path[-3:] == '.gz':
                 fasta_path = fasta_path[:-3] # remove .gz for destination files
             fasta_path = os.path.splitext(fasta_path)[0]+'.fna'
-            
-            f = open(fasta_path, 'w+') # create tempfile in working directory
-            f.close()
-            
+            fasta_paths.append(fasta_path)
+
+        for start in range(0, len(read_files), self._samples_per_run):
+            files = read_files[start:start+self._samples_per_run]
+            results = [DiamondSearchResult(fasta_path) for fasta_path in fasta_paths[start:start+self._samples_per_run]]
+
             cmd = "diamond blastx " \
                   "--outfmt 6 qseqid full_qseq sseqid " \
                   "--max-target-seqs 1 " \
                   "--evalue 0.01 " \
                   "%s " \
                   "--threads %i " \
-                  "--query %s " \
-                  "--db %s " \
-                  "| tee >(sed 's/^/>/; s/\\t/\\n/; s/\\t.*//' > %s) " \
-                  "| awk '{print $1,$3}'" % (
+                  "--db %s" % (
                       performance_parameters,
                       self._num_threads,
-                      file,
-                      diamond_database,
-                      fasta_path)
+                      diamond_database)
 
             # Originially, we ran here via os.system rather than normal extern
             # so reads can be piped in to singlem. However, this meant that
             # errors and failed commands were ignored, sometimes causing
-            # successful return of singlem but an empty OTU table.
-            qseqid_sseqid = extern.run(cmd)
-            best_hits = {}
-            for line in qseqid_sseqid.splitlines():
-                try:
-                    (qseqid,sseqid) = line.split(' ')
-                except ValueError:
-                    raise Exception("Unexpected line format for DIAMOND output line '{}'".format(line))
-                if qseqid in best_hits and best_hits[qseqid] != sseqid:
-                    raise Exception("Multiple DIAMOND best hits? for '{}'".format(qseqid))
-                best_hits[qseqid] = sseqid
-
-            diamond_results.append(DiamondSearchResult(fasta_path, best_hits))
-            
+            # successful return of singlem but an empty OTU table. Now the
+            # output is read as DIAMOND writes it, so it is never held in
+            # memory all at once, but failures are still raised.
+            with ExitStack() as stack:
+                fasta_ios = [stack.enter_context(open(r.query_sequences_file, 'w')) for r in results]
+                if len(files) == 1:
+                    self._read_diamond_hits(
+                        instrumentation.stream_output("%s --query %s" % (cmd, files[0])),
+                        fasta_ios[0], results[0])
+                else:
+                    # The reads of all samples are given to DIAMOND on
+                    # stdin, tagged with the index of their sample, and the
+                    # hits are split back into each sample as they are read.
+                    logging.debug("Searching {} samples in one DIAMOND run".format(len(files)))
+                    self._read_sample_tagged_diamond_hits(
+                        instrumentation.stream_output(
+                            cmd, stdin_writer=lambda stdin: self._write_sample_tagged_reads(files, stdin)),
+                        fasta_ios, results)
+
+            diamond_results.extend(results)
+
         return diamond_results
 
+    @staticmethod
+    def _read_diamond_hits(lines, fasta_io, result):
+        '''Read DIAMOND output lines of qseqid, full_qseq and sseqid,
+        writing each query sequence to fasta_io in FASTA format, and adding
+        its best hit to the DiamondSearchResult result.'''
+        for line in lines:
+            try:
+                (qseqid, full_qseq, sseqid) = line.rstrip('\n').split('\t')
+            except ValueError:
+                raise Exception("Unexpected line format for DIAMOND output line '{}'".format(line))
+            result.add_hit(qseqid, sseqid)
+            fasta_io.write(">{}\n{}\n".format(qseqid, full_qseq))
+
+    @staticmethod
+    def _write_sample_tagged_reads(read_files, output_io):
+        '''Write the reads of each of read_files to output_io in FASTA
+        format, with the index of their file and SAMPLE_TAG_SEPARATOR
+        prepended to their names.'''
+        reader = SeqReader()
+        for (i, read_file) in enumerate(read_files):
+            with SeqReader.open_sequence_file(read_file) as f:
+                for batch in reader.readfq_batches(f):
+                    output_io.write(''.join(
+                        ">{}{}{}\n{}\n".format(i, DiamondSpkgSearcher.SAMPLE_TAG_SEPARATOR, name, seq)
+                        for (name, seq, _) in batch))
+
+    @staticmethod
+    def _read_sample_tagged_diamond_hits(lines, fasta_ios, results):
+        '''Like _read_diamond_hits, but for DIAMOND output from reads
+        written by _write_sample_tagged_reads. The tag is removed from each
+        query name, and the query sequence written to the fasta_io and added
+        to the DiamondSearchResult of its sample.'''
+        for line in lines:
+            try:
+                (qseqid, full_qseq, sseqid) = line.rstrip('\n').split('\t')
+                (sample_index, read_name) = qseqid.split(DiamondSpkgSearcher.SAMPLE_TAG_SEPARATOR, 1)
+                sample_index = int(sample_index)
+            except ValueError:
+                raise Exception("Unexpected line format for DIAMOND output line '{}'".format(line))
+            results[sample_index].add_hit(read_name, sseqid)
+            fasta_ios[sample_index].write(">{}\n{}\n".format(read_name, full_qseq))
+
 class DiamondSearchResult:
-    def __init__(self, query_sequence_file, best_hits):
+    '''The best hit of each read in query_sequences_file, a FASTA file of the
+    reads which hit the DIAMOND database.
+
+    Read names are not stored, since they are in query_sequences_file.
+    Instead the hit of the i'th sequence in the file is stored as the i'th
+    entry of a packed array of integer codes, which index a list of the
+    distinct subject IDs. This takes a few bytes per read rather than a dict
+    entry and two strings.'''
+
+    def __init__(self, query_sequence_file):
+        '''Hits are added with add_hit(), in the order the reads are in
+        query_sequence_file.'''
         self.query_sequences_file = query_sequence_file
-        self.best_hits = best_hits
+        self._subject_ids = []
+        self._subject_id_to_code = {}
+        self._codes = array('H')
+        self._num_reads = 0
+        self._last_read_name = None
+
+    def add_hit(self, read_name, subject_id):
+        '''Record the best hit of the next sequence in the query sequences
+        file. DIAMOND reports all hits of a read together, so a read is
+        counted once however many consecutive hits it has.'''
+        code = self._subject_id_to_code.get(subject_id)
+        if code is None:
+            code = len(self._subject_ids)
+            self._subject_id_to_code[subject_id] = code
+            self._subject_ids.append(subject_id)
+            if code == 2**16:
+                self._codes = array('I', self._codes)
+        if read_name == self._last_read_name:
+            if self._subject_ids[self._codes[-1]] != subject_id:
+                raise Exception("Multiple DIAMOND best hits? for '{}'".format(read_name))
+        else:
+            self._num_reads += 1
+            self._last_read_name = read_name
+        self._codes.append(code)
+
+    def num_hits(self):
+        '''Return the number of reads with a hit'''
+        return self._num_reads
+
+    def read_store(self):
+        '''Return a ReadStore of the query sequences file'''
+        return ReadStore(self.query_sequences_file)
+
+    def each_record_with_best_hit(self):
+        '''Yield (offset, read_name, sequence, subject_id) for each sequence in
+        the query sequences file, in order, where offset is the position of
+        the sequence in read_store().'''
+        read_store = self.read_store()
+        try:
+            for (code, (offset, read_name, seq)) in zip(self._codes, read_store.each()):
+                yield (offset, read_name, seq, self._subject_ids[code])
+        finally:
+            read_store.close()
 
     def sample_name(self):
-        return FastaNameToSampleName().fasta_to_name(self.query_sequences_file)
\ No newline at end of file
+        return FastaNameToSampleName().fasta_to_name(self.query_sequences_file)
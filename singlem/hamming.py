@@ -0,0 +1,63 @@
+import numba
+import numpy as np
+
+
+def sequences_to_code_matrix(seqs):
+    """Return a 2D uint8 array of the character codes of an iterable of
+    equal-length sequences, one row per sequence."""
+    seqs = list(seqs)
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    seq_length = len(seqs[0])
+    for seq in seqs:
+        if len(seq) != seq_length:
+            raise Exception(
+                "Attempted to encode sequences with differing lengths: {} and {}".format(
+                    seqs[0], seq))
+    return np.frombuffer(
+        ''.join(seqs).encode('ascii', errors='replace'), dtype=np.uint8) \
+        .reshape(len(seqs), seq_length)
+
+@numba.njit()
+def _hamming_distance_matrix(query_codes, subject_codes):
+    distances = np.zeros((query_codes.shape[0], subject_codes.shape[0]), dtype=np.int64)
+    for i in range(query_codes.shape[0]):
+        for j in range(subject_codes.shape[0]):
+            d = 0
+            for k in range(query_codes.shape[1]):
+                if query_codes[i, k] != subject_codes[j, k]:
+                    d += 1
+            distances[i, j] = d
+    return distances
+
+def hamming_distances(query_sequences, subject_sequences):
+    """Return a 2D array of the number of positions at which each of the query
+    sequences (rows) differs from each of the subject sequences (columns). All
+    sequences must be the same length."""
+    query_codes = sequences_to_code_matrix(query_sequences)
+    subject_codes = sequences_to_code_matrix(subject_sequences)
+    if query_codes.shape[0] == 0 or subject_codes.shape[0] == 0:
+        return np.zeros((query_codes.shape[0], subject_codes.shape[0]), dtype=np.int64)
+    if query_codes.shape[1] != subject_codes.shape[1]:
+        raise Exception(
+            "Attempted comparison of sequences with differing lengths: {} and {}".format(
+                query_codes.shape[1], subject_codes.shape[1]))
+    return _hamming_distance_matrix(query_codes, subject_codes)
+
+def paired_hamming_distances(sequences1, sequences2):
+    """Return a 1D array of the number of positions at which the i'th sequence
+    of sequences1 differs from the i'th sequence of sequences2. All sequences
+    must be the same length."""
+    codes1 = sequences_to_code_matrix(sequences1)
+    codes2 = sequences_to_code_matrix(sequences2)
+    if codes1.shape[0] != codes2.shape[0]:
+        raise Exception(
+            "Attempted comparison of differing numbers of sequences: {} and {}".format(
+                codes1.shape[0], codes2.shape[0]))
+    if codes1.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    if codes1.shape[1] != codes2.shape[1]:
+        raise Exception(
+            "Attempted comparison of sequences with differing lengths: {} and {}".format(
+                codes1.shape[1], codes2.shape[1]))
+    return (codes1 != codes2).sum(axis=1)
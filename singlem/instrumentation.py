@@ -0,0 +1,193 @@
+import json
+import logging
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import extern
+
+from .version import __version__
+
+# The Instrumentation currently recording, or None. Module level so that
+# stages and external commands can be recorded from anywhere in the pipeline
+# without passing it around. Commands run in worker processes are not
+# recorded individually, but their CPU time is counted in the stage they are
+# run in once the workers have exited.
+_active = None
+
+
+class _ResourceSnapshot:
+    def __init__(self):
+        self.wall = time.perf_counter()
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.cpu = self_usage.ru_utime + self_usage.ru_stime
+        self.external_cpu = children_usage.ru_utime + children_usage.ru_stime
+
+    def usage_since(self):
+        '''Return a dict of the resources used since this snapshot was taken.
+        Peak memory is the high water mark so far, since that is all the
+        operating system reports. ru_maxrss is in kilobytes on Linux.
+
+        The peak memory of external commands is not included, since the
+        operating system only reports that of the largest command run so far,
+        which says nothing about any later stage or command. It is reported
+        once for the whole run instead.'''
+        end = _ResourceSnapshot()
+        return {
+            'wall_seconds': round(end.wall - self.wall, 3),
+            'cpu_seconds': round(end.cpu - self.cpu, 3),
+            'external_cpu_seconds': round(end.external_cpu - self.external_cpu, 3),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+
+
+class Instrumentation:
+    '''Records the wall time, CPU time, peak memory and record counts of each
+    stage of a run, and of each external command run during each stage.'''
+
+    def __init__(self):
+        self.stages = []
+        self._current_stage = None
+        self._start = _ResourceSnapshot()
+
+    def report(self):
+        total = self._start.usage_since()
+        # The largest external command run
+        total['peak_external_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+        total['singlem_version'] = __version__
+        total['stages'] = self.stages
+        return total
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def start():
+    '''Start recording, returning the new Instrumentation object.'''
+    global _active
+    _active = Instrumentation()
+    return _active
+
+def stop():
+    '''Stop recording, returning the Instrumentation object that was
+    recording, or None if there wasn't one.'''
+    global _active
+    instrumentation = _active
+    _active = None
+    return instrumentation
+
+@contextmanager
+def stage(name):
+    '''Record the resources used by the code run within this context as a
+    stage of the given name, if recording.'''
+    if _active is None:
+        yield
+        return
+    record = {'name': name, 'counts': {}, 'commands': []}
+    previous_stage = _active._current_stage
+    _active._current_stage = record
+    start_snapshot = _ResourceSnapshot()
+    try:
+        yield
+    finally:
+        record.update(start_snapshot.usage_since())
+        _active._current_stage = previous_stage
+        _active.stages.append(record)
+        logging.debug("Stage {} took {} seconds".format(name, record['wall_seconds']))
+
+def add_count(name, value):
+    '''Add a count of records e.g. the number of reads to the current stage,
+    if recording.'''
+    if _active is not None and _active._current_stage is not None:
+        _active._current_stage['counts'][name] = value
+
+@contextmanager
+def external_command(command):
+    '''Record the resources used by an external command run within this
+    context, if recording. The command must have finished when the context
+    exits for its CPU time to be counted.'''
+    if _active is None or _active._current_stage is None:
+        yield
+        return
+    start_snapshot = _ResourceSnapshot()
+    try:
+        yield
+    finally:
+        record = start_snapshot.usage_since()
+        # Time spent in Python waiting on the command is not interesting
+        del record['cpu_seconds']
+        del record['peak_rss_mb']
+        record['command'] = command
+        _active._current_stage['commands'].append(record)
+
+def run(command, stdin=None):
+    '''extern.run, recording the resources used.'''
+    with external_command(command):
+        return extern.run(command, stdin=stdin)
+
+def run_many(commands, num_threads):
+    '''extern.run_many, recording the resources used by all of the commands
+    together.'''
+    with external_command(list(commands)):
+        return extern.run_many(commands, num_threads=num_threads)
+
+def stream_output(command, stdin_writer=None):
+    '''Yield lines of the stdout of command as it runs, recording the
+    resources used, and raising an extern.ExternCalledProcessError if it
+    fails. If the lines are not all read, the command is killed.
+
+    stdin_writer: None or function
+        if not None, called in a separate thread with the stdin of command
+        (as a text file object) to write its input. An exception raised by
+        it is raised here once the command has finished.'''
+    logging.debug("Running command: {}".format(command))
+    with external_command(command):
+        with tempfile.TemporaryFile(prefix='singlem_stderr') as stderr:
+            proc = subprocess.Popen(['bash','-o','pipefail','-c',command],
+                stdin=subprocess.PIPE if stdin_writer is not None else None,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                universal_newlines=True)
+            writer_errors = []
+            writer = None
+            if stdin_writer is not None:
+                def write_stdin():
+                    try:
+                        stdin_writer(proc.stdin)
+                    except BrokenPipeError:
+                        # The command stopped early, which is reported below
+                        pass
+                    except Exception as e:
+                        writer_errors.append(e)
+                    finally:
+                        # Always close stdin, otherwise the command would
+                        # wait for more input forever
+                        try:
+                            proc.stdin.close()
+                        except BrokenPipeError:
+                            pass
+                writer = threading.Thread(target=write_stdin, daemon=True)
+                writer.start()
+            try:
+                for line in proc.stdout:
+                    yield line
+                proc.wait()
+            finally:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                if writer is not None:
+                    writer.join()
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise extern.ExternCalledProcessError(
+                    subprocess.CompletedProcess(
+                        command, proc.returncode, stdout='', stderr=stderr.read().decode()),
+                    command)
+            if len(writer_errors) > 0:
+                raise writer_errors[0]
@@ -26,7 +26,7 @@ class KingfisherSra:
         reverse_count = 0
 
         with open(fasta_path) as input:
-            for name, seq, _ in SeqReader().readfq(input):
+            for name, seq, _ in SeqReader().readfq_buffered(input):
                 m = regex.match(name)
                 if m is None:
                     raise Exception("Unexpected format for kingfisher SRA readname: {}".format(
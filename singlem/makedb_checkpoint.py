@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+
+
+class MakedbCheckpoint:
+    '''Records the stages of a SingleM database build which have been
+    completed, so that an interrupted build can be resumed without redoing
+    them. The record is kept in a JSON file inside the database directory
+    while the build is in progress, and removed once it has finished.'''
+
+    FILE_NAME = 'makedb_checkpoint.json'
+    version = 1
+
+    def __init__(self, db_path, parameters):
+        '''
+        Parameters
+        ----------
+        db_path: str
+            path to the database being built
+        parameters: dict
+            the build parameters which determine the contents of the
+            database, including the input_files fingerprint of the input
+            files. A build can only be resumed with the same parameters.
+        '''
+        self.path = os.path.join(db_path, MakedbCheckpoint.FILE_NAME)
+        self.parameters = parameters
+        self._completed_stages = []
+
+    @staticmethod
+    def input_fingerprint(paths):
+        '''Return a fingerprint of the input files, which is the absolute path,
+        size and modification time of each, so that a build is not resumed
+        with inputs which have been changed. The files are not read.'''
+        fingerprint = []
+        for path in paths:
+            stat = os.stat(path)
+            fingerprint.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+        return fingerprint
+
+    @staticmethod
+    def exists(db_path):
+        return os.path.exists(os.path.join(db_path, MakedbCheckpoint.FILE_NAME))
+
+    @staticmethod
+    def load(db_path, parameters):
+        '''Load the checkpoint of an interrupted build, raising an Exception
+        if it was started with different parameters.'''
+        checkpoint = MakedbCheckpoint(db_path, parameters)
+        with open(checkpoint.path) as f:
+            j = json.load(f)
+        if j['version'] != MakedbCheckpoint.version:
+            raise Exception("Unexpected makedb checkpoint version {} in {}".format(j['version'], checkpoint.path))
+        if j['parameters'].get('input_files') != parameters.get('input_files'):
+            raise Exception("Cannot resume building the database at {}, since the input files differ from those it was started with: {}".format(
+                db_path, j['parameters'].get('input_files')))
+        if j['parameters'] != parameters:
+            raise Exception("Cannot resume building the database at {}, since it was started with different parameters: {}".format(
+                db_path, j['parameters']))
+        checkpoint._completed_stages = j['completed_stages']
+        logging.info("Resuming database build, {} stage(s) were completed previously".format(
+            len(checkpoint._completed_stages)))
+        return checkpoint
+
+    def is_completed(self, stage):
+        return stage in self._completed_stages
+
+    def complete(self, stage):
+        '''Record that the stage has been completed.'''
+        self._completed_stages.append(stage)
+        self.write()
+
+    def write(self):
+        # Write then rename so that an interruption never leaves a partial
+        # checkpoint file
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({
+                'version': MakedbCheckpoint.version,
+                'parameters': self.parameters,
+                'completed_stages': self._completed_stages}, f)
+        os.replace(temporary_path, self.path)
+
+    def remove(self):
+        os.remove(self.path)
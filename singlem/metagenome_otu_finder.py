@@ -1,8 +1,12 @@
 import logging
 import re
+import numpy as np
 from .sequence_classes import UnalignedAlignedNucleotideSequence
 import itertools
 
+# Number of sequences windowed at once by _nucleotide_alignments
+NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE = 10000
+
 class MetagenomeOtuFinder:
     def find_windowed_sequences(self,
                                 aligned_sequences,
@@ -57,7 +61,10 @@ class MetagenomeOtuFinder:
 
         # For each read aligned to that region (e.g. that has the first and last bases),
         # record the corresponding nucleotide sequence.
-        windowed_sequences = []
+        windowed_names = []
+        windowed_aligned_sequences = []
+        windowed_nucleotides = []
+        aligned_nucleotides_list = []
         for s in aligned_sequences:
             if s.seq[chosen_positions[0]] != '-' and s.seq[chosen_positions[-1]] != '-':
                 if is_protein_alignment:
@@ -76,15 +83,25 @@ class MetagenomeOtuFinder:
                         continue
                     nuc = nucleotide_sequences[name]
                     aligned_nucleotides = nuc.replace('-','')
-                align, aligned_length = self._nucleotide_alignment(
-                    s, aligned_nucleotides, chosen_positions, is_protein_alignment,
-                    include_inserts=include_inserts)
+                windowed_names.append(name)
+                windowed_aligned_sequences.append(s)
+                windowed_nucleotides.append(nuc)
+                aligned_nucleotides_list.append(aligned_nucleotides)
 
-                windowed_sequences.append(
-                    UnalignedAlignedNucleotideSequence(name, s.name, align, nuc, aligned_length))
-        return windowed_sequences
+        alignments = self._nucleotide_alignments(
+            windowed_aligned_sequences, aligned_nucleotides_list, chosen_positions,
+            is_protein_alignment, include_inserts=include_inserts)
+        return [
+            UnalignedAlignedNucleotideSequence(name, s.name, align, nuc, aligned_length)
+            for name, s, nuc, (align, aligned_length) in zip(
+                windowed_names, windowed_aligned_sequences, windowed_nucleotides, alignments)]
 
     def _find_lower_case_columns(self, protein_alignment):
+        alignment_matrix = self._alignment_matrix(protein_alignment)
+        if alignment_matrix is not None:
+            is_lower = (alignment_matrix >= ord('a')) & (alignment_matrix <= ord('z'))
+            return np.flatnonzero(is_lower.any(axis=0)).tolist()
+
         lower_cases = [False]*len(protein_alignment[0].seq)
         lower_case_chars = re.compile(r'[a-z]')
         for pro in protein_alignment:
@@ -95,6 +112,20 @@ class MetagenomeOtuFinder:
                     lower_cases[i] = True
         return [i for i, is_lower in enumerate(lower_cases) if is_lower]
 
+    @staticmethod
+    def _alignment_matrix(aligned_sequences):
+        '''Return the aligned sequences as a 2D uint8 numpy array of character
+        codes, one row per sequence, or None if they are not all the same
+        length or are not ASCII.'''
+        alignment_length = len(aligned_sequences[0].seq)
+        if any(len(s.seq) != alignment_length for s in aligned_sequences):
+            return None
+        try:
+            joined = ''.join([s.seq for s in aligned_sequences]).encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        return np.frombuffer(joined, dtype=np.uint8).reshape(len(aligned_sequences), alignment_length)
+
     def find_best_window(self, alignment, stretch_length, is_protein_alignment):
         '''Return the position in the alignment that has the most bases aligned only
         counting sequences that overlap the entirety of the stretch. Columns
@@ -172,6 +203,35 @@ class MetagenomeOtuFinder:
 
         return start_position_without_gaps
 
+    def window_columns(self, alignment, best_position, stretch_length):
+        '''Return the insert (lower case) columns of the alignment and the
+        columns of the window starting at best_position.
+
+        Parameters
+        ----------
+        alignment: list of Sequence or AlignedProteinSequence
+            aligned sequences
+        best_position: int
+            Start of the window in the alignment not counting 'insert' columns.
+        stretch_length: int
+            window size, measured in alignment columns
+
+        Returns
+        -------
+        list of 2: the ignored columns and the chosen positions, both lists of int
+        '''
+        ignored_columns = self._find_lower_case_columns(alignment)
+        logging.debug("Ignoring columns %s", str(ignored_columns))
+        # Find start of window in aligned sequence
+        start_position = self._upper_case_position_to_alignment_position(
+            best_position, ignored_columns)
+        logging.debug("Using pre-defined best section of the alignment starting from %i" % (start_position + 1))
+        # Find all positions in the window
+        chosen_positions = self._best_position_to_chosen_positions(
+            start_position, stretch_length, ignored_columns)
+        logging.debug("Found chosen positions %s", chosen_positions)
+        return ignored_columns, chosen_positions
+
     def _best_position_to_chosen_positions(self, best_position, stretch_length, ignored_columns):
         '''Given a position to start from, and the number of positions to index,
         return the consecutive indices that are not in the ignored_columns list'''
@@ -192,6 +252,112 @@ class MetagenomeOtuFinder:
                 return target
         return target
 
+    def _nucleotide_alignments(self,
+                               protein_sequences,
+                               nucleotides_list,
+                               chosen_positions,
+                               is_protein_alignment,
+                               include_inserts=False):
+        '''Like _nucleotide_alignment, but for many sequences at once. The
+        position of each column's codon in each sequence's nucleotides is
+        calculated from a cumulative sum of its aligned columns, and the
+        windows of all sequences are gathered in one go from their
+        concatenated nucleotides.
+
+        Returns
+        -------
+        list of (nucleotides string, aligned length), one per protein_sequence
+        '''
+        # Sequences are processed in chunks so that the intermediate matrices,
+        # which are several times larger than the alignment itself, stay small
+        # however many sequences are windowed.
+        to_return = []
+        for start in range(0, len(protein_sequences), NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE):
+            end = start + NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE
+            to_return.extend(self._nucleotide_alignments_chunk(
+                protein_sequences[start:end], nucleotides_list[start:end],
+                chosen_positions, is_protein_alignment, include_inserts))
+        return to_return
+
+    def _nucleotide_alignments_chunk(self,
+                                     protein_sequences,
+                                     nucleotides_list,
+                                     chosen_positions,
+                                     is_protein_alignment,
+                                     include_inserts):
+        alignment_matrix = self._alignment_matrix(protein_sequences)
+        try:
+            joined_nucleotides = ''.join(nucleotides_list).encode('ascii')
+        except UnicodeEncodeError:
+            alignment_matrix = None
+        if alignment_matrix is None:
+            return [self._nucleotide_alignment(
+                protein_sequence, nucleotides, chosen_positions,
+                is_protein_alignment, include_inserts=include_inserts)
+                for protein_sequence, nucleotides in zip(protein_sequences, nucleotides_list)]
+
+        if is_protein_alignment:
+            length_ratio = 3
+            empty_codon = '---'
+        else:
+            length_ratio = 1
+            empty_codon = '-'
+
+        is_aligned = alignment_matrix != ord('-')
+        num_aligned = is_aligned.sum(axis=1)
+        nucleotide_lengths = np.array([len(n) for n in nucleotides_list])
+        for nucleotides, num, nucleotide_length in zip(nucleotides_list, num_aligned.tolist(), nucleotide_lengths.tolist()):
+            if nucleotide_length < num * length_ratio:
+                raise Exception("Insufficient nucleotide length found")
+            if '-' in nucleotides:
+                for i in range(length_ratio, num*length_ratio, length_ratio):
+                    if nucleotides[i:i+length_ratio] == empty_codon:
+                        raise Exception("Input nucleotide sequence had gap characters, didn't expect this")
+            if nucleotide_length > num * length_ratio:
+                raise Exception(
+                    "Insufficient aligned length found - were unaligned columns"
+                    " removed? Don't remove them.")
+
+        first = chosen_positions[0]
+        last = chosen_positions[-1]
+        aligned_lengths = is_aligned[:, first:last+1].sum(axis=1) * length_ratio
+
+        if include_inserts:
+            window_columns = np.arange(first, last+1)
+        else:
+            window_columns = np.array(chosen_positions)
+        is_chosen = np.isin(window_columns, chosen_positions)
+
+        # Index of the first nucleotide of each window column in the
+        # concatenated nucleotides, then of each nucleotide in the codon
+        nucleotide_offsets = np.concatenate(([0], np.cumsum(nucleotide_lengths)[:-1]))
+        codon_indices = np.cumsum(is_aligned, axis=1)[:, window_columns] - is_aligned[:, window_columns]
+        window_aligned = is_aligned[:, window_columns]
+        starts = nucleotide_offsets[:, None] + codon_indices * length_ratio
+        indices = starts[:, :, None] + np.arange(length_ratio)
+        indices[~window_aligned] = 0
+        nucleotide_codes = np.frombuffer(joined_nucleotides, dtype=np.uint8)
+        windows = nucleotide_codes[indices] if len(nucleotide_codes) > 0 else \
+            np.zeros(indices.shape, dtype=np.uint8)
+
+        # Inserts are lower case, unaligned chosen columns are gaps, and
+        # unaligned insert columns are removed.
+        is_insert = window_aligned & ~is_chosen
+        is_upper = (windows >= ord('A')) & (windows <= ord('Z'))
+        windows = np.where(is_insert[:, :, None] & is_upper, windows + (ord('a') - ord('A')), windows)
+        windows[~window_aligned & is_chosen] = ord('-')
+        windows[~window_aligned & ~is_chosen] = 0
+        window_bytes = windows.reshape(len(protein_sequences), -1).tobytes()
+        window_length = windows.shape[1] * length_ratio
+
+        to_return = []
+        for i, aligned_length in enumerate(aligned_lengths.tolist()):
+            window = window_bytes[i*window_length:(i+1)*window_length].decode('ascii')
+            if include_inserts:
+                window = window.replace('\0', '')
+            to_return.append((window, aligned_length))
+        return to_return
+
     def _nucleotide_alignment(self,
                               protein_sequence,
                               nucleotides,
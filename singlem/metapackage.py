@@ -5,15 +5,16 @@ import shutil
 import extern
 import tempfile
 import json
+import hashlib
 
 import zenodo_backpack
 
+from .defaults import DATA_ENVIRONMENT_VARIABLE, PREFILTER_CACHE_ENVIRONMENT_VARIABLE
 from .singlem_package import SingleMPackage
 from .sequence_classes import SeqReader
 from .metapackage_read_name_store import MetapackageReadNameStore
 
 DATA_DEFAULT_VERSION = '3.0.5'
-DATA_ENVIRONMENT_VARIABLE = 'SINGLEM_METAPACKAGE_PATH'
 DATA_DOI = '10.5281/zenodo.5739611'
 
 class Metapackage:
@@ -237,17 +238,66 @@ class Metapackage:
         self._prefilter_path = path
 
     def get_dmnd(self):
-        ''' Create temporary DIAMOND file for search method '''
+        ''' Create temporary DIAMOND file for search method. If the
+        SINGLEM_PREFILTER_CACHE_DIRECTORY environment variable is set, the
+        DIAMOND database is instead stored there, and reused by later runs with
+        the same prefilter FASTA and DIAMOND version.'''
         fasta_paths = [pkg.graftm_package().unaligned_sequence_database_path() for pkg in self.singlem_packages]
+        cache_directory = os.environ.get(PREFILTER_CACHE_ENVIRONMENT_VARIABLE)
+        if cache_directory:
+            return self._get_cached_dmnd(fasta_paths, cache_directory)
+
         temp_dmnd = tempfile.NamedTemporaryFile(mode="w", prefix='singlem-diamond-prefilter',
                                                 suffix='.dmnd', delete=False).name
+        self._make_dmnd(fasta_paths, temp_dmnd)
+        return temp_dmnd
+
+    def _make_dmnd(self, fasta_paths, dmnd_path):
         cmd = 'cat %s | '\
-            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), temp_dmnd)
+            'diamond makedb --in - --db %s' % (' '.join(fasta_paths), dmnd_path)
 
         extern.run(cmd)
-        extern.run("diamond makeidx -d {}".format(temp_dmnd))
+        extern.run("diamond makeidx -d {}".format(dmnd_path))
 
-        return temp_dmnd
+    @staticmethod
+    def _prefilter_cache_key(fasta_paths):
+        '''Return a checksum of the prefilter FASTA contents and the DIAMOND
+        version, used to name entries in the prefilter cache.'''
+        h = hashlib.sha256()
+        h.update(extern.run('diamond version').strip().encode())
+        for path in fasta_paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def _get_cached_dmnd(self, fasta_paths, cache_directory):
+        key = Metapackage._prefilter_cache_key(fasta_paths)
+        entry_directory = os.path.join(cache_directory, key)
+        dmnd_path = os.path.join(entry_directory, 'prefilter.dmnd')
+        if os.path.exists(dmnd_path):
+            logging.info("Using cached DIAMOND prefilter database {}".format(dmnd_path))
+            return dmnd_path
+
+        # Build in a temporary directory, then move it into place, so that
+        # other processes never see a partially built database.
+        logging.info("Creating DIAMOND prefilter database in cache directory {} ..".format(cache_directory))
+        os.makedirs(cache_directory, exist_ok=True)
+        build_directory = tempfile.mkdtemp(prefix='singlem-prefilter-cache', dir=cache_directory)
+        try:
+            self._make_dmnd(fasta_paths, os.path.join(build_directory, 'prefilter.dmnd'))
+        except Exception:
+            shutil.rmtree(build_directory, ignore_errors=True)
+            raise
+        try:
+            os.rename(build_directory, entry_directory)
+        except OSError:
+            if not os.path.exists(dmnd_path):
+                raise
+            # Another process finished building the same database first
+            logging.debug("DIAMOND prefilter database was concurrently created at {}".format(dmnd_path))
+            shutil.rmtree(build_directory)
+        return dmnd_path
 
     def protein_packages(self):
         return [pkg for pkg in self._hmms_and_positions.values() if pkg.is_protein_package()]
@@ -5,6 +5,7 @@ import gzip
 import json
 
 from .archive_otu_table import ArchiveOtuTable
+from .columnar_otu_table import ColumnarOtuTable
 from .otu_table import OtuTable
 from .taxonomy import TaxonomyUtils
 from .otu_table_entry import OtuTableEntry
@@ -33,6 +34,15 @@ class OtuTableCollection:
 
     def add_archive_otu_table(self, input_archive_table_io):
         self.archive_table_objects.append(ArchiveOtuTable.read(input_archive_table_io))
+
+    def add_columnar_otu_table(self, file_path):
+        '''Add a columnar OTU table file to the collection, reading it in.
+        Extra fields are kept.'''
+        otu_table = OtuTable()
+        with ColumnarOtuTable(file_path) as columnar:
+            otu_table.fields = columnar.fields
+            otu_table.data = [otu.data for otu in columnar]
+        self.otu_table_objects.append(otu_table)
     
     def add_otu_table_object(self, input_otu_table_object):
         self.otu_table_objects.append(input_otu_table_object)
@@ -185,6 +195,7 @@ class StreamingOtuTableCollection:
         self._otu_table_file_paths = []
         self._archive_table_file_paths = []
         self._gzip_archive_table_file_paths = []
+        self._columnar_table_file_paths = []
         self._archive_table_objects = []
         self.min_archive_otu_table_version = None
 
@@ -214,12 +225,21 @@ class StreamingOtuTableCollection:
     def add_gzip_archive_otu_table_file(self, file_path):
         self._gzip_archive_table_file_paths.append(file_path)
 
+    def add_columnar_otu_table_file(self, file_path):
+        self._columnar_table_file_paths.append(file_path)
+
     def add_archive_otu_table_object(self, archive_table):
         '''Not technically streaming, but easier to put this here for pipe
         instead of implementing each_sample_otus() for non-streaming OTU
         tables.'''
         self._archive_table_objects.append(archive_table)
 
+    def file_paths(self):
+        '''Return the paths of the files that OTUs are read from. Tables added
+        as IO or archive table objects are not included.'''
+        return self._archive_table_file_paths + self._otu_table_file_paths + \
+            self._gzip_archive_table_file_paths + self._columnar_table_file_paths
+
     def __iter__(self):
         '''Iterate over all the OTUs from all the tables. This can only be done once
         since the data is streamed in.
@@ -245,6 +265,10 @@ class StreamingOtuTableCollection:
                         yield otu
                 except json.decoder.JSONDecodeError:
                     logging.error(f"JSON parsing error in {file_path}, skipping this one")
+        for file_path in self._columnar_table_file_paths:
+            with ColumnarOtuTable(file_path) as table:
+                for otu in table:
+                    yield otu
         for archive_table in self._archive_table_objects:
             for otu in archive_table:
                 yield otu
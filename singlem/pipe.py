@@ -11,6 +11,8 @@ import csv
 import subprocess
 import time
 
+from . import defaults
+from . import instrumentation
 from .metapackage import Metapackage
 from .singlem import OrfMUtils, FastaNameToSampleName
 from .otu_table import OtuTable
@@ -30,16 +32,16 @@ from graftm.sequence_extractor import SequenceExtractor
 from graftm.greengenes_taxonomy import GreenGenesTaxonomy
 from graftm.sequence_search_results import HMMSearchResult, SequenceSearchResult
 
-DEFAULT_THREADS = 1
+DEFAULT_THREADS = defaults.DEFAULT_THREADS
 
 class SearchPipe:
-    DEFAULT_MIN_ORF_LENGTH = 72
-    DEFAULT_GENOME_MIN_ORF_LENGTH = 300
-    DEFAULT_FILTER_MINIMUM_PROTEIN = 24
-    DEFAULT_FILTER_MINIMUM_NUCLEOTIDE = 72
-    DEFAULT_PREFILTER_PERFORMANCE_PARAMETERS = "--block-size 0.5 --target-indexed -c1"
-    DEFAULT_DIAMOND_ASSIGN_TAXONOMY_PERFORMANCE_PARAMETERS = "--block-size 0.5 --target-indexed -c1"
-    DEFAULT_ASSIGNMENT_THREADS = 1
+    DEFAULT_MIN_ORF_LENGTH = defaults.DEFAULT_MIN_ORF_LENGTH
+    DEFAULT_GENOME_MIN_ORF_LENGTH = defaults.DEFAULT_GENOME_MIN_ORF_LENGTH
+    DEFAULT_FILTER_MINIMUM_PROTEIN = defaults.DEFAULT_FILTER_MINIMUM_PROTEIN
+    DEFAULT_FILTER_MINIMUM_NUCLEOTIDE = defaults.DEFAULT_FILTER_MINIMUM_NUCLEOTIDE
+    DEFAULT_PREFILTER_PERFORMANCE_PARAMETERS = defaults.DEFAULT_PREFILTER_PERFORMANCE_PARAMETERS
+    DEFAULT_DIAMOND_ASSIGN_TAXONOMY_PERFORMANCE_PARAMETERS = defaults.DEFAULT_DIAMOND_ASSIGN_TAXONOMY_PERFORMANCE_PARAMETERS
+    DEFAULT_ASSIGNMENT_THREADS = defaults.DEFAULT_ASSIGNMENT_THREADS
 
     def run(self, **kwargs):
         output_otu_table = kwargs.pop('otu_table', None)
@@ -47,7 +49,22 @@ class SearchPipe:
         output_taxonomic_profile = kwargs.pop('output_taxonomic_profile', None)
         output_taxonomic_profile_krona = kwargs.pop('output_taxonomic_profile_krona', None)
         output_extras = kwargs.pop('output_extras')
+        performance_report = kwargs.pop('performance_report', None)
 
+        if performance_report:
+            instrumentation.start()
+            try:
+                self._run(output_otu_table, archive_otu_table, output_taxonomic_profile,
+                    output_taxonomic_profile_krona, output_extras, **kwargs)
+            finally:
+                logging.info("Writing performance report to {}".format(performance_report))
+                instrumentation.stop().write_report(performance_report)
+        else:
+            self._run(output_otu_table, archive_otu_table, output_taxonomic_profile,
+                output_taxonomic_profile_krona, output_extras, **kwargs)
+
+    def _run(self, output_otu_table, archive_otu_table, output_taxonomic_profile,
+        output_taxonomic_profile_krona, output_extras, **kwargs):
         outputting_taxonomic_profile = output_taxonomic_profile or output_taxonomic_profile_krona
         if outputting_taxonomic_profile:
             original_tmpdir = tempfile.gettempdir()
@@ -62,23 +79,25 @@ class SearchPipe:
 
         otu_table_object = self.run_to_otu_table(**kwargs)
         if otu_table_object is not None:
-            self.write_otu_tables(
-                otu_table_object,
-                output_otu_table,
-                archive_otu_table,
-                output_extras,
-                metapackage)
+            with instrumentation.stage('write_otu_tables'):
+                self.write_otu_tables(
+                    otu_table_object,
+                    output_otu_table,
+                    archive_otu_table,
+                    output_extras,
+                    metapackage)
 
             if output_taxonomic_profile or output_taxonomic_profile_krona:
                 tempfile.tempdir = original_tmpdir
                 from .condense import Condenser
                 otu_table_collection = StreamingOtuTableCollection()
                 otu_table_collection.add_archive_otu_table_object(otu_table_object)
-                Condenser().condense(
-                    input_streaming_otu_table = otu_table_collection,
-                    output_otu_table = output_taxonomic_profile,
-                    krona = output_taxonomic_profile_krona,
-                    metapackage = metapackage)
+                with instrumentation.stage('condense'):
+                    Condenser().condense(
+                        input_streaming_otu_table = otu_table_collection,
+                        output_otu_table = output_taxonomic_profile,
+                        krona = output_taxonomic_profile_krona,
+                        metapackage = metapackage)
 
 
                 
@@ -141,6 +160,7 @@ class SearchPipe:
         known_sequence_taxonomy = kwargs.pop('known_sequence_taxonomy')
         diamond_prefilter = kwargs.pop('diamond_prefilter')
         diamond_prefilter_performance_parameters = kwargs.pop('diamond_prefilter_performance_parameters')
+        diamond_prefilter_samples_per_run = kwargs.pop('diamond_prefilter_samples_per_run', 1)
         diamond_package_assignment = kwargs.pop('diamond_package_assignment')
         diamond_prefilter_db = kwargs.pop('diamond_prefilter_db')
         diamond_taxonomy_assignment_performance_parameters = kwargs.pop('diamond_taxonomy_assignment_performance_parameters')
@@ -242,13 +262,15 @@ class SearchPipe:
         transcript_tempfile_name_to_desired_name = {}
         if genome_fasta_files:
             logging.info("Calling rough transcriptome of genome FASTA files")
-            for fasta in genome_fasta_files:
-                # Make a tempfile with delete=False because it is in a tmpdir already, and useful for debug to keep around with --working-directory
-                transcripts_path = tempfile.NamedTemporaryFile(prefix='singlem-genome-{}'.format(os.path.basename(fasta)), suffix='.fasta', delete=False)
-                extern.run('orfm -m {} -t {} {} >/dev/null'.format(self._min_orf_length, transcripts_path.name, fasta))
-                transcript_tempfiles.append(transcripts_path)
-                forward_read_files.append(transcripts_path.name)
-                transcript_tempfile_name_to_desired_name[FastaNameToSampleName().fasta_to_name(transcripts_path.name)] = FastaNameToSampleName().fasta_to_name(fasta)
+            with instrumentation.stage('genome_transcripts'):
+                for fasta in genome_fasta_files:
+                    # Make a tempfile with delete=False because it is in a tmpdir already, and useful for debug to keep around with --working-directory
+                    transcripts_path = tempfile.NamedTemporaryFile(prefix='singlem-genome-{}'.format(os.path.basename(fasta)), suffix='.fasta', delete=False)
+                    instrumentation.run('orfm -m {} -t {} {} >/dev/null'.format(self._min_orf_length, transcripts_path.name, fasta))
+                    transcript_tempfiles.append(transcripts_path)
+                    forward_read_files.append(transcripts_path.name)
+                    transcript_tempfile_name_to_desired_name[FastaNameToSampleName().fasta_to_name(transcripts_path.name)] = FastaNameToSampleName().fasta_to_name(fasta)
+                instrumentation.add_count('genomes', len(genome_fasta_files))
 
         def return_cleanly():
             for tf in transcript_tempfiles:
@@ -321,29 +343,34 @@ class SearchPipe:
                             "STDERR was: %s" % (
                                 cmd, p.returncode, p.stderr.read()))
 
-            logging.info("Filtering sequence files through DIAMOND blastx")
-            try:
-                (diamond_forward_search_results, diamond_reverse_search_results) = DiamondSpkgSearcher(
-                    self._num_threads, self._working_directory).run_diamond(
-                    hmms, forward_read_files, reverse_read_files, diamond_prefilter_performance_parameters,
-                    hmms.prefilter_db_path())
-            except extern.ExternCalledProcessError as e:
-                logging.error("Process (DIAMOND?) failed")
+            with instrumentation.stage('diamond_prefilter'):
+                logging.info("Filtering sequence files through DIAMOND blastx")
+                try:
+                    (diamond_forward_search_results, diamond_reverse_search_results) = DiamondSpkgSearcher(
+                        self._num_threads, self._working_directory,
+                        samples_per_run=diamond_prefilter_samples_per_run).run_diamond(
+                        hmms, forward_read_files, reverse_read_files, diamond_prefilter_performance_parameters,
+                        hmms.prefilter_db_path())
+                except extern.ExternCalledProcessError as e:
+                    logging.error("Process (DIAMOND?) failed")
+                    if input_sra_files:
+                        finish_sra_extraction_processes(sra_extraction_processes, sra_extraction_commands)
+                    raise e
+
                 if input_sra_files:
                     finish_sra_extraction_processes(sra_extraction_processes, sra_extraction_commands)
-                raise e
-
-            if input_sra_files:
-                finish_sra_extraction_processes(sra_extraction_processes, sra_extraction_commands)
 
-            found_a_hit = False
-            if any([len(r.best_hits)>0 for r in diamond_forward_search_results]):
-                found_a_hit = True
-            forward_read_files = list([r.query_sequences_file for r in diamond_forward_search_results])
-            if analysing_pairs:
-                reverse_read_files = list([r.query_sequences_file for r in diamond_reverse_search_results])
-                if any([len(r.best_hits)>0 for r in diamond_reverse_search_results]):
+                found_a_hit = False
+                instrumentation.add_count('samples', len(diamond_forward_search_results))
+                instrumentation.add_count('reads_with_hits', sum([r.num_hits() for r in diamond_forward_search_results]) + \
+                    (sum([r.num_hits() for r in diamond_reverse_search_results]) if analysing_pairs else 0))
+                if any([r.num_hits()>0 for r in diamond_forward_search_results]):
                     found_a_hit = True
+                forward_read_files = list([r.query_sequences_file for r in diamond_forward_search_results])
+                if analysing_pairs:
+                    reverse_read_files = list([r.query_sequences_file for r in diamond_reverse_search_results])
+                    if any([r.num_hits()>0 for r in diamond_reverse_search_results]):
+                        found_a_hit = True
             logging.info("Finished DIAMOND prefilter phase")
             if not found_a_hit:
                 logging.info("No reads identified in any samples, stopping")
@@ -386,10 +413,12 @@ class SearchPipe:
         #### Extract relevant reads for each pkg
         if diamond_package_assignment:
             logging.info("Assigning sequences to SingleM packages with DIAMOND ..")
-            extracted_reads = PipeSequenceExtractor().extract_relevant_reads_from_diamond_prefilter(
-                self._num_threads, hmms,
-                diamond_forward_search_results, diamond_reverse_search_results, 
-                analysing_pairs, include_inserts, min_orf_length)
+            with instrumentation.stage('diamond_package_assignment_and_extraction'):
+                extracted_reads = PipeSequenceExtractor().extract_relevant_reads_from_diamond_prefilter(
+                    self._num_threads, hmms,
+                    diamond_forward_search_results, diamond_reverse_search_results, 
+                    analysing_pairs, include_inserts, min_orf_length)
+                self._count_extracted_reads(extracted_reads, analysing_pairs)
             del diamond_forward_search_results
             del diamond_reverse_search_results
             if extracted_reads.empty():
@@ -453,10 +482,11 @@ class SearchPipe:
 
         if assign_taxonomy:
             logging.info("Running taxonomic assignment ..")
-            assignment_result = self._assign_taxonomy(
-                extracted_reads, singlem_assignment_method, threads,
-                diamond_taxonomy_assignment_performance_parameters,
-                assignment_singlem_db)
+            with instrumentation.stage('taxonomic_assignment'):
+                assignment_result = self._assign_taxonomy(
+                    extracted_reads, singlem_assignment_method, threads,
+                    diamond_taxonomy_assignment_performance_parameters,
+                    assignment_singlem_db)
 
         if known_sequence_taxonomy:
             logging.debug("Parsing sequence-wise taxonomy..")
@@ -469,29 +499,42 @@ class SearchPipe:
         #### Process taxonomically assigned reads
         otu_table_object = OtuTable()
         package_to_taxonomy_bihash = {}
-        for readset in extracted_reads:
-            self._process_taxonomically_assigned_reads(
-                # inputs
-                readset,
-                analysing_pairs,
-                known_taxes,
-                known_sequence_taxonomy,
-                assign_taxonomy,
-                singlem_assignment_method,
-                assignment_result if assign_taxonomy else None,
-                output_jplace,
-                known_sequence_tax if known_sequence_taxonomy else None,
-                # outputs
-                otu_table_object,
-                package_to_taxonomy_bihash)
+        with instrumentation.stage('otu_table_generation'):
+            for readset in extracted_reads:
+                self._process_taxonomically_assigned_reads(
+                    # inputs
+                    readset,
+                    analysing_pairs,
+                    known_taxes,
+                    known_sequence_taxonomy,
+                    assign_taxonomy,
+                    singlem_assignment_method,
+                    assignment_result if assign_taxonomy else None,
+                    output_jplace,
+                    known_sequence_tax if known_sequence_taxonomy else None,
+                    # outputs
+                    otu_table_object,
+                    package_to_taxonomy_bihash)
+            instrumentation.add_count('otus', len(otu_table_object.data))
         return otu_table_object
 
+    def _count_extracted_reads(self, extracted_reads, analysing_pairs):
+        '''Record the number of sequences extracted in the current
+        instrumentation stage.'''
+        num_sequences = 0
+        for readset in extracted_reads:
+            for r in (readset if analysing_pairs else [readset]):
+                num_sequences += len(r.known_sequences) + len(r.unknown_sequences)
+        instrumentation.add_count('extracted_sequences', num_sequences)
+
     def _find_and_extract_reads_by_hmmsearch(self,
         hmms, forward_read_files, reverse_read_files,
         known_taxes, known_otu_tables, include_inserts):
 
-        search_result = self._search(hmms, forward_read_files, reverse_read_files)
-        sample_names = search_result.samples_with_hits()
+        with instrumentation.stage('hmmsearch'):
+            search_result = self._search(hmms, forward_read_files, reverse_read_files)
+            sample_names = search_result.samples_with_hits()
+            instrumentation.add_count('samples_with_hits', len(sample_names))
         if len(sample_names) == 0:
             logging.info("No reads identified in any samples, stopping")
             return None
@@ -499,12 +542,15 @@ class SearchPipe:
                     % (len(sample_names), sample_names[0]))
 
         #### Search for each package separately
-        separate_search_result = self._separate_searches(search_result)
+        with instrumentation.stage('hmmsearch_package_assignment'):
+            separate_search_result = self._separate_searches(search_result)
 
         ### Extract other reads which do not have known taxonomy
-        extracted_reads = PipeSequenceExtractor().extract_relevant_reads_from_separate_search_result(
-            self._singlem_package_database, self._num_threads,
-            separate_search_result, include_inserts, known_taxes)
+        with instrumentation.stage('extraction_and_alignment'):
+            extracted_reads = PipeSequenceExtractor().extract_relevant_reads_from_separate_search_result(
+                self._singlem_package_database, self._num_threads,
+                separate_search_result, include_inserts, known_taxes)
+            self._count_extracted_reads(extracted_reads, False)
         logging.info("Finished extracting aligned sequences")
 
         return extracted_reads
@@ -1041,7 +1087,7 @@ class SearchPipe:
             if reverse_read_files is not None:
                 cmd += "--reverse {} ".format(
                     ' '.join(reverse_read_files))
-            extern.run(cmd)
+            instrumentation.run(cmd)
 
         num_singlem_packages = len(singlem_package_database.protein_packages())+\
                                len(singlem_package_database.nucleotide_packages())
@@ -1114,7 +1160,7 @@ class SearchPipe:
                 False,
                 analysing_pairs))
 
-        extern.run_many(commands, num_threads=self._num_threads)
+        instrumentation.run_many(commands, num_threads=self._num_threads)
         return SingleMPipeSeparateSearchResult(
             graftm_separate_directory_base,
             search_result.samples_with_hits(),
@@ -1175,11 +1221,15 @@ class SearchPipe:
 
 
 
-        # Run each one at a time serially so that the number of threads is
-        # respected, to save RAM as one DB needs to be loaded at once, and so
-        # fewer open files are needed, so that the open file count limit is
-        # eased.
+        # DIAMOND is run over chunks of sequences from each package. By
+        # default these are run one at a time serially so that the number of
+        # threads is respected, to save RAM as one DB needs to be loaded at
+        # once, and so fewer open files are needed, so that the open file count
+        # limit is eased. With assignment_threads > 1, that many chunks are run
+        # at once, dividing the threads between them.
         diamond_results = []
+        diamond_queries = []
+        diamond_threads = max(1, self._num_threads // assignment_threads)
         for singlem_package, readsets in extracted_reads.each_package_wise():
             tmp_files = []
             for readset in readsets:
@@ -1279,85 +1329,14 @@ class SearchPipe:
                     SCANN_THEN_DIAMOND_ASSIGNMENT_METHOD,
                     NAIVE_THEN_DIAMOND_ASSIGNMENT_METHOD):
                     
-                    def run_diamond_to_hash(cmd_stub, query, singlem_package):
-                        # Running DIAMOND from here uses too much RAM when there
-                        # are very many sequences to assign taxonomy to (>4000?)
-                        # when RAM is limited as it is in the cloud. So only
-                        # write a limited number of query sequences at a time,
-                        # chunking through.
-
-                        # Run diamond runs per chunk, collecting best hits
+                    def queue_diamond_to_hash(query, singlem_package):
+                        # The query files are queued up here, and run in
+                        # chunks once all packages have been queued. The
+                        # returned dict is filled with the best hits once they
+                        # have been run.
                         best_hits = {}
-
-                        def run_diamond_chunk(query_file_path):
-                            with tempfile.NamedTemporaryFile(prefix='singlem_diamond_assignment_output') as diamond_out:
-                                cmd2 = cmd_stub+"-q '%s' -d '%s' -o %s" % (
-                                    query_file_path, singlem_package.graftm_package().diamond_database_path(), diamond_out.name
-                                )
-                                logging.debug("Running taxonomic assignment command: {}".format(cmd2))
-                                # Run with an output file instead of streaming
-                                # stdout as a potential fix for large runs
-                                # (40Gbp+) e.g. SRR11833493 failing on
-                                # GCP/Terra. That wasn't enough to stop the
-                                # error though.
-                                extern.run(cmd2)
-
-                                chunk_best_hits = {}
-                                chunk_best_hit_bitscores = {}
-
-                                with open(diamond_out.name) as d:
-                                    for row in csv.reader(d, delimiter='\t'):
-                                        if len(row) != 3:
-                                            raise Exception("Unexpected number of CSV row elements detected in line: {}".format(row))
-                                        query = row[0]
-                                        subject = row[1]
-                                        bitscore = float(row[2])
-                                        if query in chunk_best_hit_bitscores: # If already a hit recorded for this sequence
-                                            if bitscore > chunk_best_hit_bitscores[query]:
-                                                raise Exception("Unexpected order of DIAMOND results during taxonomy assignment")
-                                            elif bitscore == chunk_best_hit_bitscores[query]:
-                                                chunk_best_hits[query].append(subject)
-                                            else:
-                                                # Close but no cigar for this hit, not exactly the same bitscore
-                                                pass
-                                        else:
-                                            chunk_best_hits[query] = [subject]
-                                            chunk_best_hit_bitscores[query] = bitscore
-
-                                # Summarise this chunk to LCA
-                                if assignment_method == DIAMOND_EXAMPLE_BEST_HIT_ASSIGNMENT_METHOD:
-                                    for (query, best_hit_ids) in chunk_best_hits.items():
-                                        best_hits[query] = best_hit_ids[0]
-                                elif assignment_method in (
-                                    DIAMOND_ASSIGNMENT_METHOD,
-                                    ANNOY_THEN_DIAMOND_ASSIGNMENT_METHOD,
-                                    SCANN_THEN_DIAMOND_ASSIGNMENT_METHOD,
-                                    NAIVE_THEN_DIAMOND_ASSIGNMENT_METHOD):
-                                    for (query, best_hit_ids) in chunk_best_hits.items():
-                                        best_hits[query] = best_hit_ids
-                                else:
-                                    raise Exception("Programming error")
-
-
-                        with open(query) as query_in:
-                            current_chunk_count = 0
-                            current_chunk_sequences_fh = tempfile.NamedTemporaryFile(prefix='singlem-diamond-chunk')
-                            for (name, seq, _) in SeqReader().readfq(query_in):
-                                current_chunk_count += 1
-                                current_chunk_sequences_fh.write(">{}\n{}\n".format(name, seq).encode())
-                                # If we at the limit, run diamond and collect
-                                if current_chunk_count == 1000:
-                                    current_chunk_sequences_fh.flush()
-                                    run_diamond_chunk(current_chunk_sequences_fh.name)
-                                    current_chunk_sequences_fh.close()
-                                    current_chunk_sequences_fh = tempfile.NamedTemporaryFile(prefix='singlem-diamond-chunk')
-                                    current_chunk_count = 0
-                            if current_chunk_count > 0:
-                                current_chunk_sequences_fh.flush()
-                                run_diamond_chunk(current_chunk_sequences_fh.name)
-                            current_chunk_sequences_fh.close()
-                                
-                            return best_hits
+                        diamond_queries.append((query, singlem_package, best_hits))
+                        return best_hits
 
                     cmd_stub = "diamond blastx " \
                         "--outfmt 6 qseqid sseqid bitscore " \
@@ -1365,27 +1344,26 @@ class SearchPipe:
                         "--evalue 0.01 " \
                         "--threads %i " \
                         "%s " % (
-                            self._num_threads,
+                            diamond_threads,
                             diamond_taxonomy_assignment_performance_parameters)
-                    # Run serially for the moment, coz lazy
                     if extracted_reads.analysing_pairs:
                         forward_results = []
                         reverse_results = []
                         sample_names = []
                         for (sample_name, t0, t1) in tmp_files:
                             sample_names.append(sample_name)
-                            logging.debug("Assigning taxonomy to forward reads file {} ..".format(t0.name))
-                            forward_results.append(run_diamond_to_hash(cmd_stub, t0.name, singlem_package))
-                            logging.debug("Assigning taxonomy to reverse reads file {} ..".format(t1.name))
-                            reverse_results.append(run_diamond_to_hash(cmd_stub, t1.name, singlem_package))
+                            logging.debug("Queueing taxonomy assignment of forward reads file {} ..".format(t0.name))
+                            forward_results.append(queue_diamond_to_hash(t0.name, singlem_package))
+                            logging.debug("Queueing taxonomy assignment of reverse reads file {} ..".format(t1.name))
+                            reverse_results.append(queue_diamond_to_hash(t1.name, singlem_package))
                         diamond_results.append([singlem_package,sample_names,[forward_results,reverse_results]])
                     else:
                         single_results = []
                         sample_names = []
                         for (sample_name, t) in tmp_files:
                             sample_names.append(sample_name)
-                            logging.debug("Assigning taxonomy to single-ended reads file {} ..".format(t.name))
-                            single_results.append(run_diamond_to_hash(cmd_stub, t.name, singlem_package))
+                            logging.debug("Queueing taxonomy assignment of single-ended reads file {} ..".format(t.name))
+                            single_results.append(queue_diamond_to_hash(t.name, singlem_package))
                         diamond_results.append([singlem_package,sample_names,single_results])
 
                 elif assignment_method == PPLACER_ASSIGNMENT_METHOD:
@@ -1418,7 +1396,11 @@ class SearchPipe:
                 else:
                     raise Exception("Programming error")
 
-        extern.run_many(commands, num_threads=assignment_threads)
+        instrumentation.run_many(commands, num_threads=assignment_threads)
+
+        if len(diamond_queries) > 0:
+            self._run_diamond_assignment(
+                diamond_queries, cmd_stub, assignment_method, assignment_threads)
         logging.info("Finished running taxonomic assignment")
         if assignment_method == DIAMOND_ASSIGNMENT_METHOD:
             return DiamondTaxonomicAssignmentResult(diamond_results, extracted_reads.analysing_pairs)
@@ -1437,6 +1419,115 @@ class SearchPipe:
         else:
             raise Exception("Programming error")
 
+    def _run_diamond_assignment(self, diamond_queries, cmd_stub, assignment_method, assignment_threads):
+        '''Run DIAMOND taxonomic assignment on each of diamond_queries, a list
+        of (query FASTA path, singlem_package, best_hits dict to fill).
+
+        Running DIAMOND on all of a query file at once uses too much RAM when
+        there are very many sequences to assign taxonomy to (>4000?) when RAM
+        is limited as it is in the cloud. So only a limited number of query
+        sequences are written to each chunk. With one assignment thread each
+        chunk is run as soon as it is written, otherwise all chunks are written
+        and then run assignment_threads at a time.'''
+        chunk_directory = tempfile.mkdtemp(prefix='diamond_assignment_chunks', dir=self._working_directory)
+        try:
+            diamond_commands = []
+            diamond_chunk_outputs = []
+            for (i, (query, singlem_package, best_hits)) in enumerate(diamond_queries):
+                for chunk_sequences_path in self._write_diamond_assignment_chunks(
+                        query, os.path.join(chunk_directory, 'query{}'.format(i))):
+                    chunk_output_path = chunk_sequences_path + '.diamond_output'
+                    cmd = cmd_stub+"-q '%s' -d '%s' -o %s" % (
+                        chunk_sequences_path, singlem_package.graftm_package().diamond_database_path(), chunk_output_path
+                    )
+                    # Run with an output file instead of streaming stdout as
+                    # a potential fix for large runs (40Gbp+) e.g. SRR11833493
+                    # failing on GCP/Terra. That wasn't enough to stop the
+                    # error though.
+                    logging.debug("Running taxonomic assignment command: {}".format(cmd))
+                    if assignment_threads == 1:
+                        instrumentation.run(cmd)
+                        self._read_diamond_assignment_chunk(chunk_output_path, best_hits, assignment_method)
+                        os.remove(chunk_sequences_path)
+                        os.remove(chunk_output_path)
+                    else:
+                        diamond_commands.append(cmd)
+                        diamond_chunk_outputs.append((chunk_output_path, best_hits))
+
+            if len(diamond_commands) > 0:
+                logging.info("Running {} DIAMOND taxonomic assignment chunk(s) with {} process(es) ..".format(
+                    len(diamond_commands), assignment_threads))
+                instrumentation.run_many(diamond_commands, num_threads=assignment_threads)
+                for (chunk_output_path, best_hits) in diamond_chunk_outputs:
+                    self._read_diamond_assignment_chunk(chunk_output_path, best_hits, assignment_method)
+        finally:
+            shutil.rmtree(chunk_directory)
+
+    def _write_diamond_assignment_chunks(self, query, chunk_path_prefix):
+        '''Split the sequences of the FASTA file query into files of at most
+        1000 sequences with paths starting with chunk_path_prefix, yielding
+        the path of each once it has been written.'''
+        with open(query) as query_in:
+            num_chunks = 0
+            current_chunk_count = 0
+            current_chunk_path = '{}.chunk0.fasta'.format(chunk_path_prefix)
+            current_chunk_sequences_fh = open(current_chunk_path, 'w')
+            for (name, seq, _) in SeqReader().readfq_buffered(query_in):
+                current_chunk_count += 1
+                current_chunk_sequences_fh.write(">{}\n{}\n".format(name, seq))
+                # If we at the limit, hand over the chunk
+                if current_chunk_count == 1000:
+                    current_chunk_sequences_fh.close()
+                    yield current_chunk_path
+                    num_chunks += 1
+                    current_chunk_path = '{}.chunk{}.fasta'.format(chunk_path_prefix, num_chunks)
+                    current_chunk_sequences_fh = open(current_chunk_path, 'w')
+                    current_chunk_count = 0
+            current_chunk_sequences_fh.close()
+            if current_chunk_count > 0:
+                yield current_chunk_path
+            else:
+                os.remove(current_chunk_path)
+
+    def _read_diamond_assignment_chunk(self, diamond_output_path, best_hits, assignment_method):
+        '''Read the output of a DIAMOND taxonomic assignment run on a chunk of
+        sequences, adding the best hits of each query to best_hits.'''
+        chunk_best_hits = {}
+        chunk_best_hit_bitscores = {}
+
+        with open(diamond_output_path) as d:
+            for row in csv.reader(d, delimiter='\t'):
+                if len(row) != 3:
+                    raise Exception("Unexpected number of CSV row elements detected in line: {}".format(row))
+                query = row[0]
+                subject = row[1]
+                bitscore = float(row[2])
+                if query in chunk_best_hit_bitscores: # If already a hit recorded for this sequence
+                    if bitscore > chunk_best_hit_bitscores[query]:
+                        raise Exception("Unexpected order of DIAMOND results during taxonomy assignment")
+                    elif bitscore == chunk_best_hit_bitscores[query]:
+                        chunk_best_hits[query].append(subject)
+                    else:
+                        # Close but no cigar for this hit, not exactly the same bitscore
+                        pass
+                else:
+                    chunk_best_hits[query] = [subject]
+                    chunk_best_hit_bitscores[query] = bitscore
+
+        # Summarise this chunk to LCA
+        if assignment_method == DIAMOND_EXAMPLE_BEST_HIT_ASSIGNMENT_METHOD:
+            for (query, best_hit_ids) in chunk_best_hits.items():
+                best_hits[query] = best_hit_ids[0]
+        elif assignment_method in (
+            DIAMOND_ASSIGNMENT_METHOD,
+            ANNOY_THEN_DIAMOND_ASSIGNMENT_METHOD,
+            SCANN_THEN_DIAMOND_ASSIGNMENT_METHOD,
+            NAIVE_THEN_DIAMOND_ASSIGNMENT_METHOD):
+            for (query, best_hit_ids) in chunk_best_hits.items():
+                best_hits[query] = best_hit_ids
+        else:
+            raise Exception("Programming error")
+
     def _diamond_assign_taxonomy_paired_output_directory(
             self, graftm_align_directory_base, singlem_package, is_forward):
         return "{}/{}_{}".format(
@@ -1,19 +1,27 @@
 import os
 import logging
-import extern
 from Bio import SeqIO
 from io import StringIO
 import multiprocessing
 import itertools
-import tempfile
-
-from graftm.hmmsearcher import HmmSearcher
+import queue
+import collections
+import functools
+from array import array
 
 from .sequence_classes import SeqReader, AlignedProteinSequence, Sequence
 from .metagenome_otu_finder import MetagenomeOtuFinder
 from . import sequence_extractor as singlem_sequence_extractor
 from .streaming_hmm_search_result import StreamingHMMSearchResult
 from .singlem import OrfMUtils
+from . import instrumentation
+
+# Maximum number of sequences from one sample and package given to each
+# hmmalign call. Packages with more sequences than this are split into chunks
+# which are run in parallel, so that one very abundant package does not hold up
+# the whole run. hmmalign can also require a lot more memory than you'd expect,
+# and the amount used increases with amount of sequence provided to it.
+HMMALIGN_CHUNK_SIZE = 5000 #=> Appoximately 100MB of RAM needed
 
 # Must be defined outside a class so that it is pickle-able, so multiprocessing can work
 def _run_individual_extraction(sample_name, singlem_package, sequence_files_for_alignment, separate_search_result, include_inserts, known_taxonomy):
@@ -27,7 +35,7 @@ def _run_individual_extraction(sample_name, singlem_package, sequence_files_for_
     if separate_search_result.analysing_pairs:
         logging.debug("Extracting forward reads")
         if os.path.exists(sequence_files_for_alignment[0]):
-            prots = SeqReader().readfq(open(sequence_files_for_alignment[0]))
+            prots = SeqReader().readfq_buffered(open(sequence_files_for_alignment[0]))
         else:
             prots = []
         readset1 = _extract_reads(
@@ -40,7 +48,7 @@ def _run_individual_extraction(sample_name, singlem_package, sequence_files_for_
             'forward')
         logging.debug("Extracting reverse reads")
         if os.path.exists(sequence_files_for_alignment[1]):
-            prots = SeqReader().readfq(open(sequence_files_for_alignment[1]))
+            prots = SeqReader().readfq_buffered(open(sequence_files_for_alignment[1]))
         else:
             prots = []
         readset2 = _extract_reads(
@@ -54,7 +62,7 @@ def _run_individual_extraction(sample_name, singlem_package, sequence_files_for_
         return [readset1, readset2]
     else:
         if os.path.exists(sequence_files_for_alignment):
-            prots = SeqReader().readfq(open(sequence_files_for_alignment))
+            prots = SeqReader().readfq_buffered(open(sequence_files_for_alignment))
         else:
             prots = []
         readset = _extract_reads(
@@ -138,7 +146,7 @@ def _align_proteins_to_hmm(protein_sequences, hmm_file):
     '''
     cmd = "hmmalign '{}' /dev/stdin".format(hmm_file)
     logging.debug("Running command: {}".format(cmd))
-    output = extern.run(cmd, stdin=''.join([
+    output = instrumentation.run(cmd, stdin=''.join([
         ">{}\n{}\n".format(s[0], s[1]) for s in protein_sequences]))
     logging.debug("Finished command: {}".format(cmd))
     protein_alignment = []
@@ -156,142 +164,235 @@ def _align_proteins_to_hmm(protein_sequences, hmm_file):
 
 def _filter_sequences_through_hmmsearch(
     singlem_package,
-    prefilter_result,
+    read_store,
+    offsets,
     min_orf_length):
-    """Return a generator of Sequence objects that match one or more of the
-    search HMMs in the graftm_package. To save RAM, the full set of sequences is
-    never read in.
+    """Return a generator of the offsets of the sequences at offsets in the
+    ReadStore read_store that match one or more of the search HMMs in the
+    graftm_package.
     """
     
     graftm_package = singlem_package.graftm_package()
-    target_sequence_ids = set(singlem_package.get_sequence_ids())
+    sequences = read_store.sequences(offsets)
+    read_store.close()
 
-    # Can re-use HmmSearcher, useful for when there is >1 search HMM
-    searcher = HmmSearcher(len(graftm_package.search_hmm_paths()), '--domE 1e-5')
-    
-    output_tempfiles = list([
-        tempfile.NamedTemporaryFile(prefix='singlem_hmmsearch') for _ in graftm_package.search_hmm_paths()
-    ])
-    with tempfile.NamedTemporaryFile(prefix='singlem_hmmsearch_input') as input_tf:
-        count, example = _generate_package_specific_fasta_input(target_sequence_ids, prefilter_result, input_tf)
-        logging.debug("Running {} sequences through HMMSEARCH e.g. {}".format(count, example))
-        input_tf.flush()
-        if count == 0:
-            return
-
-        # With some hoop jumping it should be possible to stream this, but eh
-        # for now.
-        searcher.hmmsearch(
-            'orfm -m {} {}'.format(min_orf_length, input_tf.name),
-            graftm_package.search_hmm_paths(),
-            list([tf.name for tf in output_tempfiles]))
-
-    # Stream reading of the hmmout file. Only need the query ID?
+    # Stream the candidate sequences through orfm and hmmsearch, reading the
+    # hits back from its stdout, so the candidates are never written to disk.
+    # Only need the query ID.
     seqs_to_extract = set()
-    for output_tempfile in output_tempfiles:
-        for orfm_seq_id in StreamingHMMSearchResult.yield_from_hmmsearch_table(output_tempfile.name):
-            seqs_to_extract.add(OrfMUtils().un_orfm_name(orfm_seq_id))
-
-    for (qseqid, seq) in _yield_target_sequences(target_sequence_ids, prefilter_result):
-        if qseqid in seqs_to_extract:
-            yield Sequence(qseqid, seq)
-
-def _yield_target_sequences(target_sequence_ids, prefilter_result):
-    with open(prefilter_result.query_sequences_file) as f:
-        for (qseqid, seq, _) in SeqReader().readfq(f):
-            if prefilter_result.best_hits[qseqid] in target_sequence_ids:
-                yield (qseqid, seq)
-
-def _generate_package_specific_fasta_input(
-    target_sequence_ids, prefilter_result, output_io):
-    """Write sequences that are in the prefilter result that match the singlem
-    package to output_io.
+    for orfm_seq_id in _stream_hmmsearch_query_ids(
+            sequences, min_orf_length, graftm_package.search_hmm_paths()):
+        seqs_to_extract.add(OrfMUtils().un_orfm_name(orfm_seq_id))
+    logging.debug("Found {} sequences hitting the search HMMs".format(len(seqs_to_extract)))
+
+    for (offset, s) in zip(offsets, sequences):
+        if s.name in seqs_to_extract:
+            yield offset
+
+def _stream_hmmsearch_query_ids(sequences, min_orf_length, hmm_paths):
+    """Yield the IDs of ORFs which hit any of the HMMs, once for each HMM they
+    hit. The input is written to the stdin of hmmsearch from a separate thread
+    while the domain table is read from its stdout.
+
+    With a single HMM the sequences are piped through orfm into hmmsearch.
+    With several, the sequences are translated by orfm once, and the ORFs are
+    given to each hmmsearch in turn.
     """
-    
-    count = 0
-    example = None
-
-    for (qseqid, seq) in _yield_target_sequences(target_sequence_ids, prefilter_result):
-        count += 1
-        if example is not None:
-            example = qseqid
-        output_io.write(">{}\n{}\n".format(qseqid, seq).encode())
-
-    return count, example
-
-
-def _extract_reads_by_diamond_for_package_and_sample(prefilter_result, spkg,
-    sample_name, min_orf_length, include_inserts):
-
-    # Happens when there is no hits
-    if len(prefilter_result.best_hits) == 0:
-        # Add something so that when analysing pairs and one side has no hits, indexing errors don't happen.
-        return ExtractedReadSet(
-            sample_name, spkg,
-            [], [], []
-        )
-
+    hmmsearch_cmd = "hmmsearch --domE 1e-5 --cpu 1 -o /dev/null --noali --domtblout /dev/stdout '{}' -"
+    logging.debug("Running {} sequences through HMMSEARCH e.g. {}".format(
+        len(sequences), sequences[0].name if len(sequences) > 0 else None))
+
+    if len(hmm_paths) == 1:
+        def write_input(stdin):
+            for s in sequences:
+                stdin.write(">{}\n{}\n".format(s.name, s.seq))
+        cmd = "orfm -m {} | {}".format(min_orf_length, hmmsearch_cmd.format(hmm_paths[0]))
+        yield from StreamingHMMSearchResult.yield_from_hmmsearch_table_stream(
+            instrumentation.stream_output(cmd, stdin_writer=write_input))
+        return
+
+    orfs = instrumentation.run(
+        "orfm -m {}".format(min_orf_length),
+        stdin=''.join(">{}\n{}\n".format(s.name, s.seq) for s in sequences))
+    for hmm_path in hmm_paths:
+        yield from StreamingHMMSearchResult.yield_from_hmmsearch_table_stream(
+            instrumentation.stream_output(
+                hmmsearch_cmd.format(hmm_path), stdin_writer=lambda stdin: stdin.write(orfs)))
+
+def _package_offsets(prefilter_result, package_sequence_ids):
+    '''Return a list with an array of offsets in prefilter_result.read_store()
+    for each package, of the sequences with a best hit to that package. The
+    query sequences file is read once for all packages.
+
+    package_sequence_ids: list of set of str
+        the DIAMOND sequence IDs of each package
+    '''
+    subject_id_to_packages = collections.defaultdict(list)
+    for (i, sequence_ids) in enumerate(package_sequence_ids):
+        for subject_id in sequence_ids:
+            subject_id_to_packages[subject_id].append(i)
+    offsets = [array('Q') for _ in package_sequence_ids]
+    for (offset, _, _, best_hit) in prefilter_result.each_record_with_best_hit():
+        for i in subject_id_to_packages.get(best_hit, []):
+            offsets[i].append(offset)
+    return offsets
+
+def _hmmsearch(read_store, offsets, spkg, min_orf_length):
     # Sequences have to be run through hmmsearch, because sometimes DIAMOND
     # returns some less than good quality hits, and taking those hits directly
-    # to hmmalign causes odd sequences to be counted in.
-    sequences = list(_filter_sequences_through_hmmsearch(
+    # to hmmalign causes odd sequences to be counted in. All of a package's
+    # sequences are searched together, since hmmsearch E-values depend on the
+    # number of sequences searched, so splitting them would change which
+    # sequences pass the E-value cutoff. Only the offsets of the sequences are
+    # returned, so they are not pickled back to the parent process.
+    return array('Q', _filter_sequences_through_hmmsearch(
         spkg,
-        prefilter_result,
+        read_store,
+        offsets,
         min_orf_length))
 
-    # Run orfm |hmmalign
-    #
-    # hmmalign can require a lot more memory than you'd expect, and the amount
-    # used increases with amount of sequence provided to it. To counter this, we
-    # chunk the sequences up only giving hmmalign a subset of sequences at a
-    # time.
-    chunk_size = 5000 #=> Appoximately 100MB of RAM needed
-    window_seqs = []
-    # For each chunk
-    for i in range(0, len(sequences), chunk_size):
-        chunk_sequences = sequences[i:i + chunk_size]
-        cmd = "orfm -m {} | hmmalign '{}' /dev/stdin".format(
-            min_orf_length, spkg.graftm_package().alignment_hmm_path()
-        )
-        stdin = '\n'.join(
-            [">{}\n{}".format(s.name, s.seq) for s in chunk_sequences])
-        logging.debug("Running command: {}, with {} sequences as input".format(cmd, len(chunk_sequences)))
-        output = extern.run(cmd, stdin=">dummy\n{}\n{}".format('A'*min_orf_length,stdin))
-        logging.debug("Finished command: {}".format(cmd))
-
-        # Convert to AlignedProteinSequence
-        protein_alignment = []
-        for record in SeqIO.parse(StringIO(output), 'stockholm'):
-            protein_alignment.append(AlignedProteinSequence(record.name, str(record.seq)))
-
-        if len(protein_alignment) > 0:
-            logging.debug("Read in %i aligned sequences from this chunk e.g. %s %s" % (
-                len(protein_alignment),
-                protein_alignment[0].name,
-                protein_alignment[0].seq))
-        else:
-            logging.debug("No aligned sequences found for this HMM")
-
-        # Extract OTU sequences
-        nucleotide_sequence_hash = {}
-        for s in sequences:
-            nucleotide_sequence_hash[s.name] = s.seq
-        logging.debug("First sequence: {} / {}".format(protein_alignment[0].name, protein_alignment[0].seq))
-        # Window sequences must be found for each chunk, otherwise the
-        # alignments won't line up re insert characters, between chunks.
-        window_seqs.extend(MetagenomeOtuFinder().find_windowed_sequences(
-            protein_alignment,
-            nucleotide_sequence_hash,
-            spkg.window_size(),
-            include_inserts,
-            spkg.is_protein_package(), # Always true
-            best_position=spkg.singlem_position()))
-
-    logging.debug("Found {} window sequences for spkg {}".format(len(window_seqs),spkg.base_directory()))
-    return ExtractedReadSet(
-        sample_name, spkg,
-        sequences, [], window_seqs
+def _hmmalign_chunk(read_store, offsets, spkg, min_orf_length, include_inserts):
+    '''Run orfm | hmmalign on the chunk of sequences at offsets in the
+    ReadStore read_store, returning their window sequences.'''
+    chunk_sequences = read_store.sequences(offsets)
+    read_store.close()
+    cmd = "orfm -m {} | hmmalign '{}' /dev/stdin".format(
+        min_orf_length, spkg.graftm_package().alignment_hmm_path()
     )
+    stdin = '\n'.join(
+        [">{}\n{}".format(s.name, s.seq) for s in chunk_sequences])
+    logging.debug("Running command: {}, with {} sequences as input".format(cmd, len(chunk_sequences)))
+    output = instrumentation.run(cmd, stdin=">dummy\n{}\n{}".format('A'*min_orf_length,stdin))
+    logging.debug("Finished command: {}".format(cmd))
+
+    # Convert to AlignedProteinSequence
+    protein_alignment = []
+    for record in SeqIO.parse(StringIO(output), 'stockholm'):
+        protein_alignment.append(AlignedProteinSequence(record.name, str(record.seq)))
+
+    if len(protein_alignment) > 0:
+        logging.debug("Read in %i aligned sequences from this chunk e.g. %s %s" % (
+            len(protein_alignment),
+            protein_alignment[0].name,
+            protein_alignment[0].seq))
+    else:
+        logging.debug("No aligned sequences found for this HMM")
+
+    # Extract OTU sequences. Window sequences must be found for each chunk,
+    # otherwise the alignments won't line up re insert characters, between
+    # chunks.
+    nucleotide_sequence_hash = {}
+    for s in chunk_sequences:
+        nucleotide_sequence_hash[s.name] = s.seq
+    return MetagenomeOtuFinder().find_windowed_sequences(
+        protein_alignment,
+        nucleotide_sequence_hash,
+        spkg.window_size(),
+        include_inserts,
+        spkg.is_protein_package(), # Always true
+        best_position=spkg.singlem_position())
+
+def _run_chunked_jobs(pool, jobs):
+    '''Run jobs, each a (function, args, on_finish) tuple. on_finish is
+    called in this process with the return value of function(*args), and
+    returns a list of further jobs to run.
+
+    If pool is a multiprocessing pool, the functions are run with it.
+    Workers take the next job from the pool's queue as soon as they finish
+    their last, so that the chunks of large packages are spread over all the
+    threads. Otherwise pool should be None, and the jobs are run serially.
+    '''
+    if pool is None:
+        pending = collections.deque(jobs)
+        while len(pending) > 0:
+            (function, args, on_finish) = pending.popleft()
+            pending.extend(on_finish(function(*args)))
+        return
+
+    finished = queue.Queue()
+    def submit(job):
+        (function, args, on_finish) = job
+        pool.apply_async(function, args=args,
+            callback=lambda result: finished.put((on_finish, result, None)),
+            error_callback=lambda error: finished.put((None, None, error)))
+
+    num_running = 0
+    for job in jobs:
+        submit(job)
+        num_running += 1
+    while num_running > 0:
+        (on_finish, result, error) = finished.get()
+        num_running -= 1
+        if error is not None:
+            raise error
+        for job in on_finish(result):
+            submit(job)
+            num_running += 1
+
+
+class _DiamondPackageExtraction:
+    '''The extraction of the reads of one sample which have a best hit to one
+    SingleM package. Sequences are run through hmmsearch and then orfm |
+    hmmalign in chunks, so that the alignment of abundant packages is spread
+    across threads, and the ExtractedReadSet is set as readset once all
+    chunks have finished. Sequences are passed between processes as offsets
+    into the read store of the prefilter result, rather than pickled.'''
+
+    def __init__(self, prefilter_result, spkg, sample_name, min_orf_length, include_inserts):
+        self._spkg = spkg
+        self._sample_name = sample_name
+        self._min_orf_length = min_orf_length
+        self._include_inserts = include_inserts
+        self._read_store = prefilter_result.read_store()
+        self.readset = None
+
+    def jobs(self, target_offsets):
+        '''Return the hmmsearch job to run, given the offsets in the read
+        store of the sequences with a best hit to the package.'''
+        if len(target_offsets) == 0:
+            # Add something so that when analysing pairs and one side has no
+            # hits, indexing errors don't happen.
+            self.readset = ExtractedReadSet(
+                self._sample_name, self._spkg,
+                [], [], []
+            )
+            return []
+
+        return [(
+            _hmmsearch,
+            (self._read_store, target_offsets, self._spkg, self._min_orf_length),
+            self._finish_hmmsearch)]
+
+    def _finish_hmmsearch(self, offsets):
+        self._offsets = offsets
+        starts = range(0, len(self._offsets), HMMALIGN_CHUNK_SIZE)
+        self._hmmalign_chunk_results = [None] * len(starts)
+        self._num_unfinished_chunks = len(starts)
+        if len(starts) == 0:
+            self._finish()
+        return [(
+            _hmmalign_chunk,
+            (self._read_store, self._offsets[start:start + HMMALIGN_CHUNK_SIZE], self._spkg, self._min_orf_length, self._include_inserts),
+            functools.partial(self._finish_hmmalign_chunk, i))
+            for (i, start) in enumerate(starts)]
+
+    def _finish_hmmalign_chunk(self, chunk_index, window_seqs):
+        self._hmmalign_chunk_results[chunk_index] = window_seqs
+        self._num_unfinished_chunks -= 1
+        if self._num_unfinished_chunks == 0:
+            self._finish()
+        return []
+
+    def _finish(self):
+        window_seqs = list(itertools.chain.from_iterable(self._hmmalign_chunk_results))
+        del self._hmmalign_chunk_results
+        logging.debug("Found {} window sequences for spkg {}".format(len(window_seqs),self._spkg.base_directory()))
+        sequences = self._read_store.sequences(self._offsets)
+        self._read_store.close()
+        self.readset = ExtractedReadSet(
+            self._sample_name, self._spkg,
+            sequences, [], window_seqs
+        )
 
 
 class PipeSequenceExtractor:
@@ -342,79 +443,75 @@ class PipeSequenceExtractor:
         '''
         extracted_reads = ExtractedReads(analysing_pairs)
 
-        if num_threads > 1:
-            # Multiprocessing incurs a RAM overhead, so only do it if required.
-            pool = multiprocessing.Pool(num_threads)
-        else:
-            pool = None
+        # Only sets of the sequence IDs of each package are needed
+        package_sequence_ids = [set(spkg.get_sequence_ids()) for spkg in singlem_package_database]
 
         logging.debug("Aligning and extracting forward reads ..")
-        forward_extraction_process_lists_per_sample = []
+        forward_extractions_per_sample = []
+        jobs = []
         for diamond_search_result in diamond_forward_search_results:
-            extraction_processes = self._extract_relevant_reads_from_diamond_prefilter_from_one_search_result(
-                pool, singlem_package_database, diamond_search_result, include_inserts, min_orf_length
-            )
-            forward_extraction_process_lists_per_sample.append(extraction_processes)
+            (extractions, extraction_jobs) = self._diamond_package_extractions(
+                singlem_package_database, package_sequence_ids, diamond_search_result, include_inserts, min_orf_length)
+            forward_extractions_per_sample.append(extractions)
+            jobs.extend(extraction_jobs)
 
-        logging.debug("Aligning and extracting reverse reads ..")
-        reverse_extraction_process_lists_per_sample = []
+        reverse_extractions_per_sample = []
         if analysing_pairs:
+            logging.debug("Aligning and extracting reverse reads ..")
             for diamond_search_result in diamond_reverse_search_results:
-                extraction_processes = self._extract_relevant_reads_from_diamond_prefilter_from_one_search_result(
-                    pool, singlem_package_database, diamond_search_result, include_inserts, min_orf_length
-                )
-                reverse_extraction_process_lists_per_sample.append(extraction_processes)
+                (extractions, extraction_jobs) = self._diamond_package_extractions(
+                    singlem_package_database, package_sequence_ids, diamond_search_result, include_inserts, min_orf_length)
+                reverse_extractions_per_sample.append(extractions)
+                jobs.extend(extraction_jobs)
+        logging.debug("Running {} hmmsearch jobs".format(len(jobs)))
+
+        if num_threads > 1:
+            # Multiprocessing incurs a RAM overhead, so only do it if required.
+            pool = multiprocessing.Pool(num_threads)
+            try:
+                _run_chunked_jobs(pool, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _run_chunked_jobs(None, jobs)
 
         if analysing_pairs:
-            for (fwds, revs) in zip(forward_extraction_process_lists_per_sample,reverse_extraction_process_lists_per_sample):
+            for (fwds, revs) in zip(forward_extractions_per_sample, reverse_extractions_per_sample):
                 for (fwd, rev) in zip(fwds, revs):
-                    if pool is None:
-                        extracted_reads.add((fwd, rev))
-                    else:
-                        extracted_reads.add((fwd.get(), rev.get()))
+                    extracted_reads.add((fwd.readset, rev.readset))
         else:
-            for fwds in forward_extraction_process_lists_per_sample:
+            for fwds in forward_extractions_per_sample:
                 for fwd in fwds:
-                    if pool is None:
-                        extracted_reads.add(fwd)
-                    else:
-                        extracted_reads.add(fwd.get())
-        if pool is not None:
-            pool.close()
-            pool.join()
+                    extracted_reads.add(fwd.readset)
         logging.debug("Finished aligning and extracting reads")
 
         return extracted_reads
 
-    def _extract_relevant_reads_from_diamond_prefilter_from_one_search_result(
-            self, pool, singlem_package_database, diamond_search_result, include_inserts, min_orf_length):
-        '''Return results for one search result (sample). If pool is a
-        multiprocessing pool, run individual extractions with that, otherwise it
-        should be None, which means just run each extraction serially without
-        invoking multiprocessing at all.
+    def _diamond_package_extractions(
+            self, singlem_package_database, package_sequence_ids, diamond_search_result, include_inserts, min_orf_length):
+        '''Return the extractions for one search result (sample), one for
+        each package, and the jobs needed to run them.
 
-        Returns array of ExtractedReadSet objects or multiprocessing processes
-        that yield those objects.
+        Returns
+        -------
+        (list of _DiamondPackageExtraction, list of jobs for _run_chunked_jobs)
         '''
 
         # Determine sample name. In order to have compatible sample names with
         # the hmmsearch mode, remove filename suffixes.
         sample_name = diamond_search_result.sample_name()
 
-        # Align each read via hmmsearch and pick windowed sequences
-        extraction_of_read_set_processes = []
-        for spkg in singlem_package_database:
-            if pool is None:
-                extraction_of_read_set_processes.append(
-                    _extract_reads_by_diamond_for_package_and_sample(
-                        diamond_search_result, spkg, sample_name, min_orf_length, include_inserts))
-            else:
-                extraction_of_read_set_processes.append(
-                    pool.apply_async(
-                        _extract_reads_by_diamond_for_package_and_sample, args=(
-                    diamond_search_result, spkg, sample_name, min_orf_length, include_inserts)))
+        extractions = []
+        jobs = []
+        for (spkg, target_offsets) in zip(
+                singlem_package_database, _package_offsets(diamond_search_result, package_sequence_ids)):
+            extraction = _DiamondPackageExtraction(
+                diamond_search_result, spkg, sample_name, min_orf_length, include_inserts)
+            jobs.extend(extraction.jobs(target_offsets))
+            extractions.append(extraction)
 
-        return extraction_of_read_set_processes
+        return (extractions, jobs)
 
 
 class ExtractedReads:
@@ -16,6 +16,7 @@ from .sequence_database import SequenceDatabase
 from . import sequence_database
 from .singlem_database_models import *
 from .sequence_classes import SeqReader
+from .hamming import paired_hamming_distances
 from .query_formatters import SparseResultFormatter
 from .otu_table_collection import OtuTableCollection
 from .otu_table_entry import OtuTableEntry
@@ -169,41 +170,44 @@ class Querier:
         if max_search_nearest_neighbours is None:
             max_search_nearest_neighbours = max_nearest_neighbours
 
-        last_marker = None
-        index = None
-        for q in queries:
-            if q.marker != last_marker:
-                del index
-                last_marker = q.marker
-                index = sdb.get_sequence_index(last_marker, 'nmslib', sequence_type)
-                if index is None:
-                    raise Exception("The marker '{}' does not appear to be in the singlem db".format(last_marker))
-                logging.info("Querying index for {}".format(last_marker))
-                query = select([Marker.id]).where(Marker.marker == last_marker)
-                m = sdb.sqlalchemy_connection.execute(query).first()
-                if m is None:
-                    raise Exception("Marker {} not in the SQL DB".format(last_marker))
-                last_marker_id = m['id']
-
-            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                query_protein_sequence = None
-                kNN = index.knnQuery(sequence_database.nucleotides_to_binary(q.sequence), max_search_nearest_neighbours)
-            elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
-                kNN = index.knnQuery(sequence_database.protein_to_binary(query_protein_sequence), max_search_nearest_neighbours)
-            else:
-                raise Exception("Unexpected sequence_type")
-
-            num_reported = 0
-            for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
-                div = int(hamming_distance / 2)
-                if max_divergence is None or div <= max_divergence:
-                    for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, last_marker, last_marker_id, div, query_protein_sequence=query_protein_sequence, limit_per_sequence=limit_per_sequence):
-                        yield qres
-                    num_reported += 1
-                    if num_reported >= max_nearest_neighbours:
+        for marker, marker_queries in itertools.groupby(queries, lambda x: x.marker):
+            index = sdb.get_sequence_index(marker, 'nmslib', sequence_type)
+            if index is None:
+                raise Exception("The marker '{}' does not appear to be in the singlem db".format(marker))
+            logging.info("Querying index for {}".format(marker))
+            query = select([Marker.id]).where(Marker.marker == marker)
+            m = sdb.sqlalchemy_connection.execute(query).first()
+            if m is None:
+                raise Exception("Marker {} not in the SQL DB".format(marker))
+            marker_id = m['id']
+
+            for chunked_queries in iterable_chunks(marker_queries, 1000):
+                hits_to_fetch = []
+                for q in chunked_queries:
+                    if q is None: # Trailing Nones from the iterable
                         break
 
+                    if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                        query_protein_sequence = None
+                        kNN = index.knnQuery(sequence_database.nucleotides_to_binary(q.sequence), max_search_nearest_neighbours)
+                    elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+                        query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
+                        kNN = index.knnQuery(sequence_database.protein_to_binary(query_protein_sequence), max_search_nearest_neighbours)
+                    else:
+                        raise Exception("Unexpected sequence_type")
+
+                    num_reported = 0
+                    for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
+                        div = int(hamming_distance / 2)
+                        if max_divergence is None or div <= max_divergence:
+                            hits_to_fetch.append((q, hit_index, div, query_protein_sequence))
+                            num_reported += 1
+                            if num_reported >= max_nearest_neighbours:
+                                break
+
+                for qres in self.query_results_from_db_batched(sdb, hits_to_fetch, sequence_type, marker, marker_id, limit_per_sequence=limit_per_sequence, max_divergence=max_divergence):
+                    yield qres
+            del index
 
     def query_by_sequence_similarity_with_scann(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, naive=False, preload_db=False, max_search_nearest_neighbours=None, limit_per_sequence=None):
         if naive:
@@ -265,20 +269,22 @@ class Querier:
 
             # Actually do searches, in batches
             for chunked_queries1 in iterable_chunks(marker_queries, 1000):
+                hits_to_fetch = []
+                preloaded_results = []
                 chunked_queries = list([a for a in chunked_queries1 if a is not None]) # Remove trailing Nones from the iterable
 
                 if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                    query_array = np.array([
-                        np.array(sequence_database.nucleotides_to_binary_array(q.sequence)) for q in chunked_queries])
+                    query_array = sequence_database.nucleotides_to_binary_matrix(
+                        [q.sequence for q in chunked_queries], dtype=np.float32)
                 elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
                     query_protein_sequences = np.array([
                         sequence_database.nucleotides_to_protein(q.sequence) for q in chunked_queries])
-                    query_array = np.array([
-                        np.array(sequence_database.protein_to_binary_array(seq)) for seq in query_protein_sequences])
+                    query_array = sequence_database.protein_to_binary_matrix(
+                        query_protein_sequences, dtype=np.float32)
                 else:
                     raise Exception("Unexpected sequence_type")
 
-                normed = np.array([qa / np.linalg.norm(qa) for qa in query_array])
+                normed = query_array / np.linalg.norm(query_array, axis=1)[:, np.newaxis]
                 kNN_batch = index.search_batched_parallel(normed, max_search_nearest_neighbours)
 
                 for i, q in enumerate(chunked_queries):
@@ -294,23 +300,6 @@ class Querier:
                         else:
                             div = round((1.0-float(dist))*len(query_protein_sequences[0])) # Not sure why this is necessary, why doesn't it return a real distance?
 
-                        ## DEBUG if statement
-                        # if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                        #     if current_preloaded_db is not None:
-                        #         subject_seq = list(current_preloaded_db.loc[[hit_index]].iterrows())[0][1].nucleotide_sequence
-                        #     else:
-                        #         subject_seq = list(self.query_result_from_db(sdb, q, sequence_type, hit_index, marker, marker_id, div, query_protein_sequence=query_protein_sequence))[0].nucleotide_sequence
-                        #     if div != self.divergence(q.sequence, subject_seq):
-                        #         import IPython; IPython.embed()
-                        # else:
-                        #     if current_preloaded_db is not None:
-                        #         subject_seq = list(current_preloaded_db.loc[[hit_index]].iterrows())[0][1].protein_sequence
-                        #         # print(query_protein_sequence, list(current_preloaded_db.loc[[hit_index]].iterrows())[0][1].protein_sequence, div)
-                        #     else:
-                        #         subject_seq = list(self.query_result_from_db(sdb, q, sequence_type, hit_index, marker, marker_id, div, query_protein_sequence=query_protein_sequence))[0].subject_protein_sequence
-                        #     if div != self.divergence(query_protein_sequence, subject_seq):
-                        #         import IPython; IPython.embed()
-
                         if max_divergence is None or div <= max_divergence:
                             if preload_db:
                                 hit_index = int(hit_index) # Needed only for tiny databases?
@@ -326,70 +315,88 @@ class Querier:
                                     otu.coverage = current_preloaded_db_coverage[entry_i]
                                     otu.taxonomy = current_preloaded_db_taxonomy[entry_i]
                                     if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                                        yield QueryResult(q, otu, div)
+                                        preloaded_results.append(QueryResult(q, otu, div))
                                     else:
-                                        yield QueryResult(
+                                        preloaded_results.append(QueryResult(
                                             q, otu, div, 
                                             query_protein_sequence=query_protein_sequences[i],
-                                            subject_protein_sequence=current_preloaded_db_protein_sequence[entry_i])
+                                            subject_protein_sequence=current_preloaded_db_protein_sequence[entry_i]))
                             else:
-                                for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, marker, marker_id, div, 
-                                    query_protein_sequence=query_protein_sequences[i] if sequence_type == SequenceDatabase.PROTEIN_TYPE else None,
-                                    limit_per_sequence=limit_per_sequence):
-
-                                    yield qres
+                                hits_to_fetch.append((q, hit_index, div,
+                                    query_protein_sequences[i] if sequence_type == SequenceDatabase.PROTEIN_TYPE else None))
                             num_reported += 1
                             if num_reported >= max_nearest_neighbours:
                                 break
 
+                for qres in self._with_exact_divergences(preloaded_results, max_divergence):
+                    yield qres
+                for qres in self.query_results_from_db_batched(sdb, hits_to_fetch, sequence_type, marker, marker_id, limit_per_sequence=limit_per_sequence, max_divergence=max_divergence):
+                    yield qres
+
     def query_by_sequence_similarity_with_annoy(self, queries, sdb, max_divergence, sequence_type, max_nearest_neighbours, max_search_nearest_neighbours=None, limit_per_sequence=None):
         logging.info("Searching with annoy by {} sequence ..".format(sequence_type))
 
         if max_search_nearest_neighbours is None:
             max_search_nearest_neighbours = max_nearest_neighbours
 
-        last_marker = None
-        last_marker_id = None
-        index = None
-        for q in queries:
-            if q.marker != last_marker:
-                del index
-                last_marker = q.marker
-                index = sdb.get_sequence_index(last_marker, 'annoy', sequence_type)
-                if index is None:
-                    raise Exception("The marker '{}' does not appear to be in the singlem db".format(last_marker))
-                logging.info("Querying index for {}".format(last_marker))
-                query = select([Marker.id]).where(Marker.marker == last_marker)
-                m = sdb.sqlalchemy_connection.execute(query).first()
-                if m is None:
-                    raise Exception("Marker {} not in the SQL DB".format(last_marker))
-                last_marker_id = m['id']
-
-            if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-                query_protein_sequence = None
-                kNN = index.get_nns_by_vector(sequence_database.nucleotides_to_binary_array(q.sequence), max_search_nearest_neighbours, include_distances=True)
-            elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-                query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
-                kNN = index.get_nns_by_vector(sequence_database.protein_to_binary_array(query_protein_sequence), max_search_nearest_neighbours, include_distances=True)
-            else:
-                raise Exception("Unexpected sequence_type")
-
-            num_reported = 0
-            for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
-                div = int(hamming_distance / 2)
-                if max_divergence is None or div <= max_divergence:
-                    for qres in self.query_result_from_db(sdb, q, sequence_type, hit_index, last_marker, last_marker_id, div, query_protein_sequence=query_protein_sequence, limit_per_sequence=limit_per_sequence):
-                        yield qres
-                    num_reported += 1
-                    if num_reported >= max_nearest_neighbours:
+        for marker, marker_queries in itertools.groupby(queries, lambda x: x.marker):
+            index = sdb.get_sequence_index(marker, 'annoy', sequence_type)
+            if index is None:
+                raise Exception("The marker '{}' does not appear to be in the singlem db".format(marker))
+            logging.info("Querying index for {}".format(marker))
+            query = select([Marker.id]).where(Marker.marker == marker)
+            m = sdb.sqlalchemy_connection.execute(query).first()
+            if m is None:
+                raise Exception("Marker {} not in the SQL DB".format(marker))
+            marker_id = m['id']
+
+            for chunked_queries in iterable_chunks(marker_queries, 1000):
+                hits_to_fetch = []
+                for q in chunked_queries:
+                    if q is None: # Trailing Nones from the iterable
                         break
 
-    def query_result_from_db(self, sdb, query, sequence_type, hit_index, marker, marker_id, div, query_protein_sequence=None, limit_per_sequence=None):
-        if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
-            query2 = select(
-                Otu.marker_id, Otu.sample_name, Otu.sequence, Otu.num_hits, Otu.coverage, Otu.taxonomy_id
-            ).where(Otu.marker_wise_sequence_id == int(hit_index)).where(Otu.marker_id == int(marker_id)).limit(limit_per_sequence)
-            for row in sdb.sqlalchemy_connection.execute(query2):
+                    if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                        query_protein_sequence = None
+                        kNN = index.get_nns_by_vector(sequence_database.nucleotides_to_binary_array(q.sequence), max_search_nearest_neighbours, include_distances=True)
+                    elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+                        query_protein_sequence = sequence_database.nucleotides_to_protein(q.sequence)
+                        kNN = index.get_nns_by_vector(sequence_database.protein_to_binary_array(query_protein_sequence), max_search_nearest_neighbours, include_distances=True)
+                    else:
+                        raise Exception("Unexpected sequence_type")
+
+                    num_reported = 0
+                    for (hit_index, hamming_distance) in zip(kNN[0], kNN[1]):
+                        div = int(hamming_distance / 2)
+                        if max_divergence is None or div <= max_divergence:
+                            hits_to_fetch.append((q, hit_index, div, query_protein_sequence))
+                            num_reported += 1
+                            if num_reported >= max_nearest_neighbours:
+                                break
+
+                for qres in self.query_results_from_db_batched(sdb, hits_to_fetch, sequence_type, marker, marker_id, limit_per_sequence=limit_per_sequence, max_divergence=max_divergence):
+                    yield qres
+            del index
+
+    def query_results_from_db_batched(self, sdb, hits, sequence_type, marker, marker_id, limit_per_sequence=None, max_divergence=None):
+        """Yield a QueryResult for each OTU of each hit within max_divergence
+        of its query. hits is a list of (query, hit_index, divergence,
+        query_protein_sequence) tuples, all against the same marker. The OTUs
+        of all hit sequences are retrieved with one batch lookup rather than
+        one query per hit, and results are yielded in the same order as the
+        hits."""
+        otus = sdb.otus_by_marker_wise_ids(
+            marker_id, set([int(hit[1]) for hit in hits]), sequence_type, limit_per_sequence=limit_per_sequence)
+
+        # Hits absent from the SQL DB e.g. SCANN dummy sequences for very
+        # small indices are simply never added here.
+        hit_index_to_rows = {}
+        for row in otus.itertuples(index=False):
+            hit_index_to_rows.setdefault(row.marker_wise_id, []).append(row)
+
+        results = []
+        for (query, hit_index, div, query_protein_sequence) in hits:
+            for row in hit_index_to_rows.get(int(hit_index), []):
                 otu = OtuTableEntry()
                 otu.marker = marker
                 otu.sample_name = row.sample_name
@@ -397,43 +404,41 @@ class Querier:
                 otu.sequence = row.sequence
                 otu.coverage = row.coverage
                 otu.taxonomy = sdb.get_taxonomy_via_cache(row.taxonomy_id)
-                yield QueryResult(query, otu, div)
-
-        elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
-            query2 = select([
-                Otu.sequence,
-                ProteinSequence.protein_sequence,
-                Otu.sample_name,
-                Otu.num_hits,
-                Otu.coverage,
-                Otu.taxonomy_id]) \
-                    .where(Otu.taxonomy_id == Taxonomy.id) \
-                    .where(Otu.marker_id == marker_id) \
-                    .where(NucleotidesProteins.nucleotide_id == Otu.sequence_id) \
-                    .where(NucleotidesProteins.protein_id == ProteinSequence.id) \
-                    .where(ProteinSequence.marker_wise_id == int(hit_index)) \
-                    .where(Otu.marker_id == marker_id)
-            if limit_per_sequence is not None:
-                query2 = query2.limit(limit_per_sequence)
-
-            results = sdb.sqlalchemy_connection.execute(query2)
-
-            if results is None and hit_index <= 16:
-                # For very small indexes, SCANN can have dummy sequences that
-                # are not in the SQL DB. Ignore these.
-                pass
-            else:
-                for entry in results:
-                    otu = OtuTableEntry()
-                    otu.marker = marker
-                    otu.sample_name = entry['sample_name']
-                    otu.sequence = entry['sequence']
-                    otu.count = entry['num_hits']
-                    otu.coverage = entry['coverage']
-                    otu.taxonomy = sdb.get_taxonomy_via_cache(entry['taxonomy_id'])
-                    yield QueryResult(query, otu, div, query_protein_sequence=query_protein_sequence, subject_protein_sequence=entry['protein_sequence'])
-        else:
-            raise Exception("unknown sequence_type")
+                if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+                    results.append(QueryResult(query, otu, div))
+                else:
+                    results.append(QueryResult(query, otu, div, query_protein_sequence=query_protein_sequence, subject_protein_sequence=row.protein_sequence))
+        for qres in self._with_exact_divergences(results, max_divergence):
+            yield qres
+
+    def _with_exact_divergences(self, results, max_divergence):
+        """Return the QueryResults whose query and subject sequences differ
+        by no more than max_divergence (or all of them if max_divergence is
+        None), with their divergence set to the number of differences.
+
+        The divergence from the index is only an estimate for some index
+        types, so the sequences of every candidate hit are compared again, in
+        bulk for each sequence length. Results whose query and subject
+        sequences differ in length keep the divergence from the index."""
+        def sequences(result):
+            if result.query_protein_sequence is not None:
+                return (result.query_protein_sequence, result.subject_protein_sequence)
+            return (result.query.sequence, result.subject.sequence)
+
+        indices_by_length = {}
+        for i, result in enumerate(results):
+            (query_sequence, subject_sequence) = sequences(result)
+            if len(query_sequence) == len(subject_sequence):
+                indices_by_length.setdefault(len(query_sequence), []).append(i)
+        for indices in indices_by_length.values():
+            pairs = [sequences(results[i]) for i in indices]
+            divergences = paired_hamming_distances(
+                [p[0] for p in pairs], [p[1] for p in pairs])
+            for (i, div) in zip(indices, divergences.tolist()):
+                results[i].divergence = div
+
+        return [result for result in results
+            if max_divergence is None or result.divergence <= max_divergence]
 
     def divergence(self, seq1, seq2):
         """Return the number of bases two sequences differ by"""
@@ -441,45 +446,29 @@ class Querier:
             raise Exception(
                 "Attempted comparison of two OTU sequences with differing lengths: {} and {}" \
                 .format(seq1, seq2))
-        d = 0
-        for (a, b) in zip(seq1, seq2):
-            if a != b: d += 1
-        return d
+        return int(paired_hamming_distances([seq1], [seq2])[0])
 
 
     def query_by_sqlite(self, queries, db):
-        max_set_size = 999 # Cannot query sqlite with > 999 '?' entries, so
-                           # query in batches.
         sequence_to_query_id = {}
         queries_list = list(queries)
-        seqs = set()
         for i, query in enumerate(queries_list):
-            seqs.add(query.sequence)
             try:
                 sequence_to_query_id[query.sequence].append(i)
             except KeyError:
                 sequence_to_query_id[query.sequence] = [i]
 
-        for chunk in iterable_chunks(seqs, max_set_size):
-            with db.engine.connect() as connection:
-                stmt = select([
-                    Otu.sample_name,
-                    Otu.num_hits,
-                    Otu.coverage,
-                    Otu.taxonomy_id,
-                    NucleotideSequence.sequence,
-                    Marker.marker,
-                    ]).select_from(Otu).join(NucleotideSequence).join(Marker).filter(NucleotideSequence.sequence.in_([seq for seq in chunk if seq is not None]))
-                for entry in connection.execute(stmt):
-                    for qid in sequence_to_query_id[entry.sequence]:
-                        otu = OtuTableEntry()
-                        otu.marker = entry.marker
-                        otu.sample_name = entry.sample_name
-                        otu.sequence = entry.sequence
-                        otu.count = entry.num_hits
-                        otu.coverage = entry.coverage
-                        otu.taxonomy = db.get_taxonomy_via_cache(entry.taxonomy_id)
-                        yield QueryResult(queries_list[qid], otu, 0)
+        for otus in db.otus_by_sequences(sequence_to_query_id.keys()):
+            for entry in otus.itertuples(index=False):
+                for qid in sequence_to_query_id[entry.sequence]:
+                    otu = OtuTableEntry()
+                    otu.marker = entry.marker
+                    otu.sample_name = entry.sample_name
+                    otu.sequence = entry.sequence
+                    otu.count = entry.num_hits
+                    otu.coverage = entry.coverage
+                    otu.taxonomy = db.get_taxonomy_via_cache(entry.taxonomy_id)
+                    yield QueryResult(queries_list[qid], otu, 0)
 
     def print_samples(self, **kwargs):
         db = SequenceDatabase.acquire(kwargs.pop('db'), min_version=5)
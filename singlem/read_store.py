@@ -0,0 +1,76 @@
+import mmap
+import os
+
+from .sequence_classes import Sequence
+
+
+class ReadStore:
+    '''A FASTA file with each record on exactly two lines, as written by the
+    DIAMOND prefilter, memory-mapped so that sequences can be read by the byte
+    offset of their record.
+
+    Only the path is pickled, so a ReadStore and offsets into it can be passed
+    to multiprocessing workers instead of the sequences themselves. Each
+    process maps the file separately, and the operating system shares the
+    pages between them.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _data(self):
+        if self._mmap is None:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # Empty files cannot be mapped
+                    self._mmap = b''
+                else:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._mmap = None
+
+    def _record_at(self, data, offset):
+        '''Return (name, sequence, offset of the next record)'''
+        if data[offset:offset+1] != b'>':
+            raise Exception("Unexpected record at offset {} of {}".format(offset, self.path))
+        name_end = data.find(b'\n', offset)
+        sequence_end = data.find(b'\n', name_end + 1)
+        if sequence_end == -1:
+            sequence_end = len(data)
+        return (
+            data[offset+1:name_end].decode(),
+            data[name_end+1:sequence_end].decode(),
+            sequence_end + 1)
+
+    def each(self):
+        '''Yield (offset, name, sequence) for each record in the file'''
+        data = self._data()
+        offset = 0
+        while offset < len(data):
+            (name, seq, next_offset) = self._record_at(data, offset)
+            yield (offset, name, seq)
+            offset = next_offset
+
+    def sequence(self, offset):
+        '''Return the Sequence whose record starts at offset'''
+        (name, seq, _) = self._record_at(self._data(), offset)
+        return Sequence(name, seq)
+
+    def sequences(self, offsets):
+        '''Return a list of the Sequence objects at each of the offsets'''
+        data = self._data()
+        sequences = []
+        for offset in offsets:
+            (name, seq, _) = self._record_at(data, offset)
+            sequences.append(Sequence(name, seq))
+        return sequences
@@ -13,7 +13,7 @@ from .singlem_package import SingleMPackageVersion4, SingleMPackage
 from .sequence_classes import SeqReader, Sequence
 from .dereplicator import Dereplicator
 from .sequence_extractor import SequenceExtractor
-from .metagenome_otu_finder import MetagenomeOtuFinder
+from .window_cache import WindowCache
 from .pipe_sequence_extractor import _align_proteins_to_hmm
 
 
@@ -131,16 +131,11 @@ class Regenerator:
         stretch_length = original_pkg.window_size() / 3
         trimmed_output = []
         
-        ignored_columns = MetagenomeOtuFinder()._find_lower_case_columns(tmp_alignment)
-        logging.debug("Ignoring columns %s", str(ignored_columns))
-        # Find start of window in aligned sequence
-        start_position = MetagenomeOtuFinder()._upper_case_position_to_alignment_position(
-            best_position, ignored_columns)
-        logging.debug("Using pre-defined best section of the alignment starting from %i" % (start_position + 1))
-        # Find all positions in the window
-        chosen_positions = MetagenomeOtuFinder()._best_position_to_chosen_positions(
-            start_position, stretch_length, ignored_columns)
-        logging.debug("Found chosen positions %s", chosen_positions)
+        checksum = WindowCache.checksum(
+            [os.path.join(final_gpkg, unaligned_basename), output_gpkg.alignment_hmm_path()],
+            'window_columns', best_position, stretch_length)
+        _, chosen_positions = WindowCache(original_pkg.window_cache_path()).window_columns(
+            checksum, tmp_alignment, best_position, stretch_length)
         
         for aligned_sequence in tmp_alignment:
             windowed_residues = aligned_sequence.seq[min(chosen_positions):1+max(chosen_positions)].replace('-','')
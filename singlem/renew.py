@@ -52,78 +52,74 @@ class Renew:
             len(marker_name_to_spkg),
             list(marker_name_to_spkg.keys())[0]))
 
-        # Read in archive OTU table, requiring a minimum version
-        #
-        # TODO: Probably this can converted to a streaming input, following
-        # https://stackoverflow.com/questions/54560154/streaming-json-parser
+        # Stream in archive OTU table, requiring a minimum version
         logging.info("Reading in archive OTU table ..")
-        with open(input_archive_otu_table) as f:
-            input_otus = ArchiveOtuTable.read(f)
-        if input_otus.version < 2:
-            raise Exception("Currently only version 2+ archive otu tables are supported")
-        logging.info("Read in {} OTUs".format(len(input_otus.data)))        
-        
-        # Generate ExtractedReads. Never analysing pairs because no 2 reads with
-        # the same name should be in the same OTU.
-        extracted_reads = ExtractedReads(False)
-
-        class State:
-            def __init__(self, marker_name_to_spkg):
-                self.marker_name_to_spkg = marker_name_to_spkg
-                self.reset()
-
-            def reset(self):
-                self.current_singlem_package = None
-                self.current_sample_name = None
-                self.current_sequences = []
-                self.current_unaligned_aligned_nuc_seqs = []
-
-        last_marker_and_sample = None
-        state = State(marker_name_to_spkg)
-
-        def process_otu_batch(state):
-            extracted_reads.add(ExtractedReadSet(
-                state.current_sample_name,
-                state.marker_name_to_spkg[state.current_marker_name],
-                state.current_sequences,
-                [],
-                state.current_unaligned_aligned_nuc_seqs))
-
-        read_unaligned_sequences_field = ArchiveOtuTable.FIELDS_VERSION2.index('read_unaligned_sequences')
-        nucleotides_aligned_field = ArchiveOtuTable.FIELDS_VERSION2.index('nucleotides_aligned')
-
-        for otu in input_otus:
-            # Ensure that the packages in the archive exist
-            if not otu.marker in marker_name_to_spkg:
-                raise Exception("Found marker '{}' that was not one of the specified singlem packages".format(otu.marker))
-
-            marker_and_sample = [otu.marker, otu.sample_name]
-            if marker_and_sample != last_marker_and_sample:
-                if last_marker_and_sample is not None:
-                    process_otu_batch(state)
-                    state.reset()
-                last_marker_and_sample = marker_and_sample
-
-            state.current_marker_name = otu.marker
-            state.current_sample_name = otu.sample_name
-
-            read_names = otu.read_names()
-            seqs = otu.data[read_unaligned_sequences_field]
-            nucleotides_aligned = otu.data[nucleotides_aligned_field]
-            if len(read_names) != len(nucleotides_aligned) or len(seqs) != len(nucleotides_aligned):
-                raise Exception("Unexpected format of otu found: {}".format(otu))
-            for (name, seq, num_aligned) in zip(read_names, seqs, nucleotides_aligned):
-                state.current_sequences.append(Sequence(name, seq))
-                state.current_unaligned_aligned_nuc_seqs.append(
-                    UnalignedAlignedNucleotideSequence(
-                        name, None, otu.sequence, seq, num_aligned))
-        
-        # process last batch
-        if last_marker_and_sample is not None:
-            process_otu_batch(state)
-
-        # To save RAM (untested)
-        del input_otus
+        with open(input_archive_otu_table) as input_otus_io:
+            input_otus = ArchiveOtuTable.read_streaming(input_otus_io)
+            if input_otus.version < 2:
+                raise Exception("Currently only version 2+ archive otu tables are supported")
+
+            # Generate ExtractedReads. Never analysing pairs because no 2 reads with
+            # the same name should be in the same OTU.
+            extracted_reads = ExtractedReads(False)
+
+            class State:
+                def __init__(self, marker_name_to_spkg):
+                    self.marker_name_to_spkg = marker_name_to_spkg
+                    self.reset()
+
+                def reset(self):
+                    self.current_singlem_package = None
+                    self.current_sample_name = None
+                    self.current_sequences = []
+                    self.current_unaligned_aligned_nuc_seqs = []
+
+            last_marker_and_sample = None
+            state = State(marker_name_to_spkg)
+
+            def process_otu_batch(state):
+                extracted_reads.add(ExtractedReadSet(
+                    state.current_sample_name,
+                    state.marker_name_to_spkg[state.current_marker_name],
+                    state.current_sequences,
+                    [],
+                    state.current_unaligned_aligned_nuc_seqs))
+
+            read_unaligned_sequences_field = ArchiveOtuTable.FIELDS_VERSION2.index('read_unaligned_sequences')
+            nucleotides_aligned_field = ArchiveOtuTable.FIELDS_VERSION2.index('nucleotides_aligned')
+
+            num_otus = 0
+            for otu in input_otus:
+                num_otus += 1
+                # Ensure that the packages in the archive exist
+                if not otu.marker in marker_name_to_spkg:
+                    raise Exception("Found marker '{}' that was not one of the specified singlem packages".format(otu.marker))
+
+                marker_and_sample = [otu.marker, otu.sample_name]
+                if marker_and_sample != last_marker_and_sample:
+                    if last_marker_and_sample is not None:
+                        process_otu_batch(state)
+                        state.reset()
+                    last_marker_and_sample = marker_and_sample
+
+                state.current_marker_name = otu.marker
+                state.current_sample_name = otu.sample_name
+
+                read_names = otu.read_names()
+                seqs = otu.data[read_unaligned_sequences_field]
+                nucleotides_aligned = otu.data[nucleotides_aligned_field]
+                if len(read_names) != len(nucleotides_aligned) or len(seqs) != len(nucleotides_aligned):
+                    raise Exception("Unexpected format of otu found: {}".format(otu))
+                for (name, seq, num_aligned) in zip(read_names, seqs, nucleotides_aligned):
+                    state.current_sequences.append(Sequence(name, seq))
+                    state.current_unaligned_aligned_nuc_seqs.append(
+                        UnalignedAlignedNucleotideSequence(
+                            name, None, otu.sequence, seq, num_aligned))
+
+            # process last batch
+            if last_marker_and_sample is not None:
+                process_otu_batch(state)
+        logging.info("Read in {} OTUs".format(num_otus))
 
         # Assign taxonomy and process
         pipe = SearchPipe()
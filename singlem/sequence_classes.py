@@ -1,10 +1,24 @@
 from Bio.Seq import Seq
+import gzip
+import io
+import itertools
 import logging
 import re
 
 from .singlem import OrfMUtils
 
 
+class _SourceClosingGzipFile(gzip.GzipFile):
+    '''A GzipFile which closes the file object it reads from when closed'''
+    def close(self):
+        source = self.fileobj
+        try:
+            super().close()
+        finally:
+            if source is not None:
+                source.close()
+
+
 class Sequence:
     '''Simple name+sequence object'''
     def __init__(self, name, seq):
@@ -69,6 +83,10 @@ class UnalignedAlignedNucleotideSequence:
 
 
 class SeqReader:
+    DEFAULT_BATCH_SIZE = 10000
+    CHUNK_SIZE = 4*1024*1024
+    _HEADER_DESCRIPTION_REGEX = re.compile(' [^\n]*')
+
     # Stolen from https://github.com/lh3/readfq/blob/master/readfq.py
     def readfq(self, fp): # this is a generator function
         last = None # this is a buffer keeping the last unprocessed line
@@ -101,16 +119,145 @@ class SeqReader:
                     yield name, seq, None # yield a fasta record instead
                     break
 
+    def readfq_batches(self, fp, batch_size=None):
+        '''Like readfq, but yield lists of up to batch_size (name, seq, qual)
+        tuples. The file is read in large chunks which are split into records
+        with str methods rather than line by line, which is much faster. FASTQ
+        files with records not on exactly 4 lines are parsed with readfq from
+        the first such record onwards.'''
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE
+        batch = []
+        for records in self._each_chunk_of_records(fp):
+            batch.extend(records)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if len(batch) > 0:
+            yield batch
+
+    def readfq_buffered(self, fp):
+        '''Yield (name, seq, qual) tuples like readfq, but parsed with
+        readfq_batches.'''
+        for batch in self.readfq_batches(fp):
+            for record in batch:
+                yield record
+
+    @staticmethod
+    def open_sequence_file(path):
+        '''Open a FASTA/FASTQ file for reading as text, decompressing it if it
+        is gzipped. The file is only opened once, so named pipes can be read
+        too.'''
+        f = open(path, 'rb')
+        if f.peek(2)[:2] == b'\x1f\x8b':
+            return io.TextIOWrapper(_SourceClosingGzipFile(fileobj=f))
+        return io.TextIOWrapper(f)
+
+    def _each_chunk_of_records(self, fp):
+        '''Yield lists of (name, seq, qual) tuples parsed from successive
+        chunks of fp.'''
+        remainder = ''
+        is_fastq = None
+        while True:
+            chunk = fp.read(self.CHUNK_SIZE)
+            at_eof = len(chunk) == 0
+            buffer = remainder + chunk
+            remainder = ''
+
+            if is_fastq is None:
+                buffer = buffer.lstrip()
+                if buffer == '':
+                    if at_eof:
+                        return
+                    continue
+                if buffer[0] not in '>@':
+                    # Unusual leading lines, which readfq skips over
+                    yield from self._each_list_of_readfq_records(
+                        itertools.chain(io.StringIO(buffer + fp.readline()), fp))
+                    return
+                is_fastq = buffer[0] == '@'
+
+            if is_fastq:
+                lines = buffer.split('\n')
+                if at_eof:
+                    if lines[-1] == '':
+                        lines.pop()
+                    last_line = None
+                else:
+                    last_line = lines.pop()
+                num_complete_lines = len(lines) // 4 * 4
+                headers = lines[0:num_complete_lines:4]
+                seqs = lines[1:num_complete_lines:4]
+                pluses = lines[2:num_complete_lines:4]
+                quals = lines[3:num_complete_lines:4]
+                # Check and parse the headers as one string, since there is
+                # no newline within a line.
+                joined_headers = '\n'.join(headers)
+                joined_pluses = '\n'.join(pluses)
+                if joined_headers[:1] == '@' and joined_headers.count('\n@') == len(headers) - 1 and \
+                    joined_pluses[:1] == '+' and joined_pluses.count('\n+') == len(pluses) - 1 and \
+                    list(map(len, seqs)) == list(map(len, quals)):
+                    names = self._HEADER_DESCRIPTION_REGEX.sub('', joined_headers)[1:].replace('\n@', '\n').split('\n')
+                    records = list(zip(names, seqs, quals))
+                else:
+                    # Multi-line FASTQ somewhere in this chunk, so find where
+                    records = []
+                    for i in range(0, num_complete_lines, 4):
+                        header, seq, plus, qual = lines[i:i+4]
+                        if header[:1] != '@' or plus[:1] != '+' or len(qual) != len(seq):
+                            num_complete_lines = i
+                            break
+                        records.append((header[1:].partition(' ')[0], seq, qual))
+                if len(records) > 0:
+                    yield records
+                unparsed = lines[num_complete_lines:]
+                if last_line is not None:
+                    unparsed.append(last_line)
+                remainder = '\n'.join(unparsed)
+                if num_complete_lines < len(lines) - 3 or (at_eof and len(unparsed) > 0):
+                    yield from self._each_list_of_readfq_records(
+                        itertools.chain(io.StringIO(remainder + fp.readline()), fp))
+                    return
+            else:
+                if at_eof:
+                    complete = buffer
+                else:
+                    last_record_start = buffer.rfind('\n>')
+                    if last_record_start == -1:
+                        remainder = buffer
+                        continue
+                    complete = buffer[:last_record_start+1]
+                    remainder = buffer[last_record_start+1:]
+                records = []
+                for entry in complete[1:].split('\n>'):
+                    header, _, seq = entry.partition('\n')
+                    records.append((header.partition(' ')[0], seq.replace('\n',''), None))
+                yield records
+
+            if at_eof:
+                return
+
+    def _each_list_of_readfq_records(self, lines):
+        records = self.readfq(lines)
+        while True:
+            records_list = list(itertools.islice(records, self.DEFAULT_BATCH_SIZE))
+            if len(records_list) == 0:
+                return
+            yield records_list
+
     def read_nucleotide_sequences(self, nucleotide_file):
         nucleotide_sequences = {}
-        for name, seq, _ in self.readfq(open(nucleotide_file)):
-            nucleotide_sequences[name] = seq
+        with self.open_sequence_file(nucleotide_file) as f:
+            for batch in self.readfq_batches(f):
+                for name, seq, _ in batch:
+                    nucleotide_sequences[name] = seq
         return nucleotide_sequences
 
     def alignment_from_alignment_file(self, alignment_file):
         protein_alignment = []
-        for name, seq, _ in self.readfq(open(alignment_file)):
-            protein_alignment.append(AlignedProteinSequence(name, seq))
+        with open(alignment_file) as f:
+            for name, seq, _ in self.readfq_buffered(f):
+                protein_alignment.append(AlignedProteinSequence(name, seq))
         if len(protein_alignment) > 0:
             logging.debug("Read in %i aligned sequences e.g. %s %s" % (
                 len(protein_alignment),
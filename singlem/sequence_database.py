@@ -2,6 +2,7 @@ import os
 import tempfile
 import logging
 import subprocess
+import multiprocessing
 import sqlite3
 import glob
 import json
@@ -9,7 +10,9 @@ import itertools
 import sys
 import csv
 import extern
+from bird_tool_utils import iterable_chunks
 import numpy as np
+import pandas as pd
 
 from sqlalchemy import create_engine, select, distinct
 
@@ -18,10 +21,15 @@ from numba.core import types
 import Bio.Data.CodonTable
 
 from .otu_table import OtuTable
+from .makedb_checkpoint import MakedbCheckpoint
+from .hamming import sequences_to_code_matrix
 from .singlem_database_models import *
 
 DEFAULT_NUM_THREADS = 1
 
+# Number of sequences to one-hot encode at a time when building indices
+ENCODING_BATCH_SIZE = 10000
+
 ANNOY_INDEX_FORMAT = 'annoy'
 NMSLIB_INDEX_FORMAT = 'nmslib'
 SCANN_INDEX_FORMAT = 'scann'
@@ -30,6 +38,14 @@ NAIVE_INDEX_FORMAT = 'scann-naive'
 NUCLEOTIDE_DATABASE_TYPE = 'nucleotide'
 PROTEIN_DATABASE_TYPE = 'protein'
 
+SQLITE_CHECKPOINT_STAGE = 'sqlite'
+
+# Must be defined outside a class so that it is pickle-able, so multiprocessing can work
+def _create_marker_index(db_path, method_name, marker_name, marker_id, num_index_threads, *args):
+    sdb = SequenceDatabase.acquire(db_path)
+    getattr(sdb, method_name)(marker_name, marker_id, num_index_threads, *args)
+
+
 class SequenceDatabase:
     version = 5
     SQLITE_DB_NAME = 'otus.sqlite3'
@@ -53,6 +69,10 @@ class SequenceDatabase:
 
     _marker_cache = None
     _taxonomy_cache = None
+    # MakedbCheckpoint of the build in progress, if any
+    _checkpoint = None
+    # DBAPI connection used by the batch lookups
+    _lookup_dbapi_connection = None
 
     def get_marker_via_cache(self, marker_id):
         if self._marker_cache is None:
@@ -68,6 +88,112 @@ class SequenceDatabase:
                 self._taxonomy_cache = Taxonomy.generate_python_index(conn)
         return self._taxonomy_cache[taxonomy_id]
 
+    # SQL for the batch lookups. These are constant so that sqlite3 reuses
+    # its prepared statements across lookups. IDs and sequences to look up
+    # are loaded into temporary tables and joined against, so there is no
+    # limit on how many can be looked up at once. They are loaded in chunks of
+    # _LOOKUP_CHUNK_SIZE, so the rows returned for only one chunk are held in
+    # memory at once.
+    _LOOKUP_CHUNK_SIZE = 999
+    _LOOKUP_TABLES_SQL = [
+        "CREATE TEMP TABLE IF NOT EXISTS lookup_ids (id INTEGER PRIMARY KEY)",
+        "CREATE TEMP TABLE IF NOT EXISTS lookup_sequences (sequence TEXT PRIMARY KEY)"]
+    _NUCLEOTIDE_ID_LOOKUP_SQL = \
+        "SELECT otus.marker_wise_sequence_id, otus.sample_name, otus.sequence, otus.num_hits, otus.coverage, otus.taxonomy_id" \
+        " FROM lookup_ids JOIN otus ON otus.marker_wise_sequence_id = lookup_ids.id" \
+        " WHERE otus.marker_id = ?"
+    _PROTEIN_ID_LOOKUP_SQL = \
+        "SELECT proteins.marker_wise_id, otus.sample_name, otus.sequence, otus.num_hits, otus.coverage, otus.taxonomy_id, proteins.protein_sequence" \
+        " FROM lookup_ids JOIN proteins ON proteins.marker_wise_id = lookup_ids.id" \
+        " JOIN nucleotides_proteins ON nucleotides_proteins.protein_id = proteins.id" \
+        " JOIN otus ON otus.sequence_id = nucleotides_proteins.nucleotide_id" \
+        " WHERE otus.marker_id = ?"
+    _SEQUENCE_LOOKUP_SQL = \
+        "SELECT otus.sample_name, otus.num_hits, otus.coverage, otus.taxonomy_id, nucleotides.sequence, markers.marker" \
+        " FROM lookup_sequences JOIN nucleotides ON nucleotides.sequence = lookup_sequences.sequence" \
+        " JOIN otus ON otus.sequence_id = nucleotides.id" \
+        " JOIN markers ON markers.id = nucleotides.marker_id"
+
+    def _lookup_connection(self):
+        '''Return the DBAPI connection used for batch lookups. It is separate
+        from sqlalchemy_connection, so that committing the writes to the
+        temporary tables does not end a transaction of the caller.'''
+        if self._lookup_dbapi_connection is None:
+            self._lookup_dbapi_connection = self.engine.raw_connection()
+        return self._lookup_dbapi_connection
+
+    def _lookup(self, table, column, values, sql, parameters=()):
+        '''Load each chunk of the values into the temporary table in turn,
+        then run the SQL, yielding a list of the rows returned for each
+        chunk.'''
+        dbapi_connection = self._lookup_connection()
+        cursor = dbapi_connection.cursor()
+        try:
+            for create_sql in SequenceDatabase._LOOKUP_TABLES_SQL:
+                cursor.execute(create_sql)
+            for chunk in iterable_chunks(values, SequenceDatabase._LOOKUP_CHUNK_SIZE):
+                cursor.execute("DELETE FROM {}".format(table))
+                cursor.executemany("INSERT OR IGNORE INTO {} ({}) VALUES (?)".format(table, column),
+                    ((v,) for v in chunk if v is not None)) # Trailing Nones from the iterable
+                # Only the temporary table was written to
+                dbapi_connection.commit()
+                cursor.execute(sql, parameters)
+                yield cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def otus_by_marker_wise_ids(self, marker_id, marker_wise_ids, sequence_type, limit_per_sequence=None):
+        '''Look up the OTUs of many sequences in the sequence indices of a
+        marker at once.
+
+        Parameters
+        ----------
+        marker_id: int
+            ID of the marker in the database
+        marker_wise_ids: iterable of int
+            IDs of sequences in the index of the marker e.g. hits from
+            get_sequence_index(). IDs not in the database (e.g. SCANN dummy
+            sequences) are ignored.
+        sequence_type: str
+            NUCLEOTIDE_TYPE or PROTEIN_TYPE
+        limit_per_sequence: int
+            if not None, return at most this many OTUs for each ID
+
+        Returns
+        -------
+        pandas.DataFrame with columns marker_wise_id, sample_name, sequence,
+        num_hits, coverage and taxonomy_id, and protein_sequence for protein
+        lookups.
+        '''
+        columns = ['marker_wise_id', 'sample_name', 'sequence', 'num_hits', 'coverage', 'taxonomy_id']
+        if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
+            sql = SequenceDatabase._NUCLEOTIDE_ID_LOOKUP_SQL
+        elif sequence_type == SequenceDatabase.PROTEIN_TYPE:
+            sql = SequenceDatabase._PROTEIN_ID_LOOKUP_SQL
+            columns.append('protein_sequence')
+        else:
+            raise Exception('Invalid sequence type: %s' % sequence_type)
+
+        rows = itertools.chain.from_iterable(
+            self._lookup('lookup_ids', 'id', (int(i) for i in marker_wise_ids), sql, (int(marker_id),)))
+        otus = pd.DataFrame(list(rows), columns=columns)
+        if limit_per_sequence is not None:
+            otus = otus.groupby('marker_wise_id', sort=False).head(limit_per_sequence)
+        return otus
+
+    def otus_by_sequences(self, sequences):
+        '''Look up the OTUs with any of the given nucleotide sequences. The
+        sequences are looked up in chunks, so the OTUs of only one chunk are
+        held in memory at once.
+
+        Returns
+        -------
+        generator of pandas.DataFrame, one per chunk, with columns
+        sample_name, num_hits, coverage, taxonomy_id, sequence and marker.
+        '''
+        for rows in self._lookup('lookup_sequences', 'sequence', sequences, SequenceDatabase._SEQUENCE_LOOKUP_SQL):
+            yield pd.DataFrame(rows, columns=['sample_name', 'num_hits', 'coverage', 'taxonomy_id', 'sequence', 'marker'])
+
     def add_sequence_db(self, marker_name, db_path, index_format, sequence_type):
         if index_format == NMSLIB_INDEX_FORMAT:
             if sequence_type == SequenceDatabase.NUCLEOTIDE_TYPE:
@@ -291,10 +417,21 @@ class SequenceDatabase:
         num_annoy_nucleotide_trees = 10, # ntrees are currently guesses
         num_annoy_protein_trees = 10,
         sequence_database_methods = [NAIVE_INDEX_FORMAT],
-        sequence_database_types = [NUCLEOTIDE_DATABASE_TYPE]):
+        sequence_database_types = [NUCLEOTIDE_DATABASE_TYPE],
+        resume = False):
+        '''Create a new SingleM database from an OTU table collection.
+
+        If resume is True and db_path is a database whose build was
+        interrupted, then the build is continued, skipping the SQLite import
+        if it was completed, and the sequence indices of markers which were
+        completed. The same OTU tables and parameters must be given as when
+        the build was started, and the input files must not have been
+        modified since.
+        '''
 
         if num_threads is None:
             num_threads = DEFAULT_NUM_THREADS
+        num_threads = int(num_threads)
 
         if sequence_database_types is None:
             sequence_database_types = []
@@ -302,11 +439,31 @@ class SequenceDatabase:
             if db_type not in [NUCLEOTIDE_DATABASE_TYPE, PROTEIN_DATABASE_TYPE]:
                 raise Exception("Unexpected sequence database type: {}".format(db_type))
 
-        # ensure db does not already exist
-        if os.path.exists(db_path):
-            raise Exception("Cowardly refusing to overwrite already-existing database path '%s'" % db_path)
-        logging.info("Creating SingleM database at {}".format(db_path))
-        os.makedirs(db_path)
+        input_files = []
+        if otu_table_collection is not None:
+            input_files = otu_table_collection.file_paths()
+        if pregenerated_sqlite3_db:
+            input_files = input_files + [pregenerated_sqlite3_db]
+        checkpoint_parameters = {
+            'input_files': MakedbCheckpoint.input_fingerprint(input_files),
+            'sequence_database_methods': sorted(set(sequence_database_methods)),
+            'sequence_database_types': sorted(set(sequence_database_types)),
+            'num_annoy_nucleotide_trees': num_annoy_nucleotide_trees,
+            'num_annoy_protein_trees': num_annoy_protein_trees,
+        }
+        if resume and MakedbCheckpoint.exists(db_path):
+            logging.info("Resuming creation of SingleM database at {}".format(db_path))
+            checkpoint = MakedbCheckpoint.load(db_path, checkpoint_parameters)
+        else:
+            # ensure db does not already exist
+            if os.path.exists(db_path):
+                if resume:
+                    raise Exception("Cannot resume building database '%s' since it has no checkpoint, so its build either finished or was not started" % db_path)
+                raise Exception("Cowardly refusing to overwrite already-existing database path '%s'" % db_path)
+            logging.info("Creating SingleM database at {}".format(db_path))
+            os.makedirs(db_path)
+            checkpoint = MakedbCheckpoint(db_path, checkpoint_parameters)
+            checkpoint.write()
 
         # Create contents file
         contents_file_path = os.path.join(db_path, SequenceDatabase._CONTENTS_FILE_NAME)
@@ -315,7 +472,14 @@ class SequenceDatabase:
                 SequenceDatabase.VERSION_KEY: 5,
             }, f)
 
-        if pregenerated_sqlite3_db:
+        sqlite_db_path = os.path.join(db_path, SequenceDatabase.SQLITE_DB_NAME)
+        if not checkpoint.is_completed(SQLITE_CHECKPOINT_STAGE) and os.path.lexists(sqlite_db_path):
+            logging.info("Removing SQLite database left incomplete by an interrupted build ..")
+            os.remove(sqlite_db_path)
+
+        if checkpoint.is_completed(SQLITE_CHECKPOINT_STAGE):
+            logging.info("Skipping SQLite database creation, since it was completed previously")
+        elif pregenerated_sqlite3_db:
             logging.info("Re-using previous SQLite database {}".format(pregenerated_sqlite3_db))
             sqlite_db_path = pregenerated_sqlite3_db
 
@@ -564,230 +728,313 @@ class SequenceDatabase:
                 c.execute("CREATE INDEX nucleotides_proteins_protein_id on nucleotides_proteins (protein_id)")
                 c.execute("CREATE INDEX nucleotides_proteins_nucleotide_id on nucleotides_proteins (nucleotide_id)")
                 db.commit()
-            
+                db.close()
+        if not checkpoint.is_completed(SQLITE_CHECKPOINT_STAGE):
+            checkpoint.complete(SQLITE_CHECKPOINT_STAGE)
 
         # Create sequence indices
         sdb = SequenceDatabase.acquire(db_path)
+        sdb._checkpoint = checkpoint
         if 'naive' in sequence_database_methods:
             sequence_database_methods.append(NAIVE_INDEX_FORMAT)
         if SCANN_INDEX_FORMAT in sequence_database_methods or NAIVE_INDEX_FORMAT in sequence_database_methods:
-            sdb.create_scann_indexes(sequence_database_types, NAIVE_INDEX_FORMAT in sequence_database_methods)
+            sdb.create_scann_indexes(sequence_database_types, NAIVE_INDEX_FORMAT in sequence_database_methods, num_threads=num_threads)
 
         if NMSLIB_INDEX_FORMAT in sequence_database_methods:
             if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                sdb.create_nmslib_nucleotide_indexes()
+                sdb.create_nmslib_nucleotide_indexes(num_threads=num_threads)
             if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                sdb.create_nmslib_protein_indexes()
+                sdb.create_nmslib_protein_indexes(num_threads=num_threads)
 
         if ANNOY_INDEX_FORMAT in sequence_database_methods:
             if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                sdb.create_annoy_nucleotide_indexes(ntrees=num_annoy_nucleotide_trees)
+                sdb.create_annoy_nucleotide_indexes(ntrees=num_annoy_nucleotide_trees, num_threads=num_threads)
             if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                sdb.create_annoy_protein_indexes(ntrees=num_annoy_protein_trees)
+                sdb.create_annoy_protein_indexes(ntrees=num_annoy_protein_trees, num_threads=num_threads)
 
+        checkpoint.remove()
         logging.info("Finished singlem DB creation")
 
-    def create_nmslib_nucleotide_indexes(self):
+    def _create_index_for_each_marker(self, method_name, num_threads, *args):
+        '''Call the method with the given name once for each marker, with
+        arguments marker_name, marker_id, num_index_threads and then args.
+
+        When num_threads > 1, markers are processed in parallel in separate
+        worker processes, each of which re-opens the database, and
+        num_index_threads is the number of threads each may use when building
+        its index. Otherwise markers are processed one at a time, and
+        num_index_threads is None, meaning the default of the index library.
+
+        If a database build is being checkpointed, markers whose index was
+        completed previously are skipped, and each marker is recorded in the
+        checkpoint once its index is completed.
+        '''
+        markers = []
+        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
+            if self._checkpoint is not None and self._checkpoint.is_completed(
+                    self._checkpoint_stage(method_name, marker_row['marker'])):
+                logging.info("Skipping {} for {}, since it was completed previously".format(
+                    method_name, marker_row['marker']))
+            else:
+                markers.append((marker_row['marker'], marker_row['id']))
+
+        if num_threads > 1 and len(markers) > 1:
+            num_processes = min(num_threads, len(markers))
+            num_index_threads = num_threads // num_processes
+            logging.info("Building indices for {} markers in {} processes ..".format(len(markers), num_processes))
+            # If building any index fails, leaving the with block terminates
+            # the other workers.
+            with multiprocessing.Pool(num_processes) as pool:
+                # Callbacks are run one at a time in the main process as each
+                # marker finishes, so the checkpoint is never written
+                # concurrently.
+                processes = [pool.apply_async(
+                    _create_marker_index,
+                    args=(self.base_directory, method_name, marker_name, marker_id, num_index_threads)+args,
+                    callback=lambda _, marker_name=marker_name: self._complete_checkpoint_stage(method_name, marker_name)) \
+                    for (marker_name, marker_id) in markers]
+                for process in processes:
+                    process.get()
+                pool.close()
+                pool.join()
+        else:
+            for (marker_name, marker_id) in markers:
+                getattr(self, method_name)(marker_name, marker_id, None, *args)
+                self._complete_checkpoint_stage(method_name, marker_name)
+
+    @staticmethod
+    def _checkpoint_stage(method_name, marker_name):
+        return '{} {}'.format(method_name, marker_name)
+
+    def _complete_checkpoint_stage(self, method_name, marker_name):
+        if self._checkpoint is not None:
+            self._checkpoint.complete(self._checkpoint_stage(method_name, marker_name))
+
+    def create_nmslib_nucleotide_indexes(self, num_threads=1):
         logging.info("Creating nmslib nucleotide sequence indices ..")
         nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_nmslib')
-        os.makedirs(nucleotide_db_dir)
-        
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            nucleotide_index = SequenceDatabase._nucleotide_nmslib_init()
+        os.makedirs(nucleotide_db_dir, exist_ok=True)
+        # JIT compile before worker processes are forked, so that each does
+        # not compile it again
+        nucleotides_to_binary('A')
+        self._create_index_for_each_marker('_create_nmslib_nucleotide_index', num_threads, nucleotide_db_dir)
 
-            marker_name = marker_row['marker']
-            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-            count = 0
+    def _create_nmslib_nucleotide_index(self, marker_name, marker_id, num_index_threads, nucleotide_db_dir):
+        nucleotide_index = SequenceDatabase._nucleotide_nmslib_init()
+
+        logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+        count = 0
 
-            for row in self.sqlalchemy_connection.execute(select(
-                NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
-                .where(NucleotideSequence.marker_id == marker_row['id'])):
+        for row in self.sqlalchemy_connection.execute(select(
+            NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
+            .where(NucleotideSequence.marker_id == marker_id)):
 
-                nucleotide_index.addDataPoint(row['marker_wise_id'], nucleotides_to_binary(row['sequence']))
-                count += 1
+            nucleotide_index.addDataPoint(row['marker_wise_id'], nucleotides_to_binary(row['sequence']))
+            count += 1
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary nucleotide index from {} unique sequences ..".format(count))
-            nucleotide_index.createIndex()
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary nucleotide index from {} unique sequences ..".format(count))
+        nucleotide_index.createIndex(SequenceDatabase._nmslib_index_parameters(num_index_threads))
 
-            logging.info("Writing index to disk ..")
-            nucleotide_db_path = os.path.join(nucleotide_db_dir, "%s.nmslib_index" % marker_name)
-            nucleotide_index.saveIndex(nucleotide_db_path, save_data=True)
-            logging.info("Finished writing index to disk")
+        logging.info("Writing index to disk ..")
+        nucleotide_db_path = os.path.join(nucleotide_db_dir, "%s.nmslib_index" % marker_name)
+        nucleotide_index.saveIndex(nucleotide_db_path, save_data=True)
+        logging.info("Finished writing index to disk")
 
-    def create_nmslib_protein_indexes(self):
+    def create_nmslib_protein_indexes(self, num_threads=1):
         logging.info("Creating nmslib protein sequence indices ..")
         protein_db_dir = os.path.join(self.base_directory, 'protein_indices_nmslib')
-        os.makedirs(protein_db_dir)
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            protein_index = SequenceDatabase._protein_nmslib_init()
+        os.makedirs(protein_db_dir, exist_ok=True)
+        self._create_index_for_each_marker('_create_nmslib_protein_index', num_threads, protein_db_dir)
 
-            marker_name = marker_row['marker']
-            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-            count = 0
-
-            for row in self.sqlalchemy_connection.execute(select(
-                distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
-                    .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                    .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                    .where(NucleotideSequence.marker_id == marker_row['id'])):
-                protein_index.addDataPoint(row['marker_wise_id'], protein_to_binary(row['protein_sequence']))
-                count += 1
-
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary protein index from {} unique sequences ..".format(count))
-            protein_index.createIndex()
-
-            logging.info("Writing index to disk ..")
-            protein_db_path = os.path.join(protein_db_dir, "%s.nmslib_index" % marker_name)
-            protein_index.saveIndex(protein_db_path, save_data=True)
-            logging.info("Finished writing index to disk")
-
-    def create_annoy_nucleotide_indexes(self, ntrees):
-        logging.info("Creating annoy nucleotide sequence indices ..")
-        nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_annoy')
-        os.makedirs(nucleotide_db_dir)
+    def _create_nmslib_protein_index(self, marker_name, marker_id, num_index_threads, protein_db_dir):
+        protein_index = SequenceDatabase._protein_nmslib_init()
 
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            annoy_index = self._nucleotide_annoy_init()
-
-            marker_name = marker_row['marker']
-            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-            count = 0
+        logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+        count = 0
 
-            for row in self.sqlalchemy_connection.execute(select(
-                NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
-                .where(NucleotideSequence.marker_id == marker_row['id'])):
+        for row in self.sqlalchemy_connection.execute(select(
+            distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
+                .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                .where(NucleotideSequence.marker_id == marker_id)):
+            protein_index.addDataPoint(row['marker_wise_id'], protein_to_binary(row['protein_sequence']))
+            count += 1
 
-                annoy_index.add_item(row['marker_wise_id'], nucleotides_to_binary_array(row['sequence']))
-                count += 1
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary protein index from {} unique sequences ..".format(count))
+        protein_index.createIndex(SequenceDatabase._nmslib_index_parameters(num_index_threads))
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary nucleotide index from {} unique sequences and ntrees={}..".format(count, ntrees))
-            annoy_index.build(ntrees)
+        logging.info("Writing index to disk ..")
+        protein_db_path = os.path.join(protein_db_dir, "%s.nmslib_index" % marker_name)
+        protein_index.saveIndex(protein_db_path, save_data=True)
+        logging.info("Finished writing index to disk")
 
-            logging.info("Writing index to disk ..")
-            annoy_index.save(os.path.join(nucleotide_db_dir, "%s.annoy_index" % marker_name))
-            logging.info("Finished writing index to disk")
-            # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
-            del annoy_index
+    @staticmethod
+    def _nmslib_index_parameters(num_index_threads):
+        if num_index_threads is None:
+            return None
+        return {'indexThreadQty': num_index_threads}
 
-    def create_annoy_protein_indexes(self, ntrees):
-        logging.info("Creating annoy protein sequence indices ..")
-        protein_db_dir = os.path.join(self.base_directory, 'protein_indices_annoy')
-        os.makedirs(protein_db_dir)
+    def create_annoy_nucleotide_indexes(self, ntrees, num_threads=1):
+        logging.info("Creating annoy nucleotide sequence indices ..")
+        nucleotide_db_dir = os.path.join(self.base_directory, 'nucleotide_indices_annoy')
+        os.makedirs(nucleotide_db_dir, exist_ok=True)
+        self._create_index_for_each_marker('_create_annoy_nucleotide_index', num_threads, nucleotide_db_dir, ntrees)
 
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            annoy_index = self._protein_annoy_init()
+    def _create_annoy_nucleotide_index(self, marker_name, marker_id, num_index_threads, nucleotide_db_dir, ntrees):
+        annoy_index = self._nucleotide_annoy_init()
 
-            marker_name = marker_row['marker']
-            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-            count = 0
+        logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+        count = 0
 
-            for row in self.sqlalchemy_connection.execute(select(
-                distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
-                    .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                    .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                    .where(NucleotideSequence.marker_id == marker_row['id'])):
+        for batch in self.sqlalchemy_connection.execute(select(
+            NucleotideSequence.sequence, NucleotideSequence.marker_wise_id) \
+            .where(NucleotideSequence.marker_id == marker_id)) \
+            .partitions(ENCODING_BATCH_SIZE):
 
-                annoy_index.add_item(row['marker_wise_id'], protein_to_binary_array(row['protein_sequence']))
-                count += 1
+            encoded = nucleotides_to_binary_matrix([row['sequence'] for row in batch])
+            for row, vector in zip(batch, encoded):
+                annoy_index.add_item(row['marker_wise_id'], vector)
+            count += len(batch)
 
-            # TODO: Tweak index creation parameters?
-            logging.info("Creating binary protein index from {} unique sequences and ntrees={}..".format(count, ntrees))
-            annoy_index.build(ntrees)
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary nucleotide index from {} unique sequences and ntrees={}..".format(count, ntrees))
+        annoy_index.build(ntrees, n_jobs=-1 if num_index_threads is None else num_index_threads)
 
-            logging.info("Writing index to disk ..")
-            annoy_index.save(os.path.join(protein_db_dir, "%s.annoy_index" % marker_name))
-            logging.info("Finished writing index to disk")
-            # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
-            del annoy_index
+        logging.info("Writing index to disk ..")
+        annoy_index.save(os.path.join(nucleotide_db_dir, "%s.annoy_index" % marker_name))
+        logging.info("Finished writing index to disk")
+        # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
+        del annoy_index
 
-    def create_scann_indexes(self, sequence_database_types, generate_brute_force_index):
+    def create_annoy_protein_indexes(self, ntrees, num_threads=1):
+        logging.info("Creating annoy protein sequence indices ..")
+        protein_db_dir = os.path.join(self.base_directory, 'protein_indices_annoy')
+        os.makedirs(protein_db_dir, exist_ok=True)
+        self._create_index_for_each_marker('_create_annoy_protein_index', num_threads, protein_db_dir, ntrees)
+
+    def _create_annoy_protein_index(self, marker_name, marker_id, num_index_threads, protein_db_dir, ntrees):
+        annoy_index = self._protein_annoy_init()
+
+        logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+        count = 0
+
+        for batch in self.sqlalchemy_connection.execute(select(
+            distinct(ProteinSequence.marker_wise_id), ProteinSequence.protein_sequence) \
+                .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                .where(NucleotideSequence.marker_id == marker_id)) \
+                .partitions(ENCODING_BATCH_SIZE):
+
+            encoded = protein_to_binary_matrix([row['protein_sequence'] for row in batch])
+            for row, vector in zip(batch, encoded):
+                annoy_index.add_item(row['marker_wise_id'], vector)
+            count += len(batch)
+
+        # TODO: Tweak index creation parameters?
+        logging.info("Creating binary protein index from {} unique sequences and ntrees={}..".format(count, ntrees))
+        annoy_index.build(ntrees, n_jobs=-1 if num_index_threads is None else num_index_threads)
+
+        logging.info("Writing index to disk ..")
+        annoy_index.save(os.path.join(protein_db_dir, "%s.annoy_index" % marker_name))
+        logging.info("Finished writing index to disk")
+        # Delete immediately to save RAM (was using 200G+ before getting killed on big DB)
+        del annoy_index
+
+    def create_scann_indexes(self, sequence_database_types, generate_brute_force_index, num_threads=1):
         logging.info("Creating scann sequence indices ..")
-        import tensorflow as tf
-        import scann # only load when needed to speed start-up
         if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-            nucleotide_db_dir_ah = os.path.join(self.base_directory, 'nucleotide_indices_scann')
-            nucleotide_db_dir_brute_force = os.path.join(self.base_directory, 'nucleotide_indices_scann_brute_force')
-            os.makedirs(nucleotide_db_dir_ah)
+            os.makedirs(os.path.join(self.base_directory, 'nucleotide_indices_scann'), exist_ok=True)
             if generate_brute_force_index:
-                os.makedirs(nucleotide_db_dir_brute_force)
+                os.makedirs(os.path.join(self.base_directory, 'nucleotide_indices_scann_brute_force'), exist_ok=True)
         if PROTEIN_DATABASE_TYPE in sequence_database_types:
-            protein_db_dir_ah = os.path.join(self.base_directory, 'protein_indices_scann')
-            protein_db_dir_brute_force = os.path.join(self.base_directory, 'protein_indices_scann_brute_force')
-            os.makedirs(protein_db_dir_ah)
+            os.makedirs(os.path.join(self.base_directory, 'protein_indices_scann'), exist_ok=True)
             if generate_brute_force_index:
-                os.makedirs(protein_db_dir_brute_force)
-
-        def generate_indices_from_array(a, db_dir_ah, db_dir_brute_force, generate_brute_force_index):
-            normalized_dataset = a / np.linalg.norm(a, axis=1)[:, np.newaxis]
-            logging.info("Found {} sequences for {}".format(a.shape[0], marker_name))
-            del a # not sure if this matters much
-
-            logging.info("Creating SCANN AH index ..")
-            searcher = scann.scann_ops_pybind.builder(normalized_dataset, 10, "dot_product").tree(
-                num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100, training_sample_size=250000).score_ah(
-                2, anisotropic_quantization_threshold=0.2).reorder(100).build()
-            directory = os.path.join(db_dir_ah, marker_name)
-            os.mkdir(directory)
-            searcher.serialize(directory)
-            del searcher
+                os.makedirs(os.path.join(self.base_directory, 'protein_indices_scann_brute_force'), exist_ok=True)
 
-            if generate_brute_force_index:
-                logging.info("Creating SCANN brute force index ..")
-                # use scann.scann_ops.build() to instead create a
-                # TensorFlow-compatible searcher could not work out how to
-                # deserialise a brute force without any doco, so just copying method
-                # from the tests i.e.
-                # https://github.com/google-research/google-research/blob/34444253e9f57cd03364bc4e50057a5abe9bcf17/scann/scann/scann_ops/py/scann_ops_test.py#L93
-                searcher_naive = scann.scann_ops.builder(normalized_dataset, 10, "dot_product").tree(
-                    num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100).score_brute_force(True).build()
-                directory = os.path.join(db_dir_brute_force, marker_name)
-                module = searcher_naive.serialize_to_module()
-                tf.saved_model.save(
-                    module,
-                    directory,
-                    options=tf.saved_model.SaveOptions(namespace_whitelist=["Scann"]))
-                del searcher_naive
+        self._create_index_for_each_marker(
+            '_create_scann_indexes_for_marker', num_threads, sequence_database_types, generate_brute_force_index)
 
-        for marker_row in self.sqlalchemy_connection.execute(select(Marker)):
-            marker_name = marker_row['marker']
-            marker_id = marker_row['id']
-            
-            if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
-                logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
-                a = np.concatenate([np.array([nucleotides_to_binary_array(entry['sequence'])]) for entry in \
-                    self.sqlalchemy_connection.execute(select(
-                        NucleotideSequence.sequence) \
-                        .where(NucleotideSequence.marker_id == marker_id) \
-                        .order_by(NucleotideSequence.marker_wise_id))
-                ])
-                if a.shape[0] < 16:
-                    logging.warning("Adding dummy nucleotide sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
-                    a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
-                generate_indices_from_array(a, nucleotide_db_dir_ah, nucleotide_db_dir_brute_force, generate_brute_force_index)
-                logging.info("Finished writing nucleotide indices to disk")
-            
-            if PROTEIN_DATABASE_TYPE in sequence_database_types:
-                logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
-                a = np.concatenate([np.array([protein_to_binary_array(entry['protein_sequence'])]) for entry in \
-                    self.sqlalchemy_connection.execute(select(
-                        ProteinSequence.protein_sequence) \
-                            .order_by(ProteinSequence.marker_wise_id) \
-                            .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
-                            .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
-                            .where(NucleotideSequence.marker_id == marker_id)
-                            .distinct())
-                ])
-                if a.shape[0] < 16:
-                    logging.warn("Adding dummy protein sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
-                    a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
-                generate_indices_from_array(a, protein_db_dir_ah, protein_db_dir_brute_force, generate_brute_force_index)
-                del a
-                logging.info("Finished writing protein indices to disk")
+    def _create_scann_indexes_for_marker(self, marker_name, marker_id, num_index_threads, sequence_database_types, generate_brute_force_index):
+        # num_index_threads is not used since scann does not expose the
+        # number of threads used to build an index.
+        if NUCLEOTIDE_DATABASE_TYPE in sequence_database_types:
+            logging.info("Tabulating unique nucleotide sequences for {}..".format(marker_name))
+            a = nucleotides_to_binary_matrix([entry['sequence'] for entry in \
+                self.sqlalchemy_connection.execute(select(
+                    NucleotideSequence.sequence) \
+                    .where(NucleotideSequence.marker_id == marker_id) \
+                    .order_by(NucleotideSequence.marker_wise_id))
+            ], dtype=np.float32)
+            if a.shape[0] < 16:
+                logging.warning("Adding dummy nucleotide sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
+                a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
+            self._generate_scann_indices_from_array(
+                a, marker_name,
+                os.path.join(self.base_directory, 'nucleotide_indices_scann'),
+                os.path.join(self.base_directory, 'nucleotide_indices_scann_brute_force'),
+                generate_brute_force_index)
+            logging.info("Finished writing nucleotide indices to disk")
+
+        if PROTEIN_DATABASE_TYPE in sequence_database_types:
+            logging.info("Tabulating unique protein sequences for {}..".format(marker_name))
+            a = protein_to_binary_matrix([entry['protein_sequence'] for entry in \
+                self.sqlalchemy_connection.execute(select(
+                    ProteinSequence.protein_sequence) \
+                        .order_by(ProteinSequence.marker_wise_id) \
+                        .where(ProteinSequence.id == NucleotidesProteins.protein_id) \
+                        .where(NucleotidesProteins.nucleotide_id == NucleotideSequence.id) \
+                        .where(NucleotideSequence.marker_id == marker_id)
+                        .distinct())
+            ], dtype=np.float32)
+            if a.shape[0] < 16:
+                logging.warn("Adding dummy protein sequences to SCANN AH/NAIVE DB creation since the number of real datapoints is too small")
+                a = np.concatenate([a, np.ones((16-a.shape[0], a.shape[1]))])
+            self._generate_scann_indices_from_array(
+                a, marker_name,
+                os.path.join(self.base_directory, 'protein_indices_scann'),
+                os.path.join(self.base_directory, 'protein_indices_scann_brute_force'),
+                generate_brute_force_index)
+            del a
+            logging.info("Finished writing protein indices to disk")
+
+    def _generate_scann_indices_from_array(self, a, marker_name, db_dir_ah, db_dir_brute_force, generate_brute_force_index):
+        # only load when needed to speed start-up, and so that they are not
+        # loaded before worker processes are forked
+        import tensorflow as tf
+        import scann
+        normalized_dataset = a / np.linalg.norm(a, axis=1)[:, np.newaxis]
+        logging.info("Found {} sequences for {}".format(a.shape[0], marker_name))
+        del a # not sure if this matters much
+
+        logging.info("Creating SCANN AH index ..")
+        searcher = scann.scann_ops_pybind.builder(normalized_dataset, 10, "dot_product").tree(
+            num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100, training_sample_size=250000).score_ah(
+            2, anisotropic_quantization_threshold=0.2).reorder(100).build()
+        directory = os.path.join(db_dir_ah, marker_name)
+        # may exist already if an interrupted build is being resumed
+        os.makedirs(directory, exist_ok=True)
+        searcher.serialize(directory)
+        del searcher
+
+        if generate_brute_force_index:
+            logging.info("Creating SCANN brute force index ..")
+            # use scann.scann_ops.build() to instead create a
+            # TensorFlow-compatible searcher could not work out how to
+            # deserialise a brute force without any doco, so just copying method
+            # from the tests i.e.
+            # https://github.com/google-research/google-research/blob/34444253e9f57cd03364bc4e50057a5abe9bcf17/scann/scann/scann_ops/py/scann_ops_test.py#L93
+            searcher_naive = scann.scann_ops.builder(normalized_dataset, 10, "dot_product").tree(
+                num_leaves=round(np.sqrt(normalized_dataset.shape[0])), num_leaves_to_search=100).score_brute_force(True).build()
+            directory = os.path.join(db_dir_brute_force, marker_name)
+            module = searcher_naive.serialize_to_module()
+            tf.saved_model.save(
+                module,
+                directory,
+                options=tf.saved_model.SaveOptions(namespace_whitelist=["Scann"]))
+            del searcher_naive
 
-    
     @staticmethod
     def dump(db_path):
         """Dump the DB contents to STDOUT, requiring a version 5+ database"""
@@ -891,6 +1138,36 @@ def _aa_to_binary_array(x):
 def protein_to_binary_array(seq):
     return list(itertools.chain(*[_aa_to_binary_array(b) for b in seq]))
 
+# Lookup tables from ASCII code to one-hot row, used for encoding many
+# sequences at once. These give the same encoding as
+# nucleotides_to_binary_array and protein_to_binary_array.
+_NUCLEOTIDE_ONE_HOT = np.zeros((256, 5), dtype=np.uint8)
+_NUCLEOTIDE_ONE_HOT[:, 4] = 1
+for _i, _base in enumerate('ATCG'):
+    _NUCLEOTIDE_ONE_HOT[ord(_base)] = [1 if j == _i else 0 for j in range(5)]
+
+_PROTEIN_ONE_HOT = np.zeros((256, len(AA_ORDER)), dtype=np.uint8)
+for _i, _aa in enumerate(AA_ORDER):
+    _PROTEIN_ONE_HOT[ord(_aa), _i] = 1
+
+def _sequences_to_binary_matrix(seqs, one_hot_table, dtype):
+    codes = sequences_to_code_matrix(seqs)
+    if codes.shape[0] == 0:
+        return np.zeros((0, 0), dtype=dtype)
+    return one_hot_table[codes].reshape(codes.shape[0], codes.shape[1]*one_hot_table.shape[1]).astype(dtype, copy=False)
+
+def nucleotides_to_binary_matrix(seqs, dtype=np.uint8):
+    """Encode an iterable of equal-length nucleotide sequences as a 2D array,
+    one row per sequence, each row being equal to
+    nucleotides_to_binary_array of that sequence."""
+    return _sequences_to_binary_matrix(seqs, _NUCLEOTIDE_ONE_HOT, dtype)
+
+def protein_to_binary_matrix(seqs, dtype=np.uint8):
+    """Encode an iterable of equal-length protein sequences as a 2D array,
+    one row per sequence, each row being equal to protein_to_binary_array of
+    that sequence."""
+    return _sequences_to_binary_matrix(seqs, _PROTEIN_ONE_HOT, dtype)
+
 # @numba.njit() # would like to do this, but better to move to lists not dict for codon table
 def nucleotides_to_protein(seq):
     aas = []
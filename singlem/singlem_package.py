@@ -21,6 +21,7 @@ class SingleMPackage:
     '''
 
     _CONTENTS_FILE_NAME = 'CONTENTS.json'
+    _WINDOW_CACHE_FILE_NAME = 'window_cache.json'
 
     # The key names are unlikely to change across package format versions,
     # so store them here in the superclass
@@ -132,6 +133,11 @@ class SingleMPackage:
     def base_directory(self):
         return self._base_directory
 
+    def window_cache_path(self):
+        '''Path to the WindowCache of alignment columns used with this
+        package, which may not exist yet.'''
+        return os.path.join(self._base_directory, SingleMPackage._WINDOW_CACHE_FILE_NAME)
+
 class SingleMPackageVersion1(SingleMPackage):
     version = 1 # don't change me bro
 
@@ -1,4 +1,5 @@
 from .otu_table import OtuTableEntry
+from .hamming import hamming_distances
 
 
 class DifferenceOTUEntry(OtuTableEntry):
@@ -94,13 +95,27 @@ class StrainSummariser:
         -------
         generator over DifferenceOTUEntry objects
         '''
-        for otu in otu_table_iterator:
-            # ignore the reference ones
-            if otu.sequence == reference_otu.sequence: continue
-            
+        # ignore the reference ones
+        otus = [otu for otu in otu_table_iterator if otu.sequence != reference_otu.sequence]
+
+        # Compare the OTUs to the reference in bulk, in batches of the same
+        # length. Positions past the end of the reference are ignored, and
+        # positions of the reference past the end of an OTU count as
+        # differences.
+        reference_length = len(reference_otu.sequence)
+        indices_by_length = {}
+        for i, otu in enumerate(otus):
+            indices_by_length.setdefault(
+                min(len(otu.sequence), reference_length), []).append(i)
+        differences = [None]*len(otus)
+        for length, indices in indices_by_length.items():
+            distances = hamming_distances(
+                [reference_otu.sequence[:length]],
+                [otus[i].sequence[:length] for i in indices])[0]
+            for i, distance in zip(indices, distances.tolist()):
+                differences[i] = distance + reference_length - length
+
+        for otu, difference in zip(otus, differences):
             d = DifferenceOTUEntry.create_from_otu_table_entry(otu)
-            d.difference_in_bp = 0
-            for i, ref in enumerate(reference_otu.sequence):
-                if otu.sequence[i] != ref:
-                    d.difference_in_bp += 1
+            d.difference_in_bp = difference
             yield d
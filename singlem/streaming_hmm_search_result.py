@@ -24,8 +24,17 @@ class StreamingHMMSearchResult:
         #                ]
 
         with open(hmmout_path) as f:
-            for (i, row) in enumerate([x.rstrip().split() for x in f if not x.startswith('#')]):
-                yield row[0]
+            for query_id in StreamingHMMSearchResult.yield_from_hmmsearch_table_stream(f):
+                yield query_id
+
+    @staticmethod
+    def yield_from_hmmsearch_table_stream(hmmout_io):
+        '''yield a query ID for each hit line read from an open hmmsearch
+        domain table, e.g. the stdout of a running hmmsearch process, as it is
+        read'''
+        for line in hmmout_io:
+            if not line.startswith('#'):
+                yield line.split(None, 1)[0]
                 # print("row {}, got {}".format(i, ', '.join(row)))
                 # alifrom    = int(row[17])
                 # alito      = int(row[18])
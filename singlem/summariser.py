@@ -13,6 +13,7 @@ from .otu_table import OtuTable
 from .rarefier import Rarefier
 from .ordered_set import OrderedSet
 from .archive_otu_table import ArchiveOtuTable
+from .columnar_otu_table import ColumnarOtuTable
 
 class Summariser:
     @staticmethod
@@ -165,6 +166,16 @@ class Summariser:
         else:
             OtuTable.write_otus_to(table_collection, output_table_io)
 
+    @staticmethod
+    def write_columnar_otu_table(**kwargs):
+        output_path = kwargs.pop('output_path')
+        table_collection = kwargs.pop('table_collection')
+        if len(kwargs) > 0:
+            raise Exception("Unexpected arguments detected: %s" % kwargs)
+
+        logging.info("Writing columnar OTU table %s" % output_path)
+        ColumnarOtuTable.write(table_collection, output_path)
+
     @staticmethod
     def write_wide_format_otu_table(**kwargs):
         output_table_io = kwargs.pop('output_table_io')
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+class WindowCache:
+    '''A JSON file of the windows found in alignments, so that they do not
+    have to be found again each time the same alignment is used. Entries are
+    keyed by a checksum of the files the alignment was made from and the window
+    parameters, so an entry is never used for an alignment that has changed.
+
+    For a SingleM package the cache is kept in the package directory, see
+    SingleMPackage.window_cache_path().'''
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    j = json.load(f)
+                if j['version'] == self.version:
+                    self._entries = j['entries']
+                else:
+                    logging.debug("Ignoring window cache {} of version {}".format(path, j['version']))
+            except (ValueError, KeyError, OSError) as e:
+                logging.warning("Ignoring unreadable window cache {}: {}".format(path, e))
+
+    @staticmethod
+    def checksum(paths, *parameters):
+        '''Return a checksum of the files at paths e.g. an alignment file, or
+        the sequences and HMM an alignment is made from, and other parameters
+        which determine the cached values. The files are hashed as bytes,
+        without being parsed.'''
+        h = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    h.update(chunk)
+        h.update(json.dumps(parameters).encode())
+        return h.hexdigest()
+
+    def get(self, checksum):
+        '''Return the cached dict for this checksum, or None.'''
+        return self._entries.get(checksum)
+
+    def set(self, checksum, entry):
+        '''Cache the dict entry for this checksum, writing the cache file. If
+        the file cannot be written e.g. because its directory is read only, a
+        warning is logged and the cache is only kept in memory.'''
+        self._entries[checksum] = entry
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temporary_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.singlem_window_cache', delete=False) as f:
+                temporary_path = f.name
+                json.dump({'version': self.version, 'entries': self._entries}, f)
+            # Replace atomically so concurrent readers never see a partial file
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warning("Unable to write window cache {}: {}".format(self.path, e))
+            if temporary_path is not None and os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def window_columns(self, checksum, alignment, best_position, stretch_length):
+        '''Return the ignored columns and chosen positions of
+        MetagenomeOtuFinder.window_columns from the cache, or find them and
+        cache them if this checksum has not been seen before.'''
+        cached = self.get(checksum)
+        if cached is not None:
+            logging.debug("Using cached window columns from {}".format(self.path))
+            return cached['ignored_columns'], cached['chosen_positions']
+
+        from .metagenome_otu_finder import MetagenomeOtuFinder
+        ignored_columns, chosen_positions = MetagenomeOtuFinder().window_columns(
+            alignment, best_position, stretch_length)
+        self.set(checksum, {
+            'ignored_columns': ignored_columns,
+            'chosen_positions': chosen_positions})
+        return ignored_columns, chosen_positions
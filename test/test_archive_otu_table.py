@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import sys, os, unittest, json
+from io import StringIO, BytesIO
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+from singlem.archive_otu_table import ArchiveOtuTable, StreamingArchiveOtuTable
+
+class Tests(unittest.TestCase):
+    def read_example(self):
+        with open(os.path.join(path_to_data, 'small.otu_table.json')) as f:
+            j = json.load(f)
+        j['otus'] = j['otus']*5
+        return j
+
+    def test_read_streaming(self):
+        j = self.read_example()
+        table = ArchiveOtuTable.read_streaming(StringIO(json.dumps(j)))
+        self.assertEqual(j['version'], table.version)
+        self.assertEqual(j['fields'], table.fields)
+        self.assertEqual(j['alignment_hmm_sha256s'], table.alignment_hmm_sha256s)
+        self.assertEqual(j['otus'], [otu.data for otu in table])
+
+    def test_read_streaming_small_chunks_bytes(self):
+        j = self.read_example()
+        class SmallChunks(StreamingArchiveOtuTable):
+            _CHUNK_SIZE = 3
+        table = SmallChunks(BytesIO(json.dumps(j, indent=1).encode()))
+        self.assertEqual(j['otus'], [otu.data for otu in table])
+
+    def test_read_streaming_otus_before_header(self):
+        j = self.read_example()
+        reordered = {'otus': j['otus']}
+        reordered.update(dict([(k, v) for k, v in j.items() if k != 'otus']))
+        table = ArchiveOtuTable.read_streaming(StringIO(json.dumps(reordered)))
+        self.assertEqual(j['otus'], [otu.data for otu in table])
+
+    def test_read_streaming_truncated(self):
+        s = json.dumps(self.read_example())
+        with self.assertRaises(json.decoder.JSONDecodeError):
+            list(ArchiveOtuTable.read_streaming(StringIO(s[:-30])))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import tempfile
+import sys
+import extern
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.columnar_otu_table import ColumnarOtuTable
+from singlem.archive_otu_table import ArchiveOtuTable, ArchiveOtuTableEntry
+from singlem.otu_table import OtuTable
+from singlem.otu_table_entry import OtuTableEntry
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_otu_table_round_trip(self):
+        table = OtuTable()
+        table.data = [
+            ['gene1','sample1','AAT',2,1.5,'Root; d__Bacteria'],
+            ['gene2','sample1','GGG',1,0.25,'Root'],
+            ['gene1','sample2','AAC',3,4.0,'Root; d__Bacteria'],
+        ]
+        with tempfile.NamedTemporaryFile(suffix='.smc') as f:
+            ColumnarOtuTable.write(table, f.name)
+            with ColumnarOtuTable(f.name) as columnar:
+                self.assertEqual(3, len(columnar))
+                self.assertEqual(['gene1','gene2'], columnar.genes())
+                self.assertEqual(['sample1','sample2'], columnar.samples())
+                otus = list(columnar)
+                self.assertEqual(table.data, [o.data for o in otus])
+                self.assertEqual(OtuTable.DEFAULT_OUTPUT_FIELDS, otus[0].fields)
+                self.assertIsInstance(otus[0], OtuTableEntry)
+                self.assertEqual(2, otus[0].count)
+                self.assertEqual(1.5, otus[0].coverage)
+
+                self.assertEqual(['AAT','AAC'], [o.sequence for o in columnar.each(markers=['gene1'])])
+                self.assertEqual(['AAT','GGG'], [o.sequence for o in columnar.each(samples=['sample1'])])
+                self.assertEqual(['GGG'], [o.sequence for o in columnar.each(markers=['gene2'], samples=['sample1'])])
+                self.assertEqual([], list(columnar.each(samples=['sample3'])))
+
+    def test_archive_round_trip(self):
+        with open(os.path.join(path_to_data, 'small.otu_table.json')) as f:
+            archive = ArchiveOtuTable.read(f)
+        with tempfile.NamedTemporaryFile(suffix='.smc') as f:
+            ColumnarOtuTable.write(archive, f.name,
+                alignment_hmm_sha256s=archive.alignment_hmm_sha256s,
+                singlem_package_sha256s=archive.singlem_package_sha256s)
+            with ColumnarOtuTable(f.name) as columnar:
+                self.assertEqual(archive.fields, columnar.fields)
+                self.assertEqual(archive.alignment_hmm_sha256s, columnar.alignment_hmm_sha256s)
+                otus = list(columnar)
+                self.assertEqual(archive.data, [o.data for o in otus])
+                self.assertIsInstance(otus[0], ArchiveOtuTableEntry)
+                self.assertEqual(archive.data[0][ArchiveOtuTable.READ_NAME_FIELD_INDEX], otus[0].read_names())
+
+    def test_not_columnar(self):
+        with self.assertRaises(Exception):
+            ColumnarOtuTable(os.path.join(path_to_data, 'small.otu_table.csv'))
+
+    def test_summarise(self):
+        with tempfile.TemporaryDirectory() as d:
+            extern.run("{} summarise --input-otu-tables {}/methanobacteria/otus.transcripts.on_target.csv --output-columnar-otu-table {}/otus.smc".format(
+                path_to_script, path_to_data, d))
+            with open('{}/methanobacteria/otus.transcripts.on_target.csv'.format(path_to_data)) as f:
+                expected = f.read()
+            for stream in ['', '--stream-inputs']:
+                observed = extern.run("{} summarise {} --input-columnar-otu-tables {}/otus.smc --output-otu-table /dev/stdout".format(
+                    path_to_script, stream, d))
+                self.assertEqual(expected, observed)
+
+    def test_makedb(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open('{}/methanobacteria/otus.transcripts.on_target.csv'.format(path_to_data)) as f:
+                ColumnarOtuTable.write(OtuTable.read(f), '{}/otus.smc'.format(d))
+            extern.run("{} makedb --db {}/db --columnar-otu-tables {}/otus.smc --sequence-database-methods none".format(
+                path_to_script, d, d))
+            observed = extern.run("{} query --dump --db {}/db".format(path_to_script, d))
+            with open('{}/methanobacteria/otus.transcripts.on_target.csv'.format(path_to_data)) as f:
+                expected = f.read()
+            self.assertEqual(sorted(expected.splitlines()[1:]), sorted(observed.splitlines()[1:]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os
+import sys
+import tempfile
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+from singlem.diamond_spkg_searcher import DiamondSpkgSearcher, DiamondSearchResult
+from singlem import instrumentation
+
+class Tests(unittest.TestCase):
+    def test_read_diamond_hits(self):
+        with tempfile.TemporaryDirectory() as d:
+            fasta_path = os.path.join(d, 'sample.fna')
+            result = DiamondSearchResult(fasta_path)
+            with open(fasta_path, 'w') as fasta:
+                DiamondSpkgSearcher._read_diamond_hits([
+                    "read1\tATGATG\tsubject1\n",
+                    "read2\tCCCAAA\tsubject2\n",
+                    "read3\tGGGTTT\tsubject1\n"], fasta, result)
+            with open(fasta_path) as f:
+                self.assertEqual(">read1\nATGATG\n>read2\nCCCAAA\n>read3\nGGGTTT\n", f.read())
+            self.assertEqual(3, result.num_hits())
+            self.assertEqual([
+                (0, 'read1', 'ATGATG', 'subject1'),
+                (14, 'read2', 'CCCAAA', 'subject2'),
+                (28, 'read3', 'GGGTTT', 'subject1')],
+                list(result.each_record_with_best_hit()))
+            self.assertEqual('sample', result.sample_name())
+
+    def test_read_diamond_hits_multiple_best_hits(self):
+        result = DiamondSearchResult('sample.fna')
+        result.add_hit('read1', 'subject1')
+        result.add_hit('read1', 'subject1')
+        self.assertEqual(1, result.num_hits())
+        with self.assertRaises(Exception):
+            result.add_hit('read1', 'subject2')
+
+    def test_many_subjects(self):
+        result = DiamondSearchResult('sample.fna')
+        for i in range(70000):
+            result.add_hit('read{}'.format(i), 'subject{}'.format(i))
+        self.assertEqual(70000, result.num_hits())
+        self.assertEqual('subject69999', result._subject_ids[result._codes[-1]])
+
+    def test_sample_tagged_reads(self):
+        with tempfile.TemporaryDirectory() as d:
+            read_files = [os.path.join(d, 'sample1.fa'), os.path.join(d, 'sample2.fq')]
+            with open(read_files[0], 'w') as f:
+                f.write(">read1 comment\nATGATG\n>read2\nCCCAAA\n")
+            with open(read_files[1], 'w') as f:
+                f.write("@read1\nGGGTTT\n+\nIIIIII\n")
+            lines = instrumentation.stream_output(
+                "cat", stdin_writer=lambda f: DiamondSpkgSearcher._write_sample_tagged_reads(read_files, f))
+            self.assertEqual([">0|read1\n", "ATGATG\n", ">0|read2\n", "CCCAAA\n", ">1|read1\n", "GGGTTT\n"], list(lines))
+
+            fasta_paths = [os.path.join(d, 'sample1.fna'), os.path.join(d, 'sample2.fna')]
+            results = [DiamondSearchResult(p) for p in fasta_paths]
+            with open(fasta_paths[0], 'w') as f1, open(fasta_paths[1], 'w') as f2:
+                DiamondSpkgSearcher._read_sample_tagged_diamond_hits([
+                    "0|read1\tATGATG\tsubject1\n",
+                    "1|read1\tGGGTTT\tsubject2\n",
+                    "0|read2\tCCCAAA\tsubject1\n"], [f1, f2], results)
+            self.assertEqual([('read1', 'ATGATG', 'subject1'), ('read2', 'CCCAAA', 'subject1')],
+                [r[1:] for r in results[0].each_record_with_best_hit()])
+            self.assertEqual([('read1', 'GGGTTT', 'subject2')],
+                [r[1:] for r in results[1].each_record_with_best_hit()])
+            self.assertEqual([2, 1], [r.num_hits() for r in results])
+            self.assertEqual(['sample1', 'sample2'], [r.sample_name() for r in results])
+
+if __name__ == "__main__":
+    unittest.main()
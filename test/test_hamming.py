@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+from singlem.hamming import hamming_distances, paired_hamming_distances
+
+class Tests(unittest.TestCase):
+    def test_hamming_distances(self):
+        self.assertEqual(
+            [[0, 2, 4], [2, 3, 4]],
+            hamming_distances(['ATCG','AGCC'], ['ATCG','TACG','GCTA']).tolist())
+        self.assertEqual((0, 2), hamming_distances([], ['ATCG','TACG']).shape)
+        with self.assertRaises(Exception):
+            hamming_distances(['ATG'], ['AT'])
+
+    def test_paired_hamming_distances(self):
+        self.assertEqual(
+            [0, 3],
+            paired_hamming_distances(['ATCG','AGCC'], ['ATCG','TACG']).tolist())
+        self.assertEqual([], paired_hamming_distances([], []).tolist())
+        with self.assertRaises(Exception):
+            paired_hamming_distances(['ATG'], ['AT'])
+        with self.assertRaises(Exception):
+            paired_hamming_distances(['ATG'], [])
+
+if __name__ == "__main__":
+    unittest.main()
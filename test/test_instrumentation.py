@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import tempfile
+import sys
+import json
+import extern
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem import instrumentation
+
+class Tests(unittest.TestCase):
+    def tearDown(self):
+        instrumentation.stop()
+
+    def test_not_recording(self):
+        with instrumentation.stage('nothing'):
+            instrumentation.add_count('reads', 3)
+            self.assertEqual('hello\n', instrumentation.run('echo hello'))
+        self.assertEqual(None, instrumentation.stop())
+
+    def test_report(self):
+        instrumentation.start()
+        with instrumentation.stage('first'):
+            instrumentation.run('echo hello')
+            instrumentation.run_many(['true','true'], num_threads=2)
+            instrumentation.add_count('reads', 3)
+        with instrumentation.stage('second'):
+            pass
+        with tempfile.NamedTemporaryFile(mode='w+', suffix='.json') as f:
+            instrumentation.stop().write_report(f.name)
+            report = json.load(open(f.name))
+
+        self.assertEqual(['first','second'], [s['name'] for s in report['stages']])
+        first = report['stages'][0]
+        self.assertEqual({'reads': 3}, first['counts'])
+        self.assertEqual(['echo hello', ['true','true']], [c['command'] for c in first['commands']])
+        for key in ['wall_seconds','cpu_seconds','external_cpu_seconds','peak_rss_mb']:
+            self.assertGreaterEqual(first[key], 0)
+            self.assertIn(key, report)
+        # Only known for the run as a whole
+        self.assertGreaterEqual(report['peak_external_rss_mb'], 0)
+        self.assertNotIn('peak_external_rss_mb', first)
+        self.assertNotIn('peak_external_rss_mb', first['commands'][0])
+        self.assertEqual({}, report['stages'][1]['counts'])
+        self.assertEqual([], report['stages'][1]['commands'])
+
+    def test_stream_output(self):
+        self.assertEqual(['a\tb\tc\n', 'd\te\tf\n'],
+            list(instrumentation.stream_output("printf 'a\\tb\\tc\\nd\\te\\tf\\n'")))
+        with self.assertRaises(extern.ExternCalledProcessError):
+            list(instrumentation.stream_output("echo a; echo failed >&2; false"))
+
+    def test_stream_output_stdin(self):
+        self.assertEqual(['A\n', 'B\n'],
+            list(instrumentation.stream_output("tr a-z A-Z", stdin_writer=lambda f: f.write('a\nb\n'))))
+
+    def test_stream_output_stdin_writer_error(self):
+        def failing_writer(f):
+            f.write('a\n')
+            raise ValueError("bad record")
+        # stdin is closed so the command finishes, and the error is raised
+        with self.assertRaises(ValueError):
+            list(instrumentation.stream_output("cat", stdin_writer=failing_writer))
+
+    def test_stream_output_stopped_early(self):
+        def writer(f):
+            for _ in range(100000):
+                f.write('line\n')
+        lines = instrumentation.stream_output("cat", stdin_writer=writer)
+        self.assertEqual('line\n', next(lines))
+        # Closing the generator kills the command and joins the writer
+        lines.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,14 +24,22 @@
 import unittest
 import os.path
 import tempfile
+import shutil
 import extern
 import sys
 import re
+import pandas as pd
 
 path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','bin','singlem')
 path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+from singlem.sequence_database import nucleotides_to_binary_array, nucleotides_to_binary_matrix, \
+    protein_to_binary_array, protein_to_binary_matrix
+from singlem.sequence_database import SequenceDatabase
+from singlem.makedb_checkpoint import MakedbCheckpoint
+from singlem.querier import Querier, QueryResult, QueryInputSequence
+from singlem.otu_table_entry import OtuTableEntry
 
 TEST_NMSLIB = False
 
@@ -91,6 +99,129 @@ class Tests(unittest.TestCase):
                 self.assertEqual(observed.split("\n")[0], "\t".join(self.query_result_headers))
                 self.assertTrue('GB_GCA_000309865.1_protein	CAGACTGAAATATTCATGGACAACATGCGAATGTTCCTTAAAGAAGAGGGCCAGGGGATG	0	1	1.1	GB_GCA_000309865.1_protein	S3.32.Fibrillarin	CAGACTGAAATATTCATGGACAACATGCGAATGTTCCTTAAAGAAGAGGGCCAGGGGATG	Root; d__Archaea; p__Methanobacteriota; c__Methanobacteria; o__Methanobacteriales; f__Methanobacteriaceae; g__Methanobacterium; s__Methanobacterium sp000309865\n' in observed)
 
+    def test_makedb_query_methanobacteria_threads(self):
+        with tempfile.TemporaryDirectory() as d:
+            cmd = "%s makedb --db %s/db --otu-table %s/methanobacteria/otus.transcripts.on_target.csv --sequence-database-methods annoy --sequence-database-types nucleotide protein --threads 2" %(
+                path_to_script,
+                d,
+                path_to_data)
+            extern.run(cmd)
+
+            for sequence_type in ['nucleotide','protein']:
+                cmd = "%s query --sequence-type %s --query-otu-table %s/methanobacteria/otus.transcripts.on_target.3random.csv --db %s/db --search-method annoy --max-nearest-neighbours 2" % (
+                    path_to_script,
+                    sequence_type,
+                    path_to_data,
+                    d)
+                observed = extern.run(cmd)
+                self.assertTrue('GB_GCA_000309865.1_protein\tCAGACTGAAATATTCATGGACAACATGCGAATGTTCCTTAAAGAAGAGGGCCAGGGGATG\t' in observed)
+
+    def test_batch_lookups(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = os.path.join(d, 'db')
+            with open(os.path.join(d, 'otus.csv'), 'w') as f:
+                f.write("\n".join(["\t".join(r) for r in [
+                    self.headers,
+                    ['m1', 'sample1', 'AAA', '1', '1.5', 'Root; a'],
+                    ['m1', 'sample2', 'AAA', '2', '2.5', 'Root; b'],
+                    ['m1', 'sample1', 'AAT', '3', '3.5', 'Root; a'],
+                    ['m2', 'sample1', 'AAA', '4', '4.5', 'Root; c'],
+                ]])+"\n")
+            extern.run("%s makedb --db %s --otu-table %s/otus.csv --sequence-database-methods none" % (
+                path_to_script, db, d))
+            sdb = SequenceDatabase.acquire(db)
+            marker_id = sdb.sqlalchemy_connection.execute("select id from markers where marker='m1'").scalar()
+
+            otus = sdb.otus_by_marker_wise_ids(marker_id, [0, 1, 1000], SequenceDatabase.NUCLEOTIDE_TYPE)
+            self.assertEqual([
+                (0, 'sample1', 'AAA', 1),
+                (0, 'sample2', 'AAA', 2),
+                (1, 'sample1', 'AAT', 3)],
+                sorted(zip(otus.marker_wise_id, otus.sample_name, otus.sequence, otus.num_hits)))
+            self.assertEqual(['Root; a', 'Root; b', 'Root; a'],
+                [sdb.get_taxonomy_via_cache(t) for t in otus.sort_values('num_hits').taxonomy_id])
+
+            otus = sdb.otus_by_marker_wise_ids(marker_id, [0, 1], SequenceDatabase.NUCLEOTIDE_TYPE, limit_per_sequence=1)
+            self.assertEqual([0, 1], sorted(otus.marker_wise_id))
+
+            # Protein sequences AAA -> K and AAT -> N
+            otus = sdb.otus_by_marker_wise_ids(marker_id, [0, 1], SequenceDatabase.PROTEIN_TYPE)
+            self.assertEqual([('AAA', 'K'), ('AAA', 'K'), ('AAT', 'N')],
+                sorted(zip(otus.sequence, otus.protein_sequence)))
+
+            otus = pd.concat(sdb.otus_by_sequences(['AAA', 'CCC']))
+            self.assertEqual([('m1', 'sample1'), ('m1', 'sample2'), ('m2', 'sample1')],
+                sorted(zip(otus.marker, otus.sample_name)))
+
+            # Sequences are looked up in chunks
+            original_chunk_size = SequenceDatabase._LOOKUP_CHUNK_SIZE
+            SequenceDatabase._LOOKUP_CHUNK_SIZE = 1
+            try:
+                chunks = list(sdb.otus_by_sequences(['AAA', 'CCC', 'AAT']))
+                self.assertEqual([3, 0, 1], [len(c) for c in chunks])
+            finally:
+                SequenceDatabase._LOOKUP_CHUNK_SIZE = original_chunk_size
+
+            # Lookups do not commit a transaction of the caller
+            connection = sdb.sqlalchemy_connection
+            connection.execute("CREATE TEMP TABLE caller_table (x INTEGER)")
+            transaction = connection.begin()
+            connection.execute("INSERT INTO caller_table VALUES (1)")
+            sdb.otus_by_marker_wise_ids(marker_id, [0], SequenceDatabase.NUCLEOTIDE_TYPE)
+            transaction.rollback()
+            self.assertEqual(0, connection.execute("SELECT count(*) FROM caller_table").scalar())
+
+    def test_makedb_resume(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = os.path.join(d, 'db')
+            otu_table = os.path.join(d, 'otus.csv')
+            shutil.copy(os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.csv'), otu_table)
+            cmd = "%s makedb --db %s --otu-table %s --sequence-database-methods annoy" %(
+                path_to_script,
+                db,
+                otu_table)
+            extern.run(cmd)
+            self.assertFalse(MakedbCheckpoint.exists(db))
+            query = "%s query --query-otu-table %s/methanobacteria/otus.transcripts.on_target.3random.csv --db %s --search-method annoy --max-nearest-neighbours 2" % (
+                path_to_script,
+                path_to_data,
+                db)
+            expected = extern.run(query)
+
+            # A finished build cannot be resumed
+            with self.assertRaises(Exception):
+                extern.run(cmd + ' --resume')
+
+            # Pretend the build was interrupted after the SQLite import
+            sqlite_mtime = os.path.getmtime(os.path.join(db, 'otus.sqlite3'))
+            for f in os.listdir(os.path.join(db, 'nucleotide_indices_annoy'))[:3]:
+                os.remove(os.path.join(db, 'nucleotide_indices_annoy', f))
+            MakedbCheckpoint(db, {
+                'input_files': MakedbCheckpoint.input_fingerprint([otu_table]),
+                'sequence_database_methods': ['annoy'],
+                'sequence_database_types': ['nucleotide'],
+                'num_annoy_nucleotide_trees': 10,
+                'num_annoy_protein_trees': 10,
+            }).complete('sqlite')
+
+            # Resuming with different options is an error
+            with self.assertRaises(Exception):
+                extern.run(cmd + ' --resume --num-annoy-nucleotide-trees 5')
+
+            # As is resuming with a different or modified OTU table
+            with self.assertRaises(Exception):
+                extern.run(cmd.replace(otu_table, os.path.join(path_to_data, 'methanobacteria', 'otus.transcripts.on_target.csv')) + ' --resume')
+            otu_table_stat = os.stat(otu_table)
+            os.utime(otu_table, ns=(otu_table_stat.st_atime_ns, otu_table_stat.st_mtime_ns + 10**9))
+            with self.assertRaises(Exception):
+                extern.run(cmd + ' --resume')
+            os.utime(otu_table, ns=(otu_table_stat.st_atime_ns, otu_table_stat.st_mtime_ns))
+
+            extern.run(cmd + ' --resume')
+            self.assertFalse(MakedbCheckpoint.exists(db))
+            self.assertEqual(sqlite_mtime, os.path.getmtime(os.path.join(db, 'otus.sqlite3')))
+            self.assertEqual(expected, extern.run(query))
+
     def test_protein_search_methanobacteria(self):
         with tempfile.TemporaryDirectory() as d:
             methods = ['annoy','scann','naive']
@@ -418,5 +549,36 @@ class Tests(unittest.TestCase):
                                                                   path_to_data)
         self.assertEqual(expected, extern.run(cmd).split('\n'))
 
+    def test_binary_matrix_encoding(self):
+        seqs = ['ATCGN-','GGTTAA']
+        self.assertEqual(
+            [nucleotides_to_binary_array(s) for s in seqs],
+            nucleotides_to_binary_matrix(seqs).tolist())
+        proteins = ['WHX-Z*','ACDEFG']
+        self.assertEqual(
+            [protein_to_binary_array(s) for s in proteins],
+            protein_to_binary_matrix(proteins).tolist())
+        with self.assertRaises(Exception):
+            nucleotides_to_binary_matrix(['ATG','AT'])
+
+    def test_with_exact_divergences(self):
+        def result(query_sequence, subject_sequence, estimated_divergence, protein_sequences=(None, None)):
+            subject = OtuTableEntry()
+            subject.sequence = subject_sequence
+            return QueryResult(
+                QueryInputSequence('q', query_sequence, 'marker'), subject, estimated_divergence,
+                query_protein_sequence=protein_sequences[0], subject_protein_sequence=protein_sequences[1])
+        results = [
+            result('AAAA', 'AAAT', 0),
+            result('AAAA', 'TTTT', 1),
+            result('AAAAAA', 'AAAAAT', 5),
+            result('AAA', 'AA', 1),
+            result('AAAAAA', 'TTTTTT', 0, protein_sequences=('KK', 'KF')),
+        ]
+        self.assertEqual([1, 4, 1, 1, 1],
+            [r.divergence for r in Querier()._with_exact_divergences(results, None)])
+        self.assertEqual([1, 1, 1, 1],
+            [r.divergence for r in Querier()._with_exact_divergences(results, 1)])
+
 if __name__ == "__main__":
     unittest.main()
@@ -25,6 +25,7 @@
 import sys, os, unittest
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 
+from singlem import metagenome_otu_finder
 from singlem.metagenome_otu_finder import MetagenomeOtuFinder
 from singlem.sequence_classes import *
 
@@ -48,6 +49,31 @@ class Tests(unittest.TestCase):
         self.assertEqual(('AAA-TG',6),\
             m._nucleotide_alignment(AlignedProteinSequence('name','AAA-TTGGG'), 'AAATTGGG', [0,1,2,3,5,6], False))
 
+    def test__nucleotide_alignments(self):
+        m = MetagenomeOtuFinder()
+        seqs = [AlignedProteinSequence('name','AC-D'), AlignedProteinSequence('name2','-CaD')]
+        nucleotides = ['AAATTTGGG', 'TTTCCCAAA']
+        self.assertEqual([('AAATTT---GGG',9), ('---TTTCCCAAA',9)],
+            m._nucleotide_alignments(seqs, nucleotides, [0,1,2,3], True))
+        self.assertEqual([('AAA---GGG',9), ('---CCCAAA',9)],
+            m._nucleotide_alignments(seqs, nucleotides, [0,2,3], True))
+        self.assertEqual([('AAAtttGGG',9), ('---tttcccAAA',9)],
+            m._nucleotide_alignments(seqs, nucleotides, [0,3], True, include_inserts=True))
+        self.assertEqual([], m._nucleotide_alignments([], [], [0], True))
+
+    def test__nucleotide_alignments_chunked(self):
+        m = MetagenomeOtuFinder()
+        seqs = [AlignedProteinSequence('name','AC-D'), AlignedProteinSequence('name2','-CaD'),
+                AlignedProteinSequence('name3','ACTD')]
+        nucleotides = ['AAATTTGGG', 'TTTCCCAAA', 'AAACCCGGGTTT']
+        original_chunk_size = metagenome_otu_finder.NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE
+        metagenome_otu_finder.NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE = 2
+        try:
+            self.assertEqual([('AAAtttGGG',9), ('---tttcccAAA',9), ('AAAcccgggTTT',12)],
+                m._nucleotide_alignments(seqs, nucleotides, [0,3], True, include_inserts=True))
+        finally:
+            metagenome_otu_finder.NUCLEOTIDE_ALIGNMENT_CHUNK_SIZE = original_chunk_size
+
     def test_find_best_window_with_nucleotides(self):
         m = MetagenomeOtuFinder()
         seqs = [
@@ -85,7 +111,6 @@ class Tests(unittest.TestCase):
                          [o.aligned_sequence for o in obs])
 
 
-
 if __name__ == "__main__":
     logging.basicConfig(level=logging.ERROR)
     unittest.main()
@@ -115,5 +115,22 @@ class Tests(unittest.TestCase):
             }, mp.get_taxonomy_of_reads(['2513020051', '2585428030']))
 
 
+    def test_get_dmnd_cached(self):
+        with tempfile.TemporaryDirectory(prefix='singlem') as cache:
+            os.environ['SINGLEM_PREFILTER_CACHE_DIRECTORY'] = cache
+            try:
+                mp = Metapackage([os.path.join(path_to_data, '4.12.22seqs.spkg')])
+                dmnd1 = mp.get_dmnd()
+                self.assertTrue(dmnd1.startswith(cache))
+                self.assertTrue(os.path.exists(dmnd1))
+                mtime = os.path.getmtime(dmnd1)
+                # Second call reuses the cached DB rather than rebuilding it
+                dmnd2 = mp.get_dmnd()
+                self.assertEqual(dmnd1, dmnd2)
+                self.assertEqual(mtime, os.path.getmtime(dmnd2))
+                self.assertEqual(1, len(os.listdir(cache)))
+            finally:
+                del os.environ['SINGLEM_PREFILTER_CACHE_DIRECTORY']
+
 if __name__ == "__main__":
     unittest.main()
@@ -36,6 +36,7 @@ path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 from singlem.pipe import SearchPipe
 from singlem.sequence_classes import SeqReader
+from singlem.singlem_package import SingleMPackage
 
 class Tests(unittest.TestCase):
     headers = str.split('gene sample sequence num_hits coverage taxonomy')
@@ -1094,10 +1095,34 @@ CGGGATGTAGGCAGTGACCTCCACGCCTGAGGAGAGCCGGACGCGTGCGACCTTGCGCAACGCCGAGTTCGGCTTCTTCG
             list([line.split("\t") for line in expected]),
             extern.run(cmd))
 
-
-
-
-
+    def test_write_diamond_assignment_chunks(self):
+        with tempfile.TemporaryDirectory() as d:
+            query = os.path.join(d, 'query.fasta')
+            with open(query, 'w') as f:
+                for i in range(2500):
+                    f.write(">seq{}\nATG\n".format(i))
+            chunk_sizes = []
+            for chunk_path in SearchPipe()._write_diamond_assignment_chunks(query, os.path.join(d, 'query0')):
+                with open(chunk_path) as f:
+                    chunk_sizes.append(len(list(SeqReader().readfq(f))))
+            self.assertEqual([1000, 1000, 500], chunk_sizes)
+            self.assertEqual(
+                ['query.fasta', 'query0.chunk0.fasta', 'query0.chunk1.fasta', 'query0.chunk2.fasta'],
+                sorted(os.listdir(d)))
+
+    def test_diamond_assignment_chunks_removed_on_failure(self):
+        spkg = SingleMPackage.acquire(os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        for assignment_threads in [1, 2]:
+            with tempfile.TemporaryDirectory() as d:
+                query = os.path.join(d, 'query.fasta')
+                with open(query, 'w') as f:
+                    f.write(">seq1\nATG\n")
+                pipe = SearchPipe()
+                pipe._working_directory = d
+                with self.assertRaises(extern.ExternCalledProcessError):
+                    pipe._run_diamond_assignment(
+                        [(query, spkg, {})], 'false ', 'diamond', assignment_threads)
+                self.assertEqual(['query.fasta'], os.listdir(d))
 
 
 if __name__ == "__main__":
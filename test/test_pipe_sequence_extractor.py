@@ -34,8 +34,13 @@ path_to_script = os.path.join(os.path.dirname(os.path.realpath(__file__)),'..','
 path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
-from singlem.pipe_sequence_extractor import _align_proteins_to_hmm
+from singlem import pipe_sequence_extractor
+from singlem.pipe_sequence_extractor import _align_proteins_to_hmm, _run_chunked_jobs, _package_offsets, \
+    _hmmsearch, _DiamondPackageExtraction, PipeSequenceExtractor
 from singlem.sequence_classes import SeqReader
+from singlem.diamond_spkg_searcher import DiamondSearchResult
+from singlem.singlem_package import SingleMPackage
+import multiprocessing
 
 class Tests(unittest.TestCase):
     headers = str.split('gene sample sequence num_hits coverage taxonomy')
@@ -75,5 +80,75 @@ class Tests(unittest.TestCase):
             '-------VAKKVDSVVKLQIPAGKANPAPPVGPALGQAGINIMGFCKEFNAQT-QDQA-----GMIIPVEITVYEDRSFTFITKTPPAAVLLKKAAGI-----E--------TASGEPNRNKVA---------TLNRDKVKEIAELKMPDLNAADVEAAMRMVEGTARSMGIVIED--------',
             a2.seq)
 
+    def test_run_chunked_jobs(self):
+        def run(pool):
+            finished = []
+            def on_finish(result):
+                finished.append(result)
+                # Each negative result leads to another job
+                if result < 0:
+                    return [(abs, (result,), on_finish)]
+                return []
+            _run_chunked_jobs(pool, [(abs, (-1,), on_finish), (abs, (2,), on_finish), (min, (-3, 0), on_finish)])
+            return sorted(finished)
+        self.assertEqual([-3, 1, 2, 3], run(None))
+        with multiprocessing.Pool(2) as pool:
+            self.assertEqual([-3, 1, 2, 3], run(pool))
+
+    def test_package_offsets(self):
+        with tempfile.TemporaryDirectory() as d:
+            fasta_path = os.path.join(d, 'sample.fna')
+            result = DiamondSearchResult(fasta_path)
+            with open(fasta_path, 'w') as f:
+                for i in range(5):
+                    f.write(">read{}\nATG\n".format(i))
+                    result.add_hit('read{}'.format(i), 'subject1' if i != 2 else 'subject2')
+            offsets = _package_offsets(result, [set(['subject1']), set(['subject2', 'subject3']), set(['subject4'])])
+            self.assertEqual([[0, 11, 33, 44], [22], []], [list(o) for o in offsets])
+            self.assertEqual(['read0', 'read1', 'read3', 'read4'],
+                [s.name for s in result.read_store().sequences(offsets[0])])
+
+    def write_prefilter_result(self, d, spkg):
+        fasta_path = os.path.join(d, 'sample.fna')
+        result = DiamondSearchResult(fasta_path)
+        subject_id = sorted(spkg.get_sequence_ids())[0]
+        with open(fasta_path, 'w') as f:
+            for name in ['inseqs', 'inseqs2']:
+                with open(os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg_{}.fna'.format(name))) as g:
+                    for (read_name, seq, _) in SeqReader().readfq(g):
+                        f.write(">{}\n{}\n".format(read_name, seq))
+                        result.add_hit(read_name, subject_id)
+        return result
+
+    def test_package_hmmsearch_is_not_chunked(self):
+        spkg = SingleMPackage.acquire(os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        with tempfile.TemporaryDirectory() as d:
+            result = self.write_prefilter_result(d, spkg)
+            offsets = _package_offsets(result, [spkg.get_sequence_ids()])[0]
+            jobs = _DiamondPackageExtraction(result, spkg, 'sample', 72, False).jobs(offsets)
+            self.assertEqual(1, len(jobs))
+            (function, args, _) = jobs[0]
+            self.assertEqual(_hmmsearch, function)
+            self.assertEqual(list(offsets), list(args[1]))
+
+    def test_chunked_hmmalign_gives_same_hits(self):
+        spkg = SingleMPackage.acquire(os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        def extract(hmmalign_chunk_size):
+            original_chunk_size = pipe_sequence_extractor.HMMALIGN_CHUNK_SIZE
+            pipe_sequence_extractor.HMMALIGN_CHUNK_SIZE = hmmalign_chunk_size
+            try:
+                with tempfile.TemporaryDirectory() as d:
+                    result = self.write_prefilter_result(d, spkg)
+                    extracted_reads = PipeSequenceExtractor().extract_relevant_reads_from_diamond_prefilter(
+                        1, [spkg], [result], None, False, False, 72)
+                    return sorted(
+                        (s.name, s.aligned_sequence)
+                        for readset in extracted_reads for s in readset.unknown_sequences)
+            finally:
+                pipe_sequence_extractor.HMMALIGN_CHUNK_SIZE = original_chunk_size
+        unchunked = extract(pipe_sequence_extractor.HMMALIGN_CHUNK_SIZE)
+        self.assertEqual(2, len(unchunked))
+        self.assertEqual(unchunked, extract(1))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os
+import sys
+import pickle
+import tempfile
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+from singlem.read_store import ReadStore
+
+class Tests(unittest.TestCase):
+    def test_read_store(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'reads.fna')
+            with open(path, 'w') as f:
+                f.write(">read1\nATGATG\n>read2\n\n>read3\nCCC")
+            store = ReadStore(path)
+            self.assertEqual([(0, 'read1', 'ATGATG'), (14, 'read2', ''), (22, 'read3', 'CCC')],
+                list(store.each()))
+            s = store.sequence(22)
+            self.assertEqual(('read3', 'CCC'), (s.name, s.seq))
+            self.assertEqual(['read3', 'read1'], [s.name for s in store.sequences([22, 0])])
+            with self.assertRaises(Exception):
+                store.sequence(1)
+
+            # Only the path is pickled
+            unpickled = pickle.loads(pickle.dumps(store))
+            self.assertEqual(path, unpickled.path)
+            self.assertEqual('ATGATG', unpickled.sequence(0).seq)
+            store.close()
+            unpickled.close()
+
+    def test_empty_read_store(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'reads.fna')
+            open(path, 'w').close()
+            self.assertEqual([], list(ReadStore(path).each()))
+
+if __name__ == "__main__":
+    unittest.main()
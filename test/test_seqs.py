@@ -66,5 +66,31 @@ TATGGAGGAACACCAGTGGC
                         'Found best section of the alignment starting from 14\n' in \
                         stde.read())
 
+    def test_seqs_window_cache(self):
+        aln = '''>s1
+ga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGATGTG
+>s2
+ca---------GAGATATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGACGCTGA----
+'''
+        with tempfile.TemporaryDirectory() as d:
+            alignment = os.path.join(d, 'alignment.fasta')
+            cache = os.path.join(d, 'window_cache.json')
+            with open(alignment, 'w') as a:
+                a.write(aln)
+            cmd = "%s seqs --alignment %s --alignment-type dna --window-size 20 --window-cache %s 2>&1" % (
+                path_to_script, alignment, cache)
+            first = extern.run(cmd)
+            self.assertTrue('Found best start position 13\n' in first)
+            self.assertTrue(os.path.exists(cache))
+
+            second = extern.run(cmd)
+            self.assertTrue('Found cached best section of the alignment' in second)
+            self.assertTrue('Found best start position 13\n' in second)
+
+            # A changed alignment is not found in the cache
+            with open(alignment, 'a') as a:
+                a.write(">s3\nga-------------TATGGAGGAACACCAGTGGCGAAGGCGACTTTCTGGTCTGtaACTGGGCTGATGTG-\n")
+            self.assertFalse('Found cached' in extern.run(cmd))
+
 if __name__ == "__main__":
     unittest.main()
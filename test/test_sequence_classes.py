@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+import unittest
+import os.path
+import tempfile
+import gzip
+import threading
+import sys
+from io import StringIO
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.sequence_classes import SeqReader
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    fasta = ">s1 desc\nACGT\nAA\n>s2\n\nGGG\n>s3\nT\n"
+    fastq = "@r1 desc\nACGT\n+\n@II+\n@r2\nGG\n+r2\nII\n@r3\nT\n+\n#\n"
+
+    def assertLikeReadfq(self, text):
+        expected = list(SeqReader().readfq(StringIO(text)))
+        for chunk_size in [1, 5, 1000]:
+            reader = SeqReader()
+            reader.CHUNK_SIZE = chunk_size
+            self.assertEqual(expected, list(reader.readfq_buffered(StringIO(text))))
+        return expected
+
+    def test_fasta(self):
+        self.assertEqual([
+            ('s1','ACGTAA',None),
+            ('s2','GGG',None),
+            ('s3','T',None)], self.assertLikeReadfq(self.fasta))
+
+    def test_fastq(self):
+        self.assertEqual([
+            ('r1','ACGT','@II+'),
+            ('r2','GG','II'),
+            ('r3','T','#')], self.assertLikeReadfq(self.fastq))
+
+    def test_multiline_fastq(self):
+        self.assertEqual([
+            ('r1','ACGT','@II+'),
+            ('r2','GGAA','IIII'),
+            ('r3','T','#')], self.assertLikeReadfq("@r1\nACGT\n+\n@II+\n@r2\nGG\nAA\n+\nII\nII\n@r3\nT\n+\n#\n"))
+
+    def test_empty(self):
+        self.assertEqual([], self.assertLikeReadfq(''))
+        self.assertEqual([], list(SeqReader().readfq_batches(StringIO('\n'))))
+
+    def test_batches(self):
+        batches = list(SeqReader().readfq_batches(StringIO(self.fastq), batch_size=2))
+        self.assertEqual([['r1','r2'],['r3']], [[r[0] for r in b] for b in batches])
+
+    def test_gzip(self):
+        with tempfile.NamedTemporaryFile(suffix='.fq.gz') as f:
+            with gzip.open(f.name, 'wt') as g:
+                g.write(self.fastq)
+            with SeqReader.open_sequence_file(f.name) as g:
+                self.assertEqual(['r1','r2','r3'], [r[0] for r in SeqReader().readfq_buffered(g)])
+
+    def test_gzip_named_pipe(self):
+        with tempfile.TemporaryDirectory() as d:
+            fifo = os.path.join(d, 'reads.fq.gz')
+            os.mkfifo(fifo)
+            def write():
+                with open(fifo, 'wb') as out:
+                    out.write(gzip.compress(self.fastq.encode()))
+            writer = threading.Thread(target=write)
+            writer.start()
+            with SeqReader.open_sequence_file(fifo) as g:
+                self.assertEqual(['r1','r2','r3'], [r[0] for r in SeqReader().readfq_buffered(g)])
+            writer.join()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -32,6 +32,7 @@ path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
 sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
 from singlem.strain_summariser import StrainSummariser
 from singlem.otu_table_collection import OtuTableCollection
+from singlem.otu_table_entry import OtuTableEntry
 
 class Tests(unittest.TestCase):
     headers = str.split('gene sample sequence num_hits coverage taxonomy')
@@ -115,5 +116,18 @@ class Tests(unittest.TestCase):
                         output_table_io = output)
         self.assertEqual(exp, output.getvalue())
 
+    def test_differences_of_unequal_lengths(self):
+        def entry(sequence):
+            e = OtuTableEntry()
+            e.sequence = sequence
+            return e
+        reference = entry('AAAAAA')
+        differences = StrainSummariser()._differences(
+            reference,
+            [entry('AAAAAT'), reference, entry('TAAAAAGG'), entry('AATA'), entry('TAAAAA')])
+        self.assertEqual(
+            [('AAAAAT', 1), ('TAAAAAGG', 1), ('AATA', 3), ('TAAAAA', 1)],
+            [(d.sequence, d.difference_in_bp) for d in differences])
+
 if __name__ == "__main__":
     unittest.main()
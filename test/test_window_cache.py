@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import sys, os, unittest, tempfile
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from singlem.window_cache import WindowCache
+from singlem.singlem_package import SingleMPackage
+from singlem.sequence_classes import Sequence
+
+path_to_data = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data')
+
+class Tests(unittest.TestCase):
+    def test_window_columns_cached(self):
+        alignment = [Sequence('s1', 'AAaCCCGG'), Sequence('s2', 'A-aCC-GG')]
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'window_cache.json')
+            sequences = os.path.join(d, 'seqs.fasta')
+            with open(sequences, 'w') as f:
+                f.write('>s1\nAACCCGG\n')
+            checksum = WindowCache.checksum([sequences], 'window_columns', 1, 3)
+            self.assertEqual(([2], [1, 3, 4]),
+                WindowCache(path).window_columns(checksum, alignment, 1, 3))
+
+            # A new cache from the same file gives the cached columns,
+            # without looking at the alignment.
+            self.assertEqual(([2], [1, 3, 4]),
+                WindowCache(path).window_columns(checksum, None, 1, 3))
+
+            with open(sequences, 'w') as f:
+                f.write('>s1\nAACCCGT\n')
+            self.assertIsNone(WindowCache(path).get(
+                WindowCache.checksum([sequences], 'window_columns', 1, 3)))
+
+    def test_package_window_cache_path(self):
+        spkg = SingleMPackage.acquire(os.path.join(path_to_data, '4.11.22seqs.gpkg.spkg'))
+        self.assertEqual(
+            os.path.join(spkg.base_directory(), 'window_cache.json'),
+            spkg.window_cache_path())
+
+if __name__ == "__main__":
+    unittest.main()